@@ -38,6 +38,7 @@ interface Thread {
   emailList: Email[];
   resolved: boolean;
   read: boolean;
+  responseStatus: "queued" | "running" | "done" | "failed" | null;
 }
 
 interface Email {
@@ -68,6 +69,7 @@ interface Response {
   documents: Document[][];
   confidence: number;
   emailId: number;
+  fastPath: boolean;
 }
 
 export default function InboxPage() {
@@ -201,6 +203,14 @@ export default function InboxPage() {
         body: formData,
       })
         .then((res) => {
+          if (res.status === 202) {
+            notifications.show({
+              title: "Response pending",
+              color: "blue",
+              message: "The response is still being generated, check back soon.",
+            });
+            return;
+          }
           if (res.ok) return res.json();
           notifications.show({
             title: "Error!",
@@ -210,6 +220,7 @@ export default function InboxPage() {
           return;
         })
         .then((data) => {
+          if (!data) return;
           setStoredResponses((oldResponses) => {
             return { ...oldResponses, [currEmailID]: data };
           });
@@ -290,30 +301,71 @@ export default function InboxPage() {
       loading: true,
       autoClose: false,
     });
-    fetch(`/api/emails/regen_response`, {
+    const showError = () => {
+      notifications.update({
+        id: "loading",
+        title: "Error!",
+        color: "red",
+        loading: false,
+        message: "Something went wrong!",
+      });
+    };
+    fetch(`/api/emails/regen_response_stream`, {
       method: "POST",
       body: formData,
     })
-      .then((res) => {
-        if (res.ok) return res.json();
-        notifications.update({
-          id: "loading",
-          title: "Error!",
-          color: "red",
-          loading: false,
-          message: "Something went wrong!",
-        });
+      .then(async (res) => {
+        if (res.status === 202) {
+          notifications.update({
+            id: "loading",
+            title: "Response pending",
+            color: "blue",
+            loading: false,
+            message: "The response is still being generated, check back soon.",
+          });
+          return;
+        }
+        if (!res.ok || !res.body) {
+          showError();
+          return;
+        }
+        // the response is streamed as server-sent events, separated by blank lines
+        const reader = res.body.pipeThrough(new TextDecoderStream()).getReader();
+        let buffer = "";
+        let text = "";
+        for (;;) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += value;
+          const events = buffer.split("\n\n");
+          buffer = events.pop() ?? "";
+          for (const event of events) {
+            const lines = event.split("\n");
+            const name = lines[0].replace("event: ", "");
+            const data = JSON.parse(lines[1].replace("data: ", ""));
+            if (name === "token") {
+              text += data.content;
+              editor?.commands.setContent(text.replaceAll("\n", "<br/>"));
+            } else if (name === "done") {
+              setStoredResponses((oldResponses) => {
+                return { ...oldResponses, [data.emailId]: data };
+              });
+              setResponse(data);
+              setContent(data.content.replaceAll("\n", "<br/>"));
+              notifications.update({
+                id: "loading",
+                title: "Success!",
+                color: "green",
+                loading: false,
+                message: "Response has been regenerated!",
+              });
+            } else {
+              showError();
+            }
+          }
+        }
       })
-      .then(() => {
-        getResponse(true);
-        notifications.update({
-          id: "loading",
-          title: "Success!",
-          color: "green",
-          loading: false,
-          message: "Response has been regenerated!",
-        });
-      });
+      .catch(showError);
   };
 
   const resolveThread = () => {
@@ -1,6 +1,7 @@
 """Initialize the Flask app."""
 
-from typing import Type, cast
+import logging
+from typing import TYPE_CHECKING, Type, cast
 
 import numpy
 import redis
@@ -9,8 +10,15 @@ from flask import redirect, render_template
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from psycopg2.extensions import AsIs, register_adapter
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase, MappedAsDataclass
 
+from server.utils import configure_logging, custom_log
+
+if TYPE_CHECKING:
+    from server.jobs import JobQueue
+
 
 def addapt_numpy_float64(numpy_float64):
     """Adapt numpy.float64 to SQL syntax.
@@ -61,6 +69,10 @@ db = SQLAlchemy(model_class=Base)
 db = cast(ProperlyTypedSQLAlchemy, db)
 
 redis_client: redis.Redis | None = None
+# client for values stored as raw bytes, which must not be decoded
+redis_binary_client: redis.Redis | None = None
+# queue of responses to generate, see server.jobs
+job_queue: "JobQueue | None" = None
 
 
 def create_app():
@@ -77,14 +89,23 @@ def create_app():
     )
 
     app.config.from_pyfile("config.py")
+    configure_logging(
+        app.config["LOG_LEVEL"], app.config["LOG_FORMAT"], app.config["LOG_SAMPLE_RATE"]
+    )
 
     with app.app_context():
         db.init_app(app)
 
-        global redis_client
+        global redis_client, redis_binary_client
         redis_client = redis.Redis(
             host=app.config["REDIS_HOST"], port=6379, decode_responses=True
         )
+        redis_binary_client = redis.Redis(host=app.config["REDIS_HOST"], port=6379)
+
+        from server.jobs import create_job_queue
+
+        global job_queue
+        job_queue = create_job_queue(app.config["JOB_QUEUE"])
 
         allowed_domains = app.config.get("ALLOWED_DOMAINS")
 
@@ -98,11 +119,39 @@ def create_app():
 
         app.register_blueprint(api)
 
-        from server.cli import seed
+        from server.cli import jobs, mail, seed
 
         app.register_blueprint(seed)
+        app.register_blueprint(mail)
+        app.register_blueprint(jobs)
 
         db.create_all()
+        # create_all doesn't add columns or indexes to existing tables
+        db.session.execute(
+            text(
+                "ALTER TABLE response ADD COLUMN IF NOT EXISTS "
+                "fast_path BOOLEAN NOT NULL DEFAULT false"
+            )
+        )
+        db.session.execute(
+            text("ALTER TABLE email ADD COLUMN IF NOT EXISTS stripped_body VARCHAR")
+        )
+        db.session.commit()
+        try:
+            db.session.execute(
+                text(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS ix_email_message_id "
+                    "ON email (message_id)"
+                )
+            )
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            custom_log(
+                "can't index email message ids, remove duplicate emails first:",
+                e,
+                level=logging.ERROR,
+            )
 
         @app.errorhandler(404)
         def _default(_error):
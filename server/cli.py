@@ -1,31 +1,29 @@
 """Flask CLI commands."""
 
-from flask import Blueprint
+import click
+from flask import Blueprint, current_app
 
 from server import db
+from server.config import IMPORT_BATCH_SIZE, JOB_WORKERS
 from server.fake_data import (
     generate_fake_email,
     generate_fake_thread,
     generate_test_documents,
 )
+from server.jobs import start_response_workers
+from server.mail_import import enqueue_drafts, import_mailbox, iter_mailbox
 from server.models.document import Document
-from server.nlp.embeddings import embed_corpus
+from server.nlp.embeddings import document_to_redis, embed_corpus
 
 seed = Blueprint("seed", __name__)
+mail = Blueprint("mail", __name__)
+jobs = Blueprint("jobs", __name__)
 
 
 def _embed_existing_documents(documents: list[Document]):
     """Embed existing documents."""
-    to_embed_documents = [
-        {
-            "question": doc.question,
-            "source": doc.source,
-            "content": doc.content,
-            "sql_id": doc.id,
-        }
-        for doc in documents
-    ]
-    embed_corpus(to_embed_documents)
+    embed_corpus([document_to_redis(doc) for doc in documents])
+    db.session.commit()
 
 
 @seed.cli.command()
@@ -33,6 +31,7 @@ def corpus():
     """Add test documents to the corpus."""
     test_documents = generate_test_documents()
     embed_corpus(test_documents)
+    db.session.commit()
 
 
 @seed.cli.command()
@@ -46,6 +45,7 @@ def email():
         print("No documents in the database. Generating test documents...")
         test_documents = generate_test_documents()
         embed_corpus(test_documents)
+        db.session.commit()
     else:
         print("Embedding existing documents...")
         _embed_existing_documents(docs)
@@ -64,8 +64,43 @@ def thread():
         print("No documents in the database. Generating test documents...")
         test_documents = generate_test_documents()
         embed_corpus(test_documents)
+        db.session.commit()
     else:
         print("Embedding existing documents...")
         _embed_existing_documents(docs)
 
     generate_fake_thread()
+
+
+@mail.cli.command("import")
+@click.argument("path", type=click.Path(exists=True))
+@click.option(
+    "--drafts",
+    is_flag=True,
+    help="Generate responses for unanswered threads of the mailbox.",
+)
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, show_default=True)
+def import_mail(path: str, drafts: bool, batch_size: int):
+    """Import an mbox file or a directory of .eml files."""
+    imported_threads: set[int] = set()
+    counts = import_mailbox(iter_mailbox(path), batch_size, imported_threads)
+    print(
+        f"Imported {counts['imported']} emails in {counts['threads']} new threads, "
+        f"skipped {counts['duplicates']} duplicates and {counts['unreadable']} "
+        "unreadable messages."
+    )
+    if drafts:
+        count = enqueue_drafts(imported_threads)
+        print(
+            f"Queued {count} responses, which are generated by the web server or "
+            "`flask jobs work`."
+        )
+
+
+@jobs.cli.command()
+@click.option("--workers", default=JOB_WORKERS, show_default=True)
+def work(workers: int):
+    """Generate responses to received emails until stopped."""
+    app = current_app._get_current_object()  # type: ignore
+    for worker in start_response_workers(app, workers):
+        worker.join()
@@ -1,6 +1,7 @@
 """The admin controller handles admin-related routes."""
 
 import json
+import logging
 from ast import literal_eval
 from typing import cast
 
@@ -10,12 +11,37 @@ from flask import request
 from sqlalchemy import select
 
 from server import db
+from server.mail_import import enqueue_drafts, import_mailbox, iter_mbox
 from server.models.document import Document
-from server.nlp.embeddings import embed_corpus
+from server.nlp.embeddings import (
+    delete_documents,
+    document_to_redis,
+    embed_corpus,
+    upsert_documents,
+)
+from server.nlp.metrics import get_metrics, hit_rate, ratio
+from server.utils import custom_log
 
 admin = APIBlueprint("admin", __name__, url_prefix="/admin", tag="Admin")
 
 
+def _index_documents(documents: list[Document]):
+    """Upsert committed documents into the vector store.
+
+    Errors are logged instead of raised, since the request already succeeded once
+    the documents were committed. /admin/update_embeddings indexes them later.
+
+    Args:
+        documents: committed documents
+    """
+    try:
+        upsert_documents([document_to_redis(document) for document in documents])
+        db.session.commit()
+    except Exception as e:
+        ids = [document.id for document in documents]
+        custom_log("failed to index documents", ids, e, level=logging.WARNING)
+
+
 @admin.route("/upload_document", methods=["POST"])
 def upload_text():
     """POST /admin/upload_document"""
@@ -28,6 +54,7 @@ def upload_text():
     )
     db.session.add(document)
     db.session.commit()
+    _index_documents([document])
     return {"message": "Document uploaded"}
 
 
@@ -40,6 +67,7 @@ def delete_text():
     ).scalar()
     if document is None:
         return {"error": "Document not found"}, 404
+    delete_documents([document.id])
     if document.response_count > 0:
         document.to_delete = True
         db.session.commit()
@@ -64,6 +92,8 @@ def update_text():
     document.source = data["source"]
     document.label = data["label"]
     db.session.commit()
+    if not document.to_delete:
+        _index_documents([document])
     return {"message": "Document updated"}
 
 
@@ -87,18 +117,70 @@ def update_embeddings():
         .all()
     )
 
-    docs = [document.map() for document in documents if not document.to_delete]
     modified_corpus = [
-        {
-            "question": doc["question"],
-            "source": doc["source"],
-            "content": doc["content"],
-            "sql_id": doc["id"],
-        }
-        for doc in docs
+        document_to_redis(document) for document in documents if not document.to_delete
     ]
-    embed_corpus(modified_corpus)
-    return {"message": "Embeddings updated"}
+    stats = embed_corpus(modified_corpus)
+    db.session.commit()
+    return {"message": "Embeddings updated", "embedding_cache": stats}
+
+
+@admin.route("/metrics", methods=["GET"])
+def metrics():
+    """GET /admin/metrics"""
+    counters = get_metrics()
+    return {
+        "counters": counters,
+        "query_embedding_cache_hit_rate": hit_rate(
+            counters.get("query_embedding_cache_hits", 0),
+            counters.get("query_embedding_cache_misses", 0),
+        ),
+        "document_embedding_cache_hit_rate": hit_rate(
+            counters.get("document_embedding_cache_hits", 0),
+            counters.get("document_embedding_cache_misses", 0),
+        ),
+        "response_cache_hit_rate": hit_rate(
+            counters.get("response_cache_hits", 0),
+            counters.get("response_cache_misses", 0),
+        ),
+        # fraction of emails parsed by OpenAI, and the latency they added on average
+        "parse_llm_call_rate": ratio(
+            counters.get("parse_llm_calls", 0), counters.get("parse_requests", 0)
+        ),
+        "parse_llm_ms_per_email": ratio(
+            counters.get("parse_llm_ms", 0), counters.get("parse_requests", 0)
+        ),
+        # retried requests and responses without questions per email parsed by OpenAI
+        "parse_llm_retries_per_call": ratio(
+            counters.get("openai_retries_parse", 0), counters.get("parse_llm_calls", 0)
+        ),
+        "parse_llm_invalid_rate": ratio(
+            counters.get("parse_llm_invalid", 0), counters.get("parse_llm_calls", 0)
+        ),
+        # fraction of generated responses assembled from documents without OpenAI
+        "fast_path_rate": ratio(
+            counters.get("fast_path_responses", 0),
+            counters.get("fast_path_responses", 0) + counters.get("prompts", 0),
+        ),
+        # milliseconds emails waited in the job queue before their response was started,
+        # and the fraction of response jobs that failed
+        "response_job_wait_ms_per_job": ratio(
+            counters.get("response_job_wait_ms", 0), counters.get("response_jobs", 0)
+        ),
+        "response_job_failure_rate": ratio(
+            counters.get("response_job_failures", 0), counters.get("response_jobs", 0)
+        ),
+        # microseconds spent re-ranking the candidates of a question for diversity
+        "mmr_us_per_query": ratio(
+            counters.get("mmr_us", 0), counters.get("mmr_queries", 0)
+        ),
+        # prompt tokens after deduplicating documents and fitting the token budget,
+        # as a fraction of the tokens before
+        "prompt_token_ratio": ratio(
+            counters.get("prompt_tokens_after", 0),
+            counters.get("prompt_tokens_before", 0),
+        ),
+    }
 
 
 @admin.route("/import_json", methods=["POST"])
@@ -107,6 +189,7 @@ def upload_json():
     try:
         file = request.data
         json_data = literal_eval(file.decode("utf8"))
+        documents = []
         for doc in json_data:
             document = Document(
                 doc.get("question", ""),
@@ -115,12 +198,34 @@ def upload_json():
                 doc.get("label", ""),
             )
             db.session.add(document)
+            documents.append(document)
         db.session.commit()
     except Exception as e:
         return {"error": f"An error occurred: {str(e)}"}, 400
+    _index_documents(documents)
     return {"message": "JSON imported"}
 
 
+@admin.route("/import_mailbox", methods=["POST"])
+def upload_mailbox():
+    """POST /admin/import_mailbox
+
+    Import an mbox file or a single .eml file, sent as the request body. The body is
+    read as a stream, so mailboxes of any size can be imported. Pass drafts=true to
+    generate responses for unanswered threads of the mailbox.
+    """
+    imported_threads: set[int] = set()
+    try:
+        counts = import_mailbox(
+            iter_mbox(request.stream), imported_threads=imported_threads
+        )
+    except Exception as e:
+        return {"error": f"An error occurred: {str(e)}"}, 400
+    if request.args.get("drafts") == "true":
+        counts["drafts"] = enqueue_drafts(imported_threads)
+    return counts
+
+
 @admin.route("/export_json", methods=["GET"])
 def export_json():
     """GET /admin/export_json"""
@@ -151,6 +256,7 @@ def import_csv():
         file = request.files["file"]
         df = pd.read_csv(file.stream)
 
+        documents = []
         for _, row in df.iterrows():
             document = Document(
                 question=cast(str, "" if pd.isna(row["question"]) else row["question"]),  # type: ignore
@@ -159,9 +265,11 @@ def import_csv():
                 label=cast(str, "" if pd.isna(row["label"]) else row["label"]),  # type: ignore
             )
             db.session.add(document)
+            documents.append(document)
         db.session.commit()
     except Exception as e:
         return {"error": f"An error occurred: {str(e)}"}, 400
+    _index_documents(documents)
     return {"message": "CSV imported"}
 
 
@@ -198,6 +306,7 @@ def clear_documents():
             .scalars()
             .all()
         )
+        delete_documents([document.id for document in documents])
         for document in documents:
             if document.response_count > 0:
                 document.to_delete = True
@@ -3,37 +3,50 @@
 import email
 import email.mime.multipart
 import email.mime.text
+import json
+import logging
 import os
-import re
 from datetime import datetime, timezone
 from typing import List
 
 import boto3
 from apiflask import APIBlueprint
-from flask import request
+from flask import Response as FlaskResponse
+from flask import request, stream_with_context
 from jinja2 import Environment, FileSystemLoader
+from redis.exceptions import RedisError
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 
-from server import db
+from server import db, job_queue, redis_client
 from server.config import (
     AWS_ACCESS_KEY_ID,
     AWS_REGION,
     AWS_SECRET_ACCESS_KEY,
+    EMAIL_SEEN_TTL,
     MAIL_CC,
     MAIL_USERNAME,
+    TEAM_REPLY_SOURCE,
     OpenAIMessage,
     RedisDocument,
 )
+from server.jobs import QUEUED, RUNNING
 from server.models.document import Document
 from server.models.email import Email
 from server.models.response import Response
 from server.models.thread import Thread
-from server.nlp.responses import generate_response
+from server.nlp.embeddings import document_to_redis, upsert_documents
+from server.nlp.quote_stripper import strip_quotes
+from server.nlp.responses import generate_response, stream_response
+from server.utils import clean_up, custom_log
 
 cwd = os.path.dirname(__file__)
 env = Environment(loader=FileSystemLoader([f"{cwd}/../email_template"]))
 emails = APIBlueprint("emails", __name__, url_prefix="/emails", tag="Emails")
 
+assert redis_client is not None
+assert job_queue is not None
+
 
 def thread_emails_to_openai_messages(thread_emails: List[Email]) -> List[OpenAIMessage]:
     """Converts list of email to openai messages.
@@ -47,7 +60,7 @@ def thread_emails_to_openai_messages(thread_emails: List[Email]) -> List[OpenAIM
     openai_messages = []
     for t_email in thread_emails:
         role = "user" if t_email.sender != MAIL_USERNAME else "assistant"
-        openai_messages.append({"role": role, "content": t_email.body})
+        openai_messages.append({"role": role, "content": t_email.prompt_body})
     return openai_messages
 
 
@@ -119,6 +132,120 @@ def decrement_response_count(documents: List["Document"]):
         db.session.commit()
 
 
+def update_response(
+    response: Response,
+    openai_res: str,
+    documents: dict[str, List[RedisDocument]],
+    confidence: float,
+    fast_path: bool,
+):
+    """Replace a stored response with a regenerated one.
+
+    Args:
+        response: stored response
+        openai_res: regenerated email response
+        documents: raw openai document output
+        confidence: confidence of the regenerated response
+        fast_path: whether the regenerated response was assembled by the fast path
+    """
+    decrement_response_count(response.documents)
+    questions, db_documents, doc_confs, docs_per_question = document_data(documents)
+    increment_response_count(db_documents)
+    response.response = openai_res
+    response.questions = questions
+    response.docs_per_question = docs_per_question
+    response.documents = db_documents
+    response.document_confidences = doc_confs
+    response.confidence = confidence
+    response.fast_path = fast_path
+    db.session.commit()
+
+
+def respond_to_email(email_id: int):
+    """Generate and store the response to an email.
+
+    Run by the job queue workers for emails stored by receive_email. Emails that
+    already have a response are skipped, so repeated jobs are harmless.
+
+    Args:
+        email_id: id of the email
+    """
+    email = db.session.execute(select(Email).where(Email.id == email_id)).scalar()
+    if email is None:
+        custom_log(
+            "email", email_id, "not found, skipping response job", level=logging.WARNING
+        )
+        return
+    if email.is_reply:
+        custom_log(
+            "email",
+            email_id,
+            "is a reply, skipping response job",
+            level=logging.WARNING,
+        )
+        return
+    response = db.session.execute(
+        select(Response).where(Response.email_id == email_id)
+    ).scalar()
+    if response is not None:
+        return
+
+    # only the emails before this one are previous emails of the thread
+    thread = db.session.execute(
+        select(Thread).where(Thread.id == email.thread_id)
+    ).scalar_one()
+    previous_emails = [e for e in thread.emails if e.id < email.id]
+    openai_messages = thread_emails_to_openai_messages(previous_emails)
+    openai_res, documents, confidence, fast_path = generate_response(
+        email.sender, email.prompt_body, openai_messages
+    )
+    questions, documents, doc_confs, docs_per_question = document_data(documents)
+
+    r = Response(
+        openai_res,
+        questions,
+        docs_per_question,
+        documents,
+        doc_confs,
+        confidence,
+        email.id,
+        fast_path,
+    )
+    db.session.add(r)
+    db.session.commit()
+    increment_response_count(documents)
+
+
+def enqueue_missing_response(email_id: int) -> tuple[dict, int]:
+    """Enqueue the response job of an email that has no response.
+
+    The job of the email failed, or was lost with its worker. Emails whose job is
+    still queued or running aren't enqueued again.
+
+    Args:
+        email_id: id of the email
+
+    Returns:
+        response with the status of the job
+    """
+    job_queue.enqueue(email_id)
+    status = job_queue.status(email_id)
+    return {"message": "Response is being generated", "status": status}, 202
+
+
+def server_sent_event(event: str, data: dict) -> str:
+    """Format a server-sent event.
+
+    Args:
+        event: event name
+        data: JSON-serializable event data
+
+    Returns:
+        event in the text/event-stream format
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 # not used as of 1/28/2024
 # save for future reference, in case we ever need to switch back to mailgun or a similar
 # provider
@@ -193,44 +320,112 @@ def decrement_response_count(documents: List["Document"]):
 #     return data
 
 
-@emails.route("/receive_email", methods=["POST"])
-def receive_email():
-    """GET /receive_email
+def mark_email_seen(message_id: str) -> bool:
+    """Remember that an email was received, unless it was received recently.
 
-    More information about the way that AWS SES sends emails can be found at
-    go/pigeon-emails
+    Emails are let through if redis is unavailable, and are then only deduplicated
+    by the unique index on message ids.
+
+    Args:
+        message_id: message id of the email
+
+    Returns:
+        False if an email with this message id was received in the last
+        EMAIL_SEEN_TTL seconds, True otherwise
     """
-    data = request.form
-    print(data, flush=True)
+    try:
+        return bool(
+            redis_client.set(f"emails:seen:{message_id}", 1, nx=True, ex=EMAIL_SEEN_TTL)
+        )
+    except RedisError as e:
+        custom_log("failed to check for duplicate email", e, level=logging.WARNING)
+        return True
 
-    if (
-        "From" not in data
-        or "Subject" not in data
-        or "stripped-text" not in data
-        or "Message-Id" not in data
-    ):
-        return {"message": "Missing fields"}, 400
 
-    # aws sends duplicate emails sometimes. ignore if duplicate
-    email_exists = db.session.execute(
-        select(Email).where(Email.message_id == data["Message-Id"])
+def forget_email_seen(message_id: str):
+    """Forget that an email was received, so it is accepted if it is sent again.
+
+    Args:
+        message_id: message id of the email
+    """
+    try:
+        redis_client.delete(f"emails:seen:{message_id}")
+    except RedisError as e:
+        custom_log("failed to forget email", e, level=logging.WARNING)
+
+
+def insert_email(email: Email) -> int | None:
+    """Insert an email, unless an email with the same message id exists.
+
+    Concurrent deliveries of the same email can't both insert it, because of the
+    unique index on message ids.
+
+    Args:
+        email: email to insert
+
+    Returns:
+        id of the inserted email, or None if it is a duplicate
+    """
+    columns = (
+        "date",
+        "sender",
+        "subject",
+        "body",
+        "message_id",
+        "is_reply",
+        "stripped_body",
+    )
+    values = {column: getattr(email, column) for column in columns}
+    return db.session.execute(
+        insert(Email)
+        .values(**values, thread_id=email.thread_id)
+        .on_conflict_do_nothing(index_elements=[Email.message_id])
+        .returning(Email.id)
     ).scalar()
-    if email_exists:
-        print("duplicate email", flush=True)
-        return data
 
+
+def unanswered_email(message_id: str) -> int | None:
+    """Find a stored email from a hacker that has no response.
+
+    Args:
+        message_id: message id of the email
+
+    Returns:
+        id of the email, or None if it isn't stored, is a reply or has a response
+    """
+    return db.session.execute(
+        select(Email.id)
+        .outerjoin(Response, Response.email_id == Email.id)
+        .where(
+            Email.message_id == message_id,
+            Email.is_reply.is_(False),
+            Response.id.is_(None),
+        )
+    ).scalar()
+
+
+def store_email(data) -> int | None:
+    """Store a received email, in a new thread or the thread it replies to.
+
+    The new thread of a duplicate email is deleted before it is committed, so
+    nothing is stored for duplicates.
+
+    Args:
+        data: form data of the email sent by AWS
+
+    Returns:
+        id of the stored email, or None if it was not stored
+    """
     # by default, body contains the full email bodies of all previous emails in the
-    # thread here, we filter out previous emails so that only the body of the current
-    # email is used. this filtering is purposely not done on AWS because of potentially
-    # needing context for the TODO below
-    body = data["stripped-text"]
-    body = str(body)
+    # thread, and the signature of the sender. organizers see the body up to the
+    # outlook separator, and a copy without the quoted history and signature is
+    # stored for the prompt. this filtering is purposely not done on AWS because of
+    # potentially needing context for the TODO below
+    body = str(data["stripped-text"])
     start_of_reply = body.find("________________________________")
-
     if start_of_reply != -1:
         body = body[:start_of_reply]
 
-    email = None
     thread = None
 
     if "In-Reply-To" in data:
@@ -242,67 +437,86 @@ def receive_email():
         replied_to_email = db.session.execute(
             select(Email).where(Email.message_id == real_message_id)
         ).scalar()
-        print("replied to email", replied_to_email, flush=True)
-        print("real message id", real_message_id, len(real_message_id), flush=True)
-        print(
-            "data from",
-            data["From"],
-            "hackmit@my.hackmit.org" not in data["From"],
-            flush=True,
+        custom_log(
+            "reply to",
+            real_message_id,
+            "found" if replied_to_email else "not found",
+            level=logging.DEBUG,
         )
         if "hackmit@my.hackmit.org" not in data["From"] and replied_to_email:
             thread = db.session.execute(
                 select(Thread).where(Thread.id == replied_to_email.thread_id)
             ).scalar()
-            if thread:
-                email = Email(
-                    datetime.now(timezone.utc),
-                    data["From"],
-                    data["Subject"],
-                    body,
-                    data["Message-Id"],
-                    False,
-                    thread.id,
-                )
         # TODO(#5): this ignores case where user responds to an email that isn't in the
         # database. should we handle this?
     else:
         # new email, create new thread
         thread = Thread()
         db.session.add(thread)
-        db.session.commit()
-        email = Email(
-            datetime.now(timezone.utc),
-            data["From"],
-            data["Subject"],
-            body,
-            data["Message-Id"],
-            False,
-            thread.id,
-        )
-    if email is not None and thread is not None:
-        openai_messages = thread_emails_to_openai_messages(thread.emails)
-        openai_res, documents, confidence = generate_response(
-            email.sender, email.body, openai_messages
-        )
-        questions, documents, doc_confs, docs_per_question = document_data(documents)
+        db.session.flush()
+    if thread is None:
+        return None
 
-        db.session.add(email)
-        db.session.commit()
-        r = Response(
-            openai_res,
-            questions,
-            docs_per_question,
-            documents,
-            doc_confs,
-            confidence,
-            email.id,
-        )
-        db.session.add(r)
-        thread.last_email = email.id
-        thread.resolved = False
+    email = Email(
+        datetime.now(timezone.utc),
+        data["From"],
+        data["Subject"],
+        body,
+        data["Message-Id"],
+        False,
+        thread.id,
+        strip_quotes(body),
+    )
+    email_id = insert_email(email)
+    if email_id is None:
+        custom_log("duplicate email", data["Message-Id"])
+        if "In-Reply-To" not in data:
+            db.session.delete(thread)
         db.session.commit()
-        increment_response_count(documents)
+        return None
+    thread.last_email = email_id
+    thread.resolved = False
+    db.session.commit()
+    return email_id
+
+
+@emails.route("/receive_email", methods=["POST"])
+def receive_email():
+    """GET /receive_email
+
+    More information about the way that AWS SES sends emails can be found at
+    go/pigeon-emails
+    """
+    data = request.form
+    custom_log("received email", data.get("Message-Id"), level=logging.DEBUG)
+
+    if (
+        "From" not in data
+        or "Subject" not in data
+        or "stripped-text" not in data
+        or "Message-Id" not in data
+    ):
+        return {"message": "Missing fields"}, 400
+
+    # aws sends duplicate emails sometimes. ignore if duplicate
+    message_id = data["Message-Id"]
+    if not mark_email_seen(message_id):
+        custom_log("duplicate email", message_id)
+        return data
+
+    try:
+        email_id = store_email(data)
+        if email_id is None:
+            # the email may have been stored by a delivery that failed to enqueue it
+            email_id = unanswered_email(message_id)
+        if email_id is not None:
+            # the response is generated in the background, so the sender doesn't
+            # time out and retry while it is generated
+            job_queue.enqueue(email_id)
+    except Exception:
+        # let a redelivery of the email through
+        forget_email_seen(message_id)
+        raise
     return data
 
 
@@ -357,13 +571,6 @@ def get_full_message_id(message_id):
     return f"<{message_id}@us-east-2.amazonses.com>"
 
 
-def clean_up(text):
-    r"""Clean text by removing html tags and replacing <br /> with \n."""
-    breaked_line_text = text.replace("<br/>", "\n")
-    clean_regex = re.compile("<.*?>")
-    return re.sub(clean_regex, " ", breaked_line_text)
-
-
 @emails.route("/send_email", methods=["POST"])
 def send_email():
     """POST /send_email"""
@@ -385,8 +592,8 @@ def send_email():
     body = template.render(**context)
 
     # add body to documents
-    question = clean_up(reply_to_email.body)
-    new_doc = Document(question, reply_to_email.subject, clean_text, "HackMIT team")
+    question = clean_up(reply_to_email.prompt_body)
+    new_doc = Document(question, reply_to_email.subject, clean_text, TEAM_REPLY_SOURCE)
     db.session.add(new_doc)
     db.session.commit()
 
@@ -416,12 +623,7 @@ def send_email():
     )
 
     new_mesage_id = get_full_message_id(response["MessageId"])
-    print(
-        "sending a new repsonse with message id",
-        new_mesage_id,
-        len(new_mesage_id),
-        flush=True,
-    )
+    custom_log("sent response with message id", new_mesage_id)
 
     thread.resolved = True
     reply_email = Email(
@@ -432,6 +634,7 @@ def send_email():
         get_full_message_id(response["MessageId"]),
         True,
         thread.id,
+        clean_text,
     )
 
     db.session.add(reply_email)
@@ -445,6 +648,15 @@ def send_email():
     if response:
         decrement_response_count(response.documents)
 
+    # the email has already been sent, so failing to index the new document
+    # shouldn't fail the request. it will be indexed on the next embeddings update
+    try:
+        # every reply adds a document, so cached responses aren't invalidated by them
+        upsert_documents([document_to_redis(new_doc)], invalidate_responses=False)
+        db.session.commit()
+    except Exception as e:
+        custom_log("failed to index new document", new_doc.id, e, level=logging.WARNING)
+
     return {"message": "Email sent successfully"}
 
 
@@ -457,7 +669,10 @@ def get_response():
     ).scalar()
 
     if not response:
-        return {"message": "Response not found"}, 400
+        status = job_queue.status(int(data["id"]))
+        if status in (QUEUED, RUNNING):
+            return {"message": "Response is being generated", "status": status}, 202
+        return {"message": "Response not found", "status": status}, 400
     return response.map()
 
 
@@ -476,30 +691,72 @@ def regen_response():
     ).scalar()
     if not email:
         return {"message": "Email not found"}, 400
+    if email.is_reply:
+        return {"message": "The last email of the thread is a reply"}, 400
     response = db.session.execute(
         select(Response).where(Response.email_id == email.id)
     ).scalar()
-    if not thread or not email or not response:
-        return {"message": "Something went wrong!"}, 400
+    if not response:
+        return enqueue_missing_response(email.id)
 
     openai_messages = thread_emails_to_openai_messages(thread.emails)
-    openai_res, documents, confidence = generate_response(
-        email.sender, email.body, openai_messages
+    openai_res, documents, confidence, fast_path = generate_response(
+        email.sender, email.prompt_body, openai_messages
     )
-    decrement_response_count(response.documents)
-    questions, documents, doc_confs, docs_per_question = document_data(documents)
-    increment_response_count(documents)
-    response.response = openai_res
-    response.questions = questions
-    response.docs_per_question = docs_per_question
-    response.documents = documents
-    response.document_confidences = doc_confs
-    response.confidence = confidence
-    db.session.commit()
+    update_response(response, openai_res, documents, confidence, fast_path)
 
     return {"message": "Successfully updated"}, 200
 
 
+@emails.route("/regen_response_stream", methods=["POST"])
+def regen_response_stream():
+    """POST /regen_response_stream
+
+    Regenerate the AI-gen response for an email, streaming it as server-sent events.
+    Each piece of the response is sent as a "token" event as soon as it is generated,
+    and the stored response is sent as a "done" event once it is saved.
+    """
+    data = request.form
+    thread = db.session.execute(select(Thread).where(Thread.id == data["id"])).scalar()
+    if not thread:
+        return {"message": "Thread not found"}, 400
+    email = db.session.execute(
+        select(Email).where(Email.id == thread.last_email)
+    ).scalar()
+    if not email:
+        return {"message": "Email not found"}, 400
+    if email.is_reply:
+        return {"message": "The last email of the thread is a reply"}, 400
+    response = db.session.execute(
+        select(Response).where(Response.email_id == email.id)
+    ).scalar()
+    if not response:
+        return enqueue_missing_response(email.id)
+
+    openai_messages = thread_emails_to_openai_messages(thread.emails)
+    tokens, documents, confidence, fast_path = stream_response(
+        email.sender, email.prompt_body, openai_messages
+    )
+
+    def events():
+        pieces = []
+        try:
+            for token in tokens:
+                pieces.append(token)
+                yield server_sent_event("token", {"content": token})
+            update_response(response, "".join(pieces), documents, confidence, fast_path)
+            yield server_sent_event("done", response.map())
+        except Exception as e:
+            custom_log("failed to stream response", e, level=logging.ERROR)
+            yield server_sent_event("error", {"message": "Something went wrong!"})
+
+    return FlaskResponse(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @emails.route("/resolve", methods=["POST"])
 def resolve():
     """POST /resolve
@@ -545,7 +802,7 @@ def delete():
     db.session.delete(thread)
     db.session.commit()
 
-    print("deleted thread", flush=True)
+    custom_log("deleted thread", data["id"])
 
     return {"message": "Successfully deleted"}, 200
 
@@ -563,11 +820,21 @@ def get_threads():
         .scalars()
         .all()
     )
+    email_ids = [
+        thread.last_email for thread in thread_list if thread.last_email is not None
+    ]
+    statuses = dict(zip(email_ids, job_queue.statuses(email_ids)))
     email_list = [
         {
             "id": thread.id,
             "resolved": thread.resolved,
             "read": thread.read,
+            # threads without emails have no job
+            "responseStatus": (
+                statuses.get(thread.last_email)
+                if thread.last_email is not None
+                else None
+            ),
             "emailList": [
                 thread_email.map()
                 for thread_email in db.session.execute(
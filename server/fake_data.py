@@ -13,6 +13,7 @@ from server.models.document import Document
 from server.models.email import Email
 from server.models.response import Response
 from server.models.thread import Thread
+from server.nlp.embeddings import document_to_redis
 from server.nlp.responses import generate_response
 
 FLASK_SEED_CORPUS = "server/nlp/corpus_flask_seed.json"
@@ -35,16 +36,7 @@ def generate_test_documents():
         db.session.commit()
         documents.append(document)
 
-    test_documents = [
-        {
-            "question": doc.question,
-            "source": doc.source,
-            "content": doc.content,
-            "sql_id": doc.id,
-        }
-        for doc in documents
-    ]
-    return test_documents
+    return [document_to_redis(doc) for doc in documents]
 
 
 def _generate_response(email: Email, thread: Thread):
@@ -53,8 +45,8 @@ def _generate_response(email: Email, thread: Thread):
     Email arg should be the last email in the thread.
     """
     openai_messages = thread_emails_to_openai_messages(thread.emails)
-    openai_res, documents, confidence = generate_response(
-        email.sender, email.body, openai_messages
+    openai_res, documents, confidence, fast_path = generate_response(
+        email.sender, email.prompt_body, openai_messages
     )
     questions, documents, doc_confs, docs_per_question = document_data(documents)
 
@@ -66,6 +58,7 @@ def _generate_response(email: Email, thread: Thread):
         doc_confs,
         confidence,
         email.id,
+        fast_path,
     )
 
     db.session.add(r)
@@ -84,7 +77,7 @@ def generate_fake_email():
     body_1 = (
         "Dear HackMIT Team,\n\n" "What is HackMIT? \n\n" "Best regards,\n" "Andrew\n\n"
     )
-    message_id = "test-message-id"
+    message_id = f"test-message-id-{thread.id}"
     email = Email(
         date=datetime.datetime.now(datetime.timezone.utc),
         sender=og_sender,
@@ -115,7 +108,7 @@ def generate_fake_thread():
     body_1 = (
         "Dear HackMIT Team,\n\n" "What is HackMIT? \n\n" "Best regards,\n" "Andrew\n\n"
     )
-    message_id = "test-message-id"
+    message_id = f"test-message-id-{thread.id}"
     email_1 = Email(
         date=datetime.datetime.now(datetime.timezone.utc),
         sender=og_sender,
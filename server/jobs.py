@@ -0,0 +1,525 @@
+"""Jobs.
+
+This module provides the queue that responses to incoming emails are generated from,
+so receive_email can return as soon as the email is stored. Two backends are
+available:
+
+- RedisJobQueue keeps jobs in a redis list shared by all processes.
+- InProcessJobQueue keeps jobs in memory, and is meant for tests.
+
+A pool of worker threads takes jobs off the queue and runs them. Workers are started
+by the web server and by `flask jobs work`, but not by other CLI commands, which exit
+before the jobs they would take are done. Each job generates the response to one
+email, and its status is kept by email id, so the inbox can show emails that are still
+being answered.
+
+RedisJobQueue moves the jobs it takes into a processing list, and holds a lease on
+each of them while it runs. Jobs whose lease expired, because their worker crashed or
+was stopped by a redeploy, are moved back to the queue by the other workers.
+"""
+
+import json
+import logging
+import math
+import queue
+import threading
+import time
+from typing import Callable
+
+from apiflask import APIFlask
+
+from server import db, redis_client
+from server.config import (
+    JOB_LEASE_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    JOB_POLL_SECONDS,
+    JOB_STATUS_TTL,
+)
+from server.nlp.metrics import increment
+from server.utils import custom_log
+
+assert redis_client is not None
+
+Job = dict
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# moves a job from the processing list back to the queue, unless another worker
+# already did, so it is run next
+REQUEUE_SCRIPT = """
+if redis.call("LREM", KEYS[1], 1, ARGV[1]) == 1 then
+    redis.call("RPUSH", KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# sets the status of an email to queued and pushes its job, unless its job is already
+# queued or running, so concurrent enqueues of the same email push one job
+ENQUEUE_SCRIPT = """
+local status = redis.call("GET", KEYS[1])
+if status == ARGV[2] or status == ARGV[3] then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[4])
+redis.call("LPUSH", KEYS[2], ARGV[1])
+return 1
+"""
+
+
+class JobQueue:
+    """Interface for job queue backends."""
+
+    def push(self, job: Job):
+        """Add a job to the end of the queue.
+
+        Args:
+            job: job to add
+        """
+        raise NotImplementedError
+
+    def pop(self, timeout: float) -> Job | None:
+        """Take the next job off the queue, waiting for one if it is empty.
+
+        Args:
+            timeout: seconds to wait for a job
+
+        Returns:
+            next job, or None if there was none before the timeout
+        """
+        raise NotImplementedError
+
+    def set_status(self, email_id: int, status: str):
+        """Set the status of the job of an email.
+
+        Args:
+            email_id: id of the email
+            status: "queued", "running", "done" or "failed"
+        """
+        raise NotImplementedError
+
+    def status(self, email_id: int) -> str | None:
+        """Get the status of the job of an email.
+
+        Args:
+            email_id: id of the email
+
+        Returns:
+            status of the job, or None if the email has no recent job
+        """
+        raise NotImplementedError
+
+    def statuses(self, email_ids: list[int]) -> list[str | None]:
+        """Get the statuses of the jobs of several emails.
+
+        Args:
+            email_ids: ids of the emails
+
+        Returns:
+            status of the job of each email, or None if it has no recent job
+        """
+        return [self.status(email_id) for email_id in email_ids]
+
+    def ack(self, job: Job):
+        """Forget a job that was taken off the queue and has finished.
+
+        Args:
+            job: job, as returned by pop
+        """
+
+    def requeue_stale(self) -> int:
+        """Move jobs that were taken off the queue by lost workers back to the queue.
+
+        Returns:
+            number of jobs moved back
+        """
+        return 0
+
+    @staticmethod
+    def new_job(email_id: int) -> Job:
+        """Create the first attempt of the job of an email.
+
+        Args:
+            email_id: id of the email
+
+        Returns:
+            job
+        """
+        return {"email_id": email_id, "attempts": 0, "enqueued_at": time.time()}
+
+    def enqueue(self, email_id: int) -> bool:
+        """Enqueue a job that generates the response to an email.
+
+        Emails whose job is queued or running are skipped, so they aren't answered
+        twice at once.
+
+        Args:
+            email_id: id of the email
+
+        Returns:
+            whether a job was enqueued
+        """
+        raise NotImplementedError
+
+
+class RedisJobQueue(JobQueue):
+    """Job queue in a redis list, shared by all processes.
+
+    Statuses expire after JOB_STATUS_TTL seconds, and jobs taken off the queue are
+    moved back to it if they aren't finished within JOB_LEASE_SECONDS.
+    """
+
+    queue_key = "jobs:responses"
+    processing_key = "jobs:processing"
+    status_prefix = "jobs:status:"
+    lease_prefix = "jobs:lease:"
+
+    def __init__(self):
+        """Create a client for the queue."""
+        self._requeue_script = redis_client.register_script(REQUEUE_SCRIPT)
+        self._enqueue_script = redis_client.register_script(ENQUEUE_SCRIPT)
+        # jobs in the processing list without a lease, with the time they were first
+        # seen, since a job is moved there just before its lease is taken
+        self._unleased: dict[str, float] = {}
+
+    def _lease_key(self, job: Job) -> str:
+        # retries of a job get a lease of their own, so finishing an attempt doesn't
+        # release the lease of the next one
+        return f"{self.lease_prefix}{job['email_id']}:{job['attempts']}"
+
+    def push(self, job: Job):
+        """Add a job to the end of the queue.
+
+        Args:
+            job: job to add
+        """
+        redis_client.lpush(self.queue_key, json.dumps(job))
+
+    def enqueue(self, email_id: int) -> bool:
+        """Enqueue a job that generates the response to an email.
+
+        The status is checked and set in one step, so concurrent enqueues of the same
+        email push one job.
+
+        Args:
+            email_id: id of the email
+
+        Returns:
+            whether a job was enqueued
+        """
+        return bool(
+            self._enqueue_script(
+                keys=[f"{self.status_prefix}{email_id}", self.queue_key],
+                args=[
+                    json.dumps(self.new_job(email_id)),
+                    QUEUED,
+                    RUNNING,
+                    JOB_STATUS_TTL,
+                ],
+            )
+        )
+
+    def pop(self, timeout: float) -> Job | None:
+        """Take the next job off the queue, waiting for one if it is empty.
+
+        Args:
+            timeout: seconds to wait for a job
+
+        Returns:
+            next job, or None if there was none before the timeout
+        """
+        # a timeout of 0 would block forever
+        raw = redis_client.blmove(
+            self.queue_key,
+            self.processing_key,
+            max(1, math.ceil(timeout)),
+            "RIGHT",
+            "LEFT",
+        )
+        if raw is None:
+            return None
+        job = json.loads(raw)  # type: ignore
+        redis_client.set(self._lease_key(job), 1, ex=JOB_LEASE_SECONDS)
+        return job
+
+    def set_status(self, email_id: int, status: str):
+        """Set the status of the job of an email.
+
+        Args:
+            email_id: id of the email
+            status: "queued", "running", "done" or "failed"
+        """
+        redis_client.set(f"{self.status_prefix}{email_id}", status, ex=JOB_STATUS_TTL)
+
+    def status(self, email_id: int) -> str | None:
+        """Get the status of the job of an email.
+
+        Args:
+            email_id: id of the email
+
+        Returns:
+            status of the job, or None if the email has no recent job
+        """
+        return redis_client.get(f"{self.status_prefix}{email_id}")  # type: ignore
+
+    def statuses(self, email_ids: list[int]) -> list[str | None]:
+        """Get the statuses of the jobs of several emails in one round trip.
+
+        Args:
+            email_ids: ids of the emails
+
+        Returns:
+            status of the job of each email, or None if it has no recent job
+        """
+        if not email_ids:
+            return []
+        keys = [f"{self.status_prefix}{email_id}" for email_id in email_ids]
+        return redis_client.mget(keys)  # type: ignore
+
+    def ack(self, job: Job):
+        """Forget a job that was taken off the queue and has finished.
+
+        Args:
+            job: job, as returned by pop
+        """
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.lrem(self.processing_key, 1, json.dumps(job))
+        pipeline.delete(self._lease_key(job))
+        pipeline.execute()
+
+    def requeue_stale(self) -> int:
+        """Move jobs that were taken off the queue by lost workers back to the queue.
+
+        Returns:
+            number of jobs moved back
+        """
+        raws: list[str] = redis_client.lrange(self.processing_key, 0, -1)  # type: ignore
+        if not raws:
+            self._unleased = {}
+            return 0
+        jobs = [json.loads(raw) for raw in raws]
+        leases = redis_client.mget([self._lease_key(job) for job in jobs])
+        now = time.time()
+        unleased, count = {}, 0
+        for raw, job, lease in zip(raws, jobs, leases):  # type: ignore
+            if lease is not None:
+                continue
+            seen_at = self._unleased.get(raw, now)
+            if now - seen_at < JOB_POLL_SECONDS:
+                unleased[raw] = seen_at
+                continue
+            if self._requeue_script(
+                keys=[self.processing_key, self.queue_key], args=[raw]
+            ):
+                self.set_status(job["email_id"], QUEUED)
+                count += 1
+        self._unleased = unleased
+        return count
+
+
+class InProcessJobQueue(JobQueue):
+    """Job queue in memory, only visible to the process that created it."""
+
+    def __init__(self):
+        """Create an empty queue."""
+        self._jobs: queue.Queue[Job] = queue.Queue()
+        self._statuses: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def push(self, job: Job):
+        """Add a job to the end of the queue.
+
+        Args:
+            job: job to add
+        """
+        self._jobs.put(job)
+
+    def enqueue(self, email_id: int) -> bool:
+        """Enqueue a job that generates the response to an email.
+
+        Args:
+            email_id: id of the email
+
+        Returns:
+            whether a job was enqueued
+        """
+        with self._lock:
+            if self.status(email_id) in (QUEUED, RUNNING):
+                return False
+            self.set_status(email_id, QUEUED)
+            self.push(self.new_job(email_id))
+        return True
+
+    def pop(self, timeout: float) -> Job | None:
+        """Take the next job off the queue, waiting for one if it is empty.
+
+        Args:
+            timeout: seconds to wait for a job
+
+        Returns:
+            next job, or None if there was none before the timeout
+        """
+        try:
+            return self._jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def set_status(self, email_id: int, status: str):
+        """Set the status of the job of an email.
+
+        Args:
+            email_id: id of the email
+            status: "queued", "running", "done" or "failed"
+        """
+        self._statuses[email_id] = status
+
+    def status(self, email_id: int) -> str | None:
+        """Get the status of the job of an email.
+
+        Args:
+            email_id: id of the email
+
+        Returns:
+            status of the job, or None if the email has no job
+        """
+        return self._statuses.get(email_id)
+
+
+def create_job_queue(backend: str) -> JobQueue:
+    """Create the job queue for the configured backend.
+
+    Args:
+        backend: "redis" or "memory"
+
+    Returns:
+        job queue
+
+    Raises:
+        exception: if the backend is not supported
+    """
+    if backend == "redis":
+        return RedisJobQueue()
+    if backend == "memory":
+        return InProcessJobQueue()
+    raise Exception(f"unsupported job queue {backend}")
+
+
+def run_job(job_queue: JobQueue, job: Job, handler: Callable[[int], None]):
+    """Run a job, retrying it later if it fails.
+
+    Must be called within an app context.
+
+    Args:
+        job_queue: queue the job was taken from
+        job: job to run
+        handler: generates the response to an email, given its id
+    """
+    email_id = job["email_id"]
+    job_queue.set_status(email_id, RUNNING)
+    increment("response_jobs")
+    increment("response_job_wait_ms", round((time.time() - job["enqueued_at"]) * 1000))
+    try:
+        handler(email_id)
+    except Exception as e:
+        db.session.rollback()
+        attempts = job["attempts"] + 1
+        custom_log(
+            "response job for email", email_id, "failed:", e, level=logging.WARNING
+        )
+        increment("response_job_failures")
+        if attempts < JOB_MAX_ATTEMPTS:
+            job_queue.set_status(email_id, QUEUED)
+            job_queue.push({**job, "attempts": attempts})
+        else:
+            job_queue.set_status(email_id, FAILED)
+        job_queue.ack(job)
+        return
+    job_queue.set_status(email_id, DONE)
+    job_queue.ack(job)
+
+
+def work(app: APIFlask, job_queue: JobQueue, handler: Callable[[int], None]):
+    """Run jobs from the queue forever.
+
+    Args:
+        app: Flask app, whose context jobs are run in
+        job_queue: queue to take jobs from
+        handler: generates the response to an email, given its id
+    """
+    checked_at = 0.0
+    while True:
+        try:
+            if time.time() - checked_at >= JOB_POLL_SECONDS:
+                checked_at = time.time()
+                requeued = job_queue.requeue_stale()
+                if requeued:
+                    custom_log(
+                        "requeued", requeued, "stale jobs", level=logging.WARNING
+                    )
+            job = job_queue.pop(JOB_POLL_SECONDS)
+        except Exception as e:
+            custom_log("job queue unavailable:", e, level=logging.WARNING)
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+        if job is None:
+            continue
+        with app.app_context():
+            try:
+                run_job(job_queue, job, handler)
+            except Exception as e:
+                custom_log(
+                    "response job for email",
+                    job["email_id"],
+                    "lost:",
+                    e,
+                    level=logging.ERROR,
+                )
+
+
+def start_workers(
+    app: APIFlask, job_queue: JobQueue, handler: Callable[[int], None], count: int
+) -> list[threading.Thread]:
+    """Start a pool of worker threads that run jobs from the queue.
+
+    Args:
+        app: Flask app, whose context jobs are run in
+        job_queue: queue to take jobs from
+        handler: generates the response to an email, given its id
+        count: number of worker threads
+
+    Returns:
+        worker threads
+    """
+    workers = [
+        threading.Thread(
+            target=work, args=(app, job_queue, handler), name=f"job-worker-{i}"
+        )
+        for i in range(count)
+    ]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    return workers
+
+
+def start_response_workers(app: APIFlask, count: int) -> list[threading.Thread]:
+    """Start a pool of worker threads that generate responses to received emails.
+
+    Only long-running processes should start workers, since jobs taken by a process
+    that exits are only run again once their lease expires.
+
+    Args:
+        app: Flask app, whose context jobs are run in
+        count: number of worker threads
+
+    Returns:
+        worker threads
+    """
+    from server import job_queue
+    from server.controllers.emails import respond_to_email
+
+    assert job_queue is not None
+    return start_workers(app, job_queue, respond_to_email, count)
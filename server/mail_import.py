@@ -0,0 +1,325 @@
+"""Mail import.
+
+This module imports mailboxes in bulk, e.g. the inbox of a previous season or a
+backlog of emails that SES couldn't deliver during an outage. Mailboxes are read from
+an mbox file or a directory of .eml files one message at a time, and stored in
+batches of IMPORT_BATCH_SIZE emails, so memory use doesn't grow with the mailbox.
+
+Messages are threaded by their In-Reply-To and References headers. Threads are looked
+up among the emails of the same batch and, through the unique index on message ids,
+among the stored emails, so a reply joins the thread of its parent as long as the
+parent comes first in the mailbox or is already stored. Messages that are already
+stored are skipped, so importing a mailbox again is harmless.
+"""
+
+import hashlib
+import logging
+import re
+from datetime import datetime, timezone
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+from email.utils import parseaddr, parsedate_to_datetime
+from pathlib import Path
+from typing import IO, Iterable, Iterator
+
+from sqlalchemy import and_, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from server import db, job_queue
+from server.config import IMPORT_BATCH_SIZE, MAIL_USERNAME
+from server.models.email import Email
+from server.models.response import Response
+from server.models.thread import Thread
+from server.nlp.quote_stripper import strip_quotes
+from server.utils import clean_up, custom_log
+
+assert job_queue is not None
+
+ImportedEmail = dict
+
+# addresses that emails of the HackMIT team are sent from
+TEAM_ADDRESSES = frozenset({"hackmit@my.hackmit.org", MAIL_USERNAME})
+
+MESSAGE_ID = re.compile(r"<[^<>\s]+>")
+# mboxrd escapes lines of message bodies that start with "From " by prefixing them
+# with ">", and lines that already start with ">From " by prefixing another one
+ESCAPED_FROM_LINE = re.compile(rb"^>(>*From )")
+
+# sets the last email of each of the given threads to its newest email, and resolves
+# threads whose newest email was sent by the team
+UPDATE_THREADS = text(
+    """
+    UPDATE thread
+    SET last_email = newest.id, resolved = newest.is_reply
+    FROM (
+        SELECT DISTINCT ON (thread_id) thread_id, id, is_reply
+        FROM email
+        WHERE thread_id = ANY(:thread_ids)
+        ORDER BY thread_id, date DESC, id DESC
+    ) AS newest
+    WHERE thread.id = newest.thread_id
+    """
+)
+
+
+def iter_mbox(file: IO[bytes]) -> Iterator[bytes]:
+    """Read the messages of an mbox file one at a time.
+
+    Lines before the first "From " line are read as a message of their own, so a
+    single .eml file is read as a mailbox with one message.
+
+    Args:
+        file: mbox file opened in binary mode, or a binary stream such as a request
+            body
+
+    Yields:
+        raw messages, in the order of the file
+    """
+    lines: list[bytes] = []
+    for line in file:
+        if line.startswith(b"From "):
+            if any(line.strip() for line in lines):
+                yield b"".join(lines)
+            lines = []
+        else:
+            lines.append(ESCAPED_FROM_LINE.sub(rb"\1", line))
+    if any(line.strip() for line in lines):
+        yield b"".join(lines)
+
+
+def iter_mailbox(path: str | Path) -> Iterator[bytes]:
+    """Read the messages of an mbox file or a directory of .eml files one at a time.
+
+    Args:
+        path: mbox file, or directory searched recursively for .eml files
+
+    Yields:
+        raw messages, in the order of the file or sorted by file path
+    """
+    path = Path(path)
+    if not path.is_dir():
+        with path.open("rb") as file:
+            yield from iter_mbox(file)
+        return
+    for eml_path in sorted(path.rglob("*.eml")):
+        yield eml_path.read_bytes()
+
+
+def message_body(message: EmailMessage) -> str:
+    """Get the text of an email.
+
+    Args:
+        message: parsed email
+
+    Returns:
+        plain text body, or the text of the HTML body if there is no plain text body
+    """
+    part = message.get_body(preferencelist=("plain", "html"))
+    if part is None:
+        return ""
+    try:
+        content = part.get_content()
+    except (LookupError, UnicodeDecodeError):
+        payload = part.get_payload(decode=True)
+        content = (
+            payload.decode("utf-8", "replace") if isinstance(payload, bytes) else ""
+        )
+    if part.get_content_type() == "text/html":
+        content = clean_up(content)
+    return str(content).strip()
+
+
+def parse_message(raw: bytes) -> ImportedEmail:
+    """Parse a raw message into the fields of an email.
+
+    Messages without a Message-Id get one derived from their contents, so importing
+    them again is still harmless.
+
+    Args:
+        raw: raw message
+
+    Returns:
+        dictionary with the columns of the email, and the message ids of the emails
+        it replies to as "parents", nearest first
+    """
+    message = BytesParser(policy=policy.default).parsebytes(raw)
+    assert isinstance(message, EmailMessage)
+
+    message_ids = MESSAGE_ID.findall(str(message.get("Message-Id", "")))
+    if message_ids:
+        message_id = message_ids[0]
+    else:
+        message_id = f"<{hashlib.sha256(raw).hexdigest()[:32]}@import.pigeon>"
+
+    try:
+        date = parsedate_to_datetime(str(message["Date"]))
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        date = datetime.now(timezone.utc)
+
+    body = message_body(message)
+    sender = str(message.get("From", ""))
+    references = MESSAGE_ID.findall(str(message.get("References", "")))
+    in_reply_to = MESSAGE_ID.findall(str(message.get("In-Reply-To", "")))
+    parents = list(dict.fromkeys(in_reply_to + references[::-1]))
+
+    return {
+        "date": date.astimezone(timezone.utc),
+        "sender": sender,
+        "subject": str(message.get("Subject", "")),
+        "body": body,
+        "stripped_body": strip_quotes(body),
+        "message_id": message_id,
+        "is_reply": parseaddr(sender)[1].lower() in TEAM_ADDRESSES,
+        "parents": [parent for parent in parents if parent != message_id],
+    }
+
+
+def import_batch(
+    emails: list[ImportedEmail], imported_threads: set[int] | None = None
+) -> dict[str, int]:
+    """Store a batch of parsed emails in their threads.
+
+    Args:
+        emails: parsed emails, with unique message ids
+        imported_threads: set the ids of the threads emails were imported into are
+            added to
+
+    Returns:
+        number of emails imported, skipped as duplicates, and threads created
+    """
+    message_ids = [email["message_id"] for email in emails]
+    stored = set(
+        db.session.execute(
+            select(Email.message_id).where(Email.message_id.in_(message_ids))
+        ).scalars()
+    )
+    emails = [email for email in emails if email["message_id"] not in stored]
+
+    parents = {parent for email in emails for parent in email["parents"]}
+    threads: dict[str, int | Thread] = dict(
+        db.session.execute(  # type: ignore
+            select(Email.message_id, Email.thread_id).where(
+                Email.message_id.in_(parents)
+            )
+        ).all()
+    )
+    new_threads = []
+    for email in emails:
+        thread = next(
+            (threads[parent] for parent in email["parents"] if parent in threads),
+            None,
+        )
+        if thread is None:
+            thread = Thread()
+            new_threads.append(thread)
+        threads[email["message_id"]] = thread
+    db.session.add_all(new_threads)
+    db.session.flush()
+
+    rows = []
+    for email in emails:
+        thread = threads[email["message_id"]]
+        thread_id = thread.id if isinstance(thread, Thread) else thread
+        columns = {key: value for key, value in email.items() if key != "parents"}
+        rows.append({**columns, "thread_id": thread_id})
+    imported = 0
+    if rows:
+        thread_ids = list({row["thread_id"] for row in rows})
+        imported = len(
+            db.session.execute(
+                insert(Email)
+                .on_conflict_do_nothing(index_elements=[Email.message_id])
+                .returning(Email.id),
+                rows,
+            ).all()
+        )
+        db.session.execute(UPDATE_THREADS, {"thread_ids": thread_ids})
+        if imported_threads is not None:
+            imported_threads.update(thread_ids)
+    db.session.commit()
+    # drop the stored objects, so the session doesn't grow with the mailbox
+    db.session.expunge_all()
+    return {
+        "imported": imported,
+        "duplicates": len(message_ids) - imported,
+        "threads": len(new_threads),
+    }
+
+
+def import_mailbox(
+    messages: Iterable[bytes],
+    batch_size: int = IMPORT_BATCH_SIZE,
+    imported_threads: set[int] | None = None,
+) -> dict[str, int]:
+    """Import a mailbox in batches.
+
+    Args:
+        messages: raw messages, parents before their replies where possible
+        batch_size: number of emails stored at once
+        imported_threads: set the ids of the threads emails were imported into are
+            added to
+
+    Returns:
+        number of emails imported, skipped as duplicates or unreadable, and threads
+        created
+    """
+    counts = {"imported": 0, "duplicates": 0, "unreadable": 0, "threads": 0}
+    batch: dict[str, ImportedEmail] = {}
+
+    def flush():
+        for key, value in import_batch(list(batch.values()), imported_threads).items():
+            counts[key] += value
+        custom_log("imported", counts["imported"], "emails")
+        batch.clear()
+
+    for raw in messages:
+        try:
+            email = parse_message(raw)
+        except Exception as e:
+            custom_log("can't read message:", e, level=logging.WARNING)
+            counts["unreadable"] += 1
+            continue
+        if email["message_id"] in batch:
+            counts["duplicates"] += 1
+            continue
+        batch[email["message_id"]] = email
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return counts
+
+
+def enqueue_drafts(thread_ids: Iterable[int]) -> int:
+    """Enqueue response jobs for the given threads that are waiting for one.
+
+    Only unresolved threads whose newest email has no response are enqueued, and
+    emails whose job is already queued or running are skipped. Responses are
+    generated by the job queue workers.
+
+    Args:
+        thread_ids: ids of the threads, e.g. the ones emails were imported into
+
+    Returns:
+        number of jobs enqueued
+    """
+    thread_ids = list(thread_ids)
+    count = 0
+    for start in range(0, len(thread_ids), IMPORT_BATCH_SIZE):
+        email_ids = db.session.execute(
+            select(Email.id)
+            .join(Thread, Thread.last_email == Email.id)
+            .outerjoin(Response, Response.email_id == Email.id)
+            .where(
+                and_(
+                    Thread.id.in_(thread_ids[start : start + IMPORT_BATCH_SIZE]),
+                    Thread.resolved.is_(False),
+                    Response.id.is_(None),
+                )
+            )
+        ).scalars()
+        count += sum(job_queue.enqueue(email_id) for email_id in email_ids)
+    return count
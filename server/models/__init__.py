@@ -4,5 +4,6 @@
 
 from server.models.document import Document
 from server.models.email import Email
+from server.models.embedding_cache import EmbeddingCache
 from server.models.response import Response
 from server.models.thread import Thread
@@ -7,6 +7,7 @@ from sqlalchemy import ForeignKey
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from server import db
+from server.nlp.quote_stripper import strip_quotes
 
 if TYPE_CHECKING:
     from server.models.response import Response
@@ -24,11 +25,13 @@ class Email(db.Model):
         sender (str): The sender of the email.
         subject (str): The subject of the email.
         body (str): The body of the email.
-        message_id (str): The message ID of the email.
+        message_id (str): The message ID of the email, unique across emails.
         response (Optional[Response]): AI response to the email.
         is_reply (bool): Whether the email is a reply to another email.
         thread_id (int): The ID of the thread the email belongs to.
         thread (Thread): The thread the email belongs to.
+        stripped_body (Optional[str]): The body of the email without its quoted
+            history and signature, which is sent to OpenAI.
     """
 
     __tablename__ = "email"
@@ -38,7 +41,7 @@ class Email(db.Model):
     sender: Mapped[str] = mapped_column(nullable=False)
     subject: Mapped[str] = mapped_column(nullable=False)
     body: Mapped[str] = mapped_column(nullable=False)
-    message_id: Mapped[str] = mapped_column(nullable=False)
+    message_id: Mapped[str] = mapped_column(nullable=False, unique=True, index=True)
 
     response: Mapped[Optional["Response"]] = relationship(
         "Response",
@@ -57,6 +60,18 @@ class Email(db.Model):
         "Thread", back_populates="emails", init=False
     )
 
+    stripped_body: Mapped[Optional[str]] = mapped_column(default=None)
+
+    @property
+    def prompt_body(self) -> str:
+        """Body of the email to send to OpenAI.
+
+        Emails stored before bodies were stripped at ingestion are stripped here.
+        """
+        if self.stripped_body is None:
+            return strip_quotes(self.body)
+        return self.stripped_body
+
     def map(self):
         """Map the email to a dictionary."""
         return {
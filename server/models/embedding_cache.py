@@ -0,0 +1,25 @@
+"""Embedding cache."""
+
+from sqlalchemy import LargeBinary
+from sqlalchemy.orm import Mapped, mapped_column
+
+from server import db
+
+
+class EmbeddingCache(db.Model):
+    """Embedding cache.
+
+    Table for caching document embeddings, so that unchanged documents don't need to
+    be re-embedded when the vector index is rebuilt.
+
+    Attributes:
+        key (str): Hash of the embedding model and the embedded text.
+        model (str): The embedding model.
+        embedding (bytes): The embedding, packed as float32.
+    """
+
+    __tablename__ = "embedding_cache"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    model: Mapped[str] = mapped_column(nullable=False)
+    embedding: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
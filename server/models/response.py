@@ -2,7 +2,7 @@
 
 from typing import TYPE_CHECKING, List
 
-from sqlalchemy import ForeignKey, Integer, Text, UniqueConstraint
+from sqlalchemy import ForeignKey, Integer, Text, UniqueConstraint, false
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.types import Numeric
@@ -30,6 +30,8 @@ class Response(db.Model):
         confidence (float): The confidence of the response.
         email_id (str): The ID of the original email.
         email (Email): The original email.
+        fast_path (bool): Whether the response was assembled from documents without
+            OpenAI.
     """
 
     __tablename__ = "response"
@@ -52,6 +54,9 @@ class Response(db.Model):
     email: Mapped["Email"] = relationship(
         "Email", back_populates="response", init=False, single_parent=True
     )
+    fast_path: Mapped[bool] = mapped_column(
+        nullable=False, default=False, server_default=false()
+    )
 
     def map(self):
         """Map the response to a dictionary.
@@ -77,4 +82,5 @@ class Response(db.Model):
             "documents": docs,
             "confidence": self.confidence,
             "emailId": self.email_id,
+            "fastPath": self.fast_path,
         }
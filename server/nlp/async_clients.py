@@ -0,0 +1,118 @@
+"""Async clients.
+
+This module runs coroutines on a background event loop shared by the whole process,
+so synchronous Flask routes can use the async OpenAI and redis clients. The clients
+are created on that loop and reused, so their connection pools persist across
+requests. The async OpenAI client lives in server.nlp.openai_client.
+"""
+
+import asyncio
+import threading
+from typing import AsyncIterator, Coroutine, Iterator, TypeVar
+
+import redis.asyncio
+
+from server import redis_client
+
+assert redis_client is not None
+
+T = TypeVar("T")
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+_redis_client: redis.asyncio.Redis | None = None
+_redis_binary_client: redis.asyncio.Redis | None = None
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    """Get the background event loop, starting it on first use.
+
+    Returns:
+        event loop running on a daemon thread
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever, name="nlp-event-loop", daemon=True
+            )
+            thread.start()
+            _loop = loop
+    return _loop
+
+
+def run(coroutine: Coroutine[object, object, T]) -> T:
+    """Run a coroutine on the background event loop, blocking until it is done.
+
+    Args:
+        coroutine: coroutine to run
+
+    Returns:
+        result of the coroutine
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, event_loop()).result()
+
+
+def iterate(iterator: AsyncIterator[T]) -> Iterator[T]:
+    """Iterate over an async iterator on the background event loop.
+
+    Each item is awaited on the background event loop and yielded as soon as it
+    arrives. Closing the returned iterator closes the async iterator.
+
+    Args:
+        iterator: async iterator to iterate over
+
+    Yields:
+        items of the async iterator
+    """
+    done = object()
+
+    async def next_item():
+        try:
+            return await iterator.__anext__()
+        except StopAsyncIteration:
+            return done
+
+    try:
+        while (item := run(next_item())) is not done:
+            yield item  # type: ignore
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            run(aclose())
+
+
+def async_redis_client() -> redis.asyncio.Redis:
+    """Get the async redis client of the background event loop.
+
+    Only call this from coroutines running on the background event loop.
+
+    Returns:
+        async redis client, connected to the same server as redis_client
+    """
+    global _redis_client
+    if _redis_client is None:
+        kwargs = redis_client.connection_pool.connection_kwargs
+        _redis_client = redis.asyncio.Redis(
+            host=kwargs["host"], port=kwargs["port"], decode_responses=True
+        )
+    return _redis_client
+
+
+def async_redis_binary_client() -> redis.asyncio.Redis:
+    """Get the async redis client for raw bytes of the background event loop.
+
+    Only call this from coroutines running on the background event loop.
+
+    Returns:
+        async redis client that doesn't decode responses, connected to the same server
+        as redis_client
+    """
+    global _redis_binary_client
+    if _redis_binary_client is None:
+        kwargs = redis_client.connection_pool.connection_kwargs
+        _redis_binary_client = redis.asyncio.Redis(
+            host=kwargs["host"], port=kwargs["port"]
+        )
+    return _redis_binary_client
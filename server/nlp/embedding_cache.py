@@ -0,0 +1,245 @@
+"""Embedding cache.
+
+This module caches document embeddings in postgres, keyed by a hash of the embedding
+model and the embedded text, so that they survive redis being flushed.
+
+Embeddings of incoming questions are cached in redis instead, shared by all workers.
+That cache is bounded: entries expire after QUERY_EMBEDDING_CACHE_TTL, and the least
+recently used entries are evicted beyond QUERY_EMBEDDING_CACHE_SIZE.
+"""
+
+import hashlib
+import logging
+import time
+from typing import cast
+
+import numpy as np
+from sqlalchemy import CursorResult, delete, func, literal, select
+from sqlalchemy.dialects.postgresql import insert
+
+from server import db, redis_binary_client, redis_client
+from server.config import QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL
+from server.models.document import Document
+from server.models.embedding_cache import EmbeddingCache
+from server.nlp.metrics import increment
+from server.utils import custom_log
+
+assert redis_client is not None
+assert redis_binary_client is not None
+
+query_cache_prefix = "query_embeddings:"
+# sorted set of cached query keys, scored by when they were last used
+query_cache_lru_key = "query_embeddings:lru"
+
+
+def embedding_key(model: str, text: str) -> str:
+    """Compute the cache key for an embedding.
+
+    Args:
+        model: embedding model
+        text: embedded text
+
+    Returns:
+        hex digest identifying the embedding
+    """
+    return hashlib.sha256(f"{model}\n{text}".encode()).hexdigest()
+
+
+def document_text(question: str, content: str) -> str:
+    """Text that is embedded for a document.
+
+    Args:
+        question: document question
+        content: document content
+
+    Returns:
+        text to embed
+    """
+    return question + " " + content
+
+
+def get_cached_embeddings(keys: list[str]) -> dict[str, list[float]]:
+    """Look up embeddings in the cache.
+
+    Args:
+        keys: list of cache keys
+
+    Returns:
+        dictionary mapping each cached key to its embedding. keys that aren't cached
+        are left out.
+    """
+    if not keys:
+        return {}
+    rows = db.session.execute(
+        select(EmbeddingCache).where(EmbeddingCache.key.in_(keys))
+    ).scalars()
+    return {
+        row.key: np.frombuffer(row.embedding, dtype=np.float32).tolist() for row in rows
+    }
+
+
+def cache_embeddings(model: str, keys: list[str], embeddings: list[list[float]]):
+    """Store embeddings in the cache.
+
+    The embeddings are flushed, and committed by the caller.
+
+    Args:
+        model: embedding model
+        keys: list of cache keys
+        embeddings: list of embeddings, one per key
+    """
+    if not keys:
+        return
+    rows = [
+        {
+            "key": key,
+            "model": model,
+            "embedding": np.array(embedding, dtype=np.float32).tobytes(),
+        }
+        for key, embedding in zip(keys, embeddings)
+    ]
+    db.session.execute(
+        insert(EmbeddingCache)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=["key"])
+    )
+    db.session.flush()
+
+
+def record_lookups(hits: int, misses: int, stats: dict[str, int] | None = None):
+    """Update the cache hit and miss counters.
+
+    Args:
+        hits: number of cache hits
+        misses: number of cache misses
+        stats: hits and misses of the caller, which are added to
+    """
+    if stats is not None:
+        stats["hits"] = stats.get("hits", 0) + hits
+        stats["misses"] = stats.get("misses", 0) + misses
+    increment("document_embedding_cache_hits", hits)
+    increment("document_embedding_cache_misses", misses)
+    custom_log("embedding cache hits", hits, "misses", misses, level=logging.DEBUG)
+
+
+def evict_unreferenced_embeddings(model: str) -> int:
+    """Delete cached embeddings that no live document references anymore.
+
+    The keys of live documents are computed in postgres, like embedding_key does, so
+    the cache is anti-joined with the documents without loading either of them. The
+    deletion is flushed, and committed by the caller.
+
+    Args:
+        model: embedding model used for live documents
+
+    Returns:
+        number of evicted embeddings
+    """
+    live_key = func.encode(
+        func.sha256(
+            func.convert_to(
+                literal(f"{model}\n") + Document.question + " " + Document.content,
+                "UTF8",
+            )
+        ),
+        "hex",
+    )
+    referenced = (
+        select(Document.id)
+        .where(Document.to_delete.is_(False), live_key == EmbeddingCache.key)
+        .exists()
+    )
+    result = db.session.execute(
+        delete(EmbeddingCache).where(~referenced),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.flush()
+    evicted = cast(CursorResult, result).rowcount
+    custom_log("evicted", evicted, "unreferenced embeddings")
+    return evicted
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question, so that trivially different questions share a cache entry.
+
+    Args:
+        question: question text
+
+    Returns:
+        casefolded question with collapsed whitespace
+    """
+    return " ".join(question.casefold().split())
+
+
+def get_cached_query_embeddings(model: str, texts: list[str]) -> dict[str, list[float]]:
+    """Look up query embeddings in the cache, marking hits as recently used.
+
+    Hits get a fresh TTL, so an entry expires QUERY_EMBEDDING_CACHE_TTL after it was
+    last used, like its score in the LRU set says.
+
+    Args:
+        model: embedding model
+        texts: list of normalized questions
+
+    Returns:
+        dictionary mapping each cached text to its embedding. texts that aren't cached
+        are left out.
+    """
+    if not texts:
+        return {}
+    keys = [embedding_key(model, text) for text in texts]
+    values = redis_binary_client.mget([query_cache_prefix + key for key in keys])
+
+    now = time.time()
+    hits = {}
+    used = {}
+    for text, key, value in zip(texts, keys, values):  # type: ignore
+        if value is not None:
+            hits[text] = np.frombuffer(value, dtype=np.float32).tolist()
+            used[key] = now
+    if used:
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.zadd(query_cache_lru_key, used)
+        for key in used:
+            pipeline.expire(query_cache_prefix + key, QUERY_EMBEDDING_CACHE_TTL)
+        pipeline.execute()
+    return hits
+
+
+def cache_query_embeddings(model: str, texts: list[str], embeddings: list[list[float]]):
+    """Store query embeddings in the cache, evicting the least recently used entries.
+
+    Args:
+        model: embedding model
+        texts: list of normalized questions
+        embeddings: list of embeddings, one per text
+    """
+    if not texts:
+        return
+    now = time.time()
+    keys = [embedding_key(model, text) for text in texts]
+
+    pipeline = redis_binary_client.pipeline(transaction=False)
+    for key, embedding in zip(keys, embeddings):
+        pipeline.set(
+            query_cache_prefix + key,
+            np.asarray(embedding, dtype=np.float32).tobytes(),
+            ex=QUERY_EMBEDDING_CACHE_TTL,
+        )
+    pipeline.zadd(query_cache_lru_key, {key: now for key in keys})
+    # entries unused for longer than the TTL have expired already
+    pipeline.zremrangebyscore(
+        query_cache_lru_key, "-inf", now - QUERY_EMBEDDING_CACHE_TTL
+    )
+    pipeline.zcard(query_cache_lru_key)
+    size = pipeline.execute()[-1]
+
+    if size > QUERY_EMBEDDING_CACHE_SIZE:
+        evicted = cast(
+            list[tuple[str, float]],
+            redis_client.zpopmin(
+                query_cache_lru_key, size - QUERY_EMBEDDING_CACHE_SIZE
+            ),
+        )
+        redis_client.unlink(*[query_cache_prefix + key for key, _ in evicted])
+        increment("query_embedding_cache_evictions", len(evicted))
@@ -1,23 +1,56 @@
 """Embeddings.
 
-This module provides functions for embedding documents and querying them in Redis.
+This module provides functions for embedding documents and querying them in the
+vector store.
 """
 
+import asyncio
+import logging
 import os
 import time
-
-import numpy as np
-import openai
-from redis.commands.search.field import (
-    NumericField,
-    TextField,
-    VectorField,
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import String, func, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from server import db, redis_client
+from server.config import (
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_TOKENS,
+    EMBEDDING_MAX_CONCURRENCY,
+    MMR_FETCH_FACTOR,
+    MMR_LAMBDA,
+    RETRIEVAL_MODE,
+    VECTOR_DIMENSION,
+    VECTOR_STORE,
+    RedisDocument,
+)
+from server.models.document import Document
+from server.nlp.embedding_cache import (
+    cache_embeddings,
+    cache_query_embeddings,
+    document_text,
+    embedding_key,
+    evict_unreferenced_embeddings,
+    get_cached_embeddings,
+    get_cached_query_embeddings,
+    normalize_question,
+    record_lookups,
+)
+from server.nlp.metrics import aincrement, increment
+from server.nlp.openai_client import (
+    aopenai_request,
+    async_openai_client,
+    openai_client,
+    openai_request,
+)
+from server.nlp.response_cache import bump_corpus_version
+from server.nlp.vector_store import (
+    NumpyVectorStore,
+    RedisVectorStore,
+    VectorStore,
+    rerank_mmr,
 )
-from redis.commands.search.indexDefinition import IndexDefinition, IndexType
-from redis.commands.search.query import Query
-
-from server import redis_client
-from server.config import VECTOR_DIMENSION, RedisDocument
 from server.utils import custom_log
 
 assert redis_client is not None
@@ -25,208 +58,423 @@ assert redis_client is not None
 cwd = os.path.dirname(__file__)
 
 embedding_model = "text-embedding-3-small"
+embedding_model_dimension = 1536
+# shortened embeddings are cached separately from full ones
+cache_model = (
+    embedding_model
+    if embedding_model_dimension == VECTOR_DIMENSION
+    else f"{embedding_model}@{VECTOR_DIMENSION}"
+)
 
 
-def load_corpus(corpus: list[RedisDocument]):
-    """Loads given corpus into redis.
+def document_to_redis(document: Document) -> RedisDocument:
+    """Convert a document into the dictionary stored in redis.
 
     Args:
-        corpus: list of documents, each represented by dictionary
+        document: postgres document
 
-    Raises:
-        exception: if failed to load corpus into redis
+    Returns:
+        document represented by dictionary
+    """
+    return {
+        "question": document.question,
+        "source": document.source,
+        "content": document.content,
+        "sql_id": document.id,  # type: ignore
+    }
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text.
+
+    Uses the rule of thumb of roughly four characters per token, which is close enough
+    for packing requests.
+
+    Args:
+        text: text to estimate
+
+    Returns:
+        estimated number of tokens
+    """
+    return len(text) // 4 + 1
+
+
+def batch_texts(
+    texts: list[str],
+    max_items: int = EMBEDDING_BATCH_SIZE,
+    max_tokens: int = EMBEDDING_BATCH_TOKENS,
+) -> list[list[int]]:
+    """Pack texts into batches capped by item count and estimated token count.
+
+    A single text that exceeds max_tokens on its own still gets a batch of its own.
+
+    Args:
+        texts: list of texts to batch
+        max_items: maximum number of texts per batch
+        max_tokens: maximum number of estimated tokens per batch
+
+    Returns:
+        list of batches, each a list of indices into texts
     """
-    custom_log("loading corpus...")
+    batches: list[list[int]] = []
+    batch: list[int] = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _embed_batch(
+    texts: list[str], dimensions: int = VECTOR_DIMENSION
+) -> list[list[float]]:
+    """Embed a single batch of texts with one OpenAI request.
 
-    pipeline = redis_client.pipeline()
-    for i, doc in enumerate(corpus, start=1):
-        redis_key = f"documents:{i:03}"
-        pipeline.json().set(redis_key, "$", doc)
-    res = pipeline.execute()
+    Args:
+        texts: list of texts to embed
+        dimensions: dimension of the embeddings
 
-    if not all(res):
-        raise Exception("failed to load some documents")
-    custom_log("successfully loaded all documents")
+    Returns:
+        list of embeddings, in the same order as texts
+    """
+    response = openai_request(
+        openai_client().embeddings.create,
+        input=texts,
+        model=embedding_model,
+        dimensions=dimensions,
+        tokens=sum(estimate_tokens(text) for text in texts),
+    )
+    return [data.embedding for data in sorted(response.data, key=lambda d: d.index)]
 
 
-def compute_openai_embeddings(texts):
+def compute_openai_embeddings(
+    texts: list[str], dimensions: int = VECTOR_DIMENSION
+) -> list[list[float]]:
     """Compute embeddings from texts using OpenAI.
 
+    Texts are packed into batches, and up to EMBEDDING_MAX_CONCURRENCY batches are
+    requested at once.
+
     Args:
         texts: list of texts to embed
+        dimensions: dimension of the embeddings
 
     Returns:
-        list of embeddings
+        list of embeddings, in the same order as texts
     """
-    embeddings = []
-    for i in range(len(texts)):
-        embeddings.append(
-            openai.embeddings.create(input=texts[i], model=embedding_model)
-            .data[0]
-            .embedding
-        )
+    batches = batch_texts(texts)
+    batched_texts = [[texts[i] for i in batch] for batch in batches]
+
+    if len(batches) <= 1:
+        results = [_embed_batch(batch, dimensions) for batch in batched_texts]
+    else:
+        workers = min(EMBEDDING_MAX_CONCURRENCY, len(batches))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    _embed_batch, batched_texts, [dimensions] * len(batched_texts)
+                )
+            )
+
+    embeddings: list[list[float]] = [[] for _ in texts]
+    for batch, batch_embeddings in zip(batches, results):
+        for i, embedding in zip(batch, batch_embeddings):
+            embeddings[i] = embedding
     return embeddings
 
 
-def compute_embeddings():
-    """Compute embeddings from redis documents."""
-    custom_log("computing embeddings...")
+def compute_cached_embeddings(
+    texts: list[str], stats: dict[str, int] | None = None
+) -> list[list[float]]:
+    """Compute embeddings from texts, only calling OpenAI for uncached texts.
+
+    Args:
+        texts: list of texts to embed
+        stats: cache hits and misses of the texts are added to it
 
-    # get keys, questions, content
-    keys = sorted(redis_client.keys("documents:*"))  # type: ignore
-    questions = redis_client.json().mget(keys, "$.question")
-    content = redis_client.json().mget(keys, "$.content")
+    Returns:
+        list of embeddings, in the same order as texts
+    """
+    keys = [embedding_key(cache_model, text) for text in texts]
+    cached = get_cached_embeddings(list(set(keys)))
 
-    # compute embeddings
-    question_and_content = [
-        questions[i][0] + " " + content[i][0]  # type: ignore
-        for i in range(len(questions))  # type: ignore
-    ]
+    # texts may repeat, so only embed each missing key once
+    missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+    record_lookups(len(texts) - len(missing), len(missing), stats)
+    if missing:
+        missing_keys = list(missing.keys())
+        computed = compute_openai_embeddings(list(missing.values()))
+        cache_embeddings(cache_model, missing_keys, computed)
+        cached.update(zip(missing_keys, computed))
 
-    embeddings = compute_openai_embeddings(question_and_content)
+    return [cached[key] for key in keys]
 
-    custom_log("successfully computed embeddings")
+
+async def _aembed_batch(
+    texts: list[str], dimensions: int = VECTOR_DIMENSION
+) -> list[list[float]]:
+    """Embed a single batch of texts with one async OpenAI request.
+
+    Args:
+        texts: list of texts to embed
+        dimensions: dimension of the embeddings
+
+    Returns:
+        list of embeddings, in the same order as texts
+    """
+    response = await aopenai_request(
+        async_openai_client().embeddings.create,
+        input=texts,
+        model=embedding_model,
+        dimensions=dimensions,
+        tokens=sum(estimate_tokens(text) for text in texts),
+    )
+    return [data.embedding for data in sorted(response.data, key=lambda d: d.index)]
+
+
+async def acompute_openai_embeddings(
+    texts: list[str], dimensions: int = VECTOR_DIMENSION
+) -> list[list[float]]:
+    """Compute embeddings from texts using the async OpenAI client.
+
+    Same as compute_openai_embeddings, with the batches requested concurrently on the
+    event loop.
+
+    Args:
+        texts: list of texts to embed
+        dimensions: dimension of the embeddings
+
+    Returns:
+        list of embeddings, in the same order as texts
+    """
+    batches = batch_texts(texts)
+    semaphore = asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+
+    async def embed(batch: list[int]) -> list[list[float]]:
+        async with semaphore:
+            return await _aembed_batch([texts[i] for i in batch], dimensions)
+
+    results = await asyncio.gather(*(embed(batch) for batch in batches))
+
+    embeddings: list[list[float]] = [[] for _ in texts]
+    for batch, batch_embeddings in zip(batches, results):
+        for i, embedding in zip(batch, batch_embeddings):
+            embeddings[i] = embedding
     return embeddings
 
 
-def load_embeddings(embeddings: list[list[float]]):
-    """Load embeddings into redis.
+def _lookup_query_embeddings(
+    questions: list[str],
+) -> tuple[list[str], dict[str, list[float]], list[str]]:
+    """Normalize questions and look them up in the query embedding cache.
 
     Args:
-        embeddings:
-            list of embeddings
+        questions: list of questions
 
-    Raises:
-        exception: if failed to load embeddings into redis
+    Returns:
+        (normalized questions,
+        dictionary mapping cached normalized questions to their embeddings,
+        distinct normalized questions that aren't cached)
     """
-    custom_log("loading embeddings into redis...")
+    texts = [normalize_question(question) for question in questions]
+    unique_texts = list(dict.fromkeys(texts))
+    cached = get_cached_query_embeddings(cache_model, unique_texts)
+
+    missing = [text for text in unique_texts if text not in cached]
+    increment("query_embedding_cache_hits", len(unique_texts) - len(missing))
+    increment("query_embedding_cache_misses", len(missing))
+    return texts, cached, missing
+
+
+def compute_query_embeddings(questions: list[str]) -> list[list[float]]:
+    """Compute embeddings for questions, only calling OpenAI for uncached questions.
 
-    # load embeddings into redis
-    pipeline = redis_client.pipeline()
-    for i, embedding in enumerate(embeddings, start=1):
-        redis_key = f"documents:{i:03}"
-        pipeline.json().set(redis_key, "$.question_and_content_embeddings", embedding)
-    res = pipeline.execute()
+    Questions are normalized before they are embedded, so questions that only differ
+    in case or whitespace share an embedding.
 
-    if not all(res):
-        raise Exception("failed to load embeddings")
+    Args:
+        questions: list of questions to embed
+
+    Returns:
+        list of embeddings, in the same order as questions
+    """
+    texts, cached, missing = _lookup_query_embeddings(questions)
+    if missing:
+        computed = compute_openai_embeddings(missing)
+        cache_query_embeddings(cache_model, missing, computed)
+        cached.update(zip(missing, computed))
 
-    custom_log("successfully loaded all embeddings")
+    return [cached[text] for text in texts]
 
 
-def create_index(corpus_len: int):
-    """Create search index in redis.
+async def acompute_query_embeddings(questions: list[str]) -> list[list[float]]:
+    """Compute embeddings for questions asynchronously.
 
-    Assumes that documents and embeddings have already been loaded into redis
+    Same as compute_query_embeddings. The cache is accessed in a worker thread, so the
+    event loop isn't blocked.
 
     Args:
-        corpus_len:
-            number of documents in corpus
+        questions: list of questions to embed
 
-    Raises:
-        exception: if failed to create index
+    Returns:
+        list of embeddings, in the same order as questions
     """
-    custom_log("creating index...")
-
-    schema = (
-        TextField("$.source", no_stem=True, as_name="source"),
-        TextField("$.question", no_stem=True, as_name="question"),
-        TextField("$.content", no_stem=True, as_name="content"),
-        NumericField("$.sql_id", as_name="sql_id"),
-        VectorField(
-            "$.question_and_content_embeddings",
-            "FLAT",
-            {
-                "TYPE": "FLOAT32",
-                "DIM": VECTOR_DIMENSION,
-                "DISTANCE_METRIC": "COSINE",
-            },
-            as_name="vector",
-        ),
-    )
-    definition = IndexDefinition(prefix=["documents:"], index_type=IndexType.JSON)
-    res = redis_client.ft("idx:documents_vss").create_index(
-        fields=schema, definition=definition
+    texts, cached, missing = await asyncio.to_thread(
+        _lookup_query_embeddings, questions
     )
+    if missing:
+        computed = await acompute_openai_embeddings(missing)
+        await asyncio.to_thread(cache_query_embeddings, cache_model, missing, computed)
+        cached.update(zip(missing, computed))
+
+    return [cached[text] for text in texts]
+
 
-    if res == "OK":
-        start = time.time()
-        while 1:
-            if str(redis_client.ft("idx:documents_vss").info()["num_docs"]) == str(
-                corpus_len
-            ):
-                info = redis_client.ft("idx:documents_vss").info()
-                num_docs = info["num_docs"]
-                indexing_failures = info["hash_indexing_failures"]
-                custom_log("num_docs", num_docs, "indexing_failures", indexing_failures)
-                return
-            if time.time() - start >= 60:
-                raise Exception("time out")
-    raise Exception("failed to create index")
-
-
-def create_query(k: int):
-    """Create k-NN redis query.
+def compute_embeddings(
+    corpus: list[RedisDocument], stats: dict[str, int] | None = None
+) -> list[list[float]]:
+    """Compute embeddings for documents.
 
     Args:
-        k: number of nearest neighbors to return
+        corpus: list of documents, each represented by dictionary
+        stats: cache hits and misses of the documents are added to it
 
     Returns:
-        redis query object
+        list of embeddings, one per document
     """
-    return (
-        Query(f"(*)=>[KNN {k} @vector $query_vector AS vector_score]")
-        .sort_by("vector_score")
-        .return_fields("vector_score", "source", "question", "content", "sql_id")
-        .dialect(2)
+    custom_log("computing embeddings...")
+
+    question_and_content = [
+        document_text(doc["question"], doc["content"]) for doc in corpus
+    ]
+    embeddings = compute_cached_embeddings(question_and_content, stats)
+
+    custom_log("successfully computed embeddings")
+    return embeddings
+
+
+def _load_live_corpus() -> tuple[list[RedisDocument], list[list[float]]]:
+    """Load all live documents and their embeddings from postgres."""
+    documents = (
+        db.session.execute(
+            select(Document).where(Document.to_delete.is_(False)).order_by(Document.id)
+        )
+        .scalars()
+        .all()
     )
+    corpus = [document_to_redis(document) for document in documents]
+    return corpus, compute_embeddings(corpus)
 
 
-def queries(query, queries: list[str]) -> list[dict]:
-    """Run queries against redis.
+def _reconcile_with_postgres(
+    loaded: dict[int, RedisDocument],
+) -> tuple[list[RedisDocument], list[list[float]], list[int]]:
+    """Find the live documents that differ from the ones loaded into the vector store.
 
     Args:
-        query: redis query object
-        queries: list of question queries
+        loaded: documents loaded into the vector store by sql_id
 
     Returns:
-        list of dictionaries containing query and result
+        (documents added or changed in postgres, their embeddings,
+        sql_ids of loaded documents that were deleted from postgres)
     """
-    custom_log("running queries...")
-
-    # encode queries
-    encoded_queries = compute_openai_embeddings(queries)
-
-    # run queries
-    results_list = []
-    for i, encoded_query in enumerate(encoded_queries):
-        result_docs = (
-            redis_client.ft("idx:documents_vss")
-            .search(
-                query,
-                {"query_vector": np.array(encoded_query, dtype=np.float32).tobytes()},
-            )
-            .docs  # type: ignore
+    documents = (
+        db.session.execute(
+            select(Document)
+            .where(Document.to_delete.is_(False))
+            .order_by(Document.id)
+            # other sessions may have edited documents this session already loaded
+            .execution_options(populate_existing=True)
         )
-        query_result = []
-        for doc in result_docs:
-            vector_score = round(1 - float(doc.vector_score), 2)
-            query_result.append(
-                {
-                    "score": vector_score,
-                    "source": doc.source,
-                    "question": doc.question,
-                    "content": doc.content,
-                    "sql_id": doc.sql_id,
-                }
-            )
-        results_list.append({"query": queries[i], "result": query_result})
+        .scalars()
+        .all()
+    )
+    live = {document.id: document_to_redis(document) for document in documents}
+    changed = [doc for sql_id, doc in live.items() if loaded.get(sql_id) != doc]
+    deleted = [sql_id for sql_id in loaded if sql_id not in live]
+    return changed, compute_embeddings(changed) if changed else [], deleted
+
+
+def _live_corpus_signature() -> tuple:
+    """Cheap signature of the live documents, computed by postgres.
+
+    Changes whenever a live document is added, removed or edited.
+    """
+    text_hash = func.md5(
+        Document.id.cast(String) + Document.question + Document.content
+    )
+    return tuple(
+        db.session.execute(
+            select(
+                func.count(Document.id),
+                func.md5(
+                    func.string_agg(text_hash, aggregate_order_by(",", Document.id))
+                ),
+            ).where(Document.to_delete.is_(False))
+        ).one()
+    )
+
+
+def create_vector_store(backend: str = VECTOR_STORE) -> VectorStore:
+    """Create the vector store for the configured backend.
+
+    Args:
+        backend: "redis" or "numpy"
+
+    Returns:
+        vector store
+
+    Raises:
+        exception: if the backend is not supported
+    """
+    if backend == "redis":
+        return RedisVectorStore()
+    if backend == "numpy":
+        return NumpyVectorStore(_load_live_corpus, _live_corpus_signature)
+    raise Exception(f"unsupported vector store {backend}")
 
-    custom_log("done running query")
-    return results_list
 
+vector_store = create_vector_store()
 
-def query_all(k: int, questions: list[str]):
+
+def upsert_documents(corpus: list[RedisDocument], invalidate_responses: bool = True):
+    """Add or replace documents in the vector store.
+
+    Only documents whose text changed since they were last embedded are re-embedded.
+
+    Args:
+        corpus: list of documents, each represented by dictionary
+        invalidate_responses: whether cached responses are invalidated. responses
+            generated without new documents are still valid, so this can be turned
+            off for documents made from the replies the team sends
+    """
+    if not corpus:
+        return
+    vector_store.upsert(corpus, compute_embeddings(corpus))
+    if invalidate_responses:
+        bump_corpus_version()
+
+
+def delete_documents(sql_ids: list[int]):
+    """Remove documents from the vector store.
+
+    Args:
+        sql_ids: ids of the documents in postgres
+    """
+    if not sql_ids:
+        return
+    vector_store.delete(sql_ids)
+    bump_corpus_version()
+
+
+def query_all(k: int, questions: list[str]) -> list[dict]:
     """Return k most similar documents for each query.
 
     Args:
@@ -236,28 +484,89 @@ def query_all(k: int, questions: list[str]):
     Returns:
         list of dictionaries containing query and result
     """
-    redis_query = create_query(k)
-    return queries(redis_query, questions)
+    custom_log("running queries...", level=logging.DEBUG)
+
+    # encode all uncached queries with a single embeddings request
+    encoded_queries = compute_query_embeddings(questions)
+    if RETRIEVAL_MODE == "hybrid":
+        results = vector_store.hybrid_search(encoded_queries, questions, k)
+    elif MMR_LAMBDA < 1:
+        candidates = vector_store.search_with_vectors(
+            encoded_queries, k * MMR_FETCH_FACTOR
+        )
+        start = time.perf_counter()
+        results = rerank_mmr(encoded_queries, candidates, k)
+        increment("mmr_queries", len(questions))
+        increment("mmr_us", round((time.perf_counter() - start) * 1e6))
+    else:
+        results = vector_store.search(encoded_queries, k)
+
+    custom_log("done running query", level=logging.DEBUG)
+    return [
+        {"query": question, "result": result}
+        for question, result in zip(questions, results)
+    ]
+
+
+async def aquery_all(
+    k: int,
+    questions: list[str],
+    encoded_queries: list[list[float]] | None = None,
+) -> list[dict]:
+    """Return k most similar documents for each query, asynchronously.
+
+    Args:
+        k: number of nearest neighbors to return
+        questions: list of question queries
+        encoded_queries: embeddings of the questions, if already computed
+
+    Returns:
+        list of dictionaries containing query and result
+    """
+    custom_log("running queries...", level=logging.DEBUG)
+
+    if encoded_queries is None:
+        encoded_queries = await acompute_query_embeddings(questions)
+    if RETRIEVAL_MODE == "hybrid":
+        results = await vector_store.ahybrid_search(encoded_queries, questions, k)
+    elif MMR_LAMBDA < 1:
+        candidates = await vector_store.asearch_with_vectors(
+            encoded_queries, k * MMR_FETCH_FACTOR
+        )
+        start = time.perf_counter()
+        results = rerank_mmr(encoded_queries, candidates, k)
+        await aincrement("mmr_queries", len(questions))
+        await aincrement("mmr_us", round((time.perf_counter() - start) * 1e6))
+    else:
+        results = await vector_store.asearch(encoded_queries, k)
+
+    custom_log("done running query", level=logging.DEBUG)
+    return [
+        {"query": question, "result": result}
+        for question, result in zip(questions, results)
+    ]
 
 
-def embed_corpus(corpus: list[RedisDocument]):
-    """Load corpus, compute embeddings, load embeddings into redis.
+def embed_corpus(corpus: list[RedisDocument]) -> dict[str, int]:
+    """Sync the vector store with the given corpus.
+
+    Documents in the corpus are upserted, and documents in the vector store that are
+    not in the corpus are removed. Documents uploaded, edited or deleted in postgres
+    while the corpus was embedded are reconciled before the new documents go live.
+    Changes to the embedding cache are flushed, and committed by the caller.
 
     Args:
         corpus: list of documents, each represented by dictionary
 
+    Returns:
+        embedding cache hits and misses of the corpus
+
     Raises:
         exception: if failed to load corpus
     """
-    # flush database
-    custom_log("cleaning database...")
-    redis_client.flushdb()
-    custom_log("done cleaning database")
-
-    # embed corpus
-    if not corpus:
-        return
-    load_corpus(corpus)
-    embeddings = compute_embeddings()
-    load_embeddings(embeddings)
-    create_index(len(corpus))
+    stats = {"hits": 0, "misses": 0}
+    embeddings = compute_embeddings(corpus, stats)
+    vector_store.sync(corpus, embeddings, _reconcile_with_postgres)
+    bump_corpus_version()
+    evict_unreferenced_embeddings(cache_model)
+    return stats
@@ -0,0 +1,75 @@
+"""Metrics.
+
+This module keeps counters in a redis hash, so they are shared by all workers and
+survive restarts.
+"""
+
+from typing import Awaitable, cast
+
+from server import redis_client
+from server.nlp.async_clients import async_redis_client
+
+assert redis_client is not None
+
+metrics_key = "metrics"
+
+
+def increment(name: str, amount: int = 1):
+    """Increment a counter.
+
+    Args:
+        name: name of the counter
+        amount: amount to increment by
+    """
+    if amount:
+        redis_client.hincrby(metrics_key, name, amount)
+
+
+async def aincrement(name: str, amount: int = 1):
+    """Increment a counter from a coroutine on the background event loop.
+
+    Args:
+        name: name of the counter
+        amount: amount to increment by
+    """
+    if amount:
+        # the stubs type commands of sync and async clients alike
+        await cast(
+            Awaitable[int], async_redis_client().hincrby(metrics_key, name, amount)
+        )
+
+
+def get_metrics() -> dict[str, int]:
+    """Get all counters.
+
+    Returns:
+        dictionary mapping counter names to their values
+    """
+    counters = redis_client.hgetall(metrics_key)
+    return {name: int(value) for name, value in counters.items()}  # type: ignore
+
+
+def ratio(numerator: int, denominator: int) -> float | None:
+    """Ratio of two counters.
+
+    Args:
+        numerator: counter to divide
+        denominator: counter to divide by
+
+    Returns:
+        ratio, or None if the denominator is 0
+    """
+    return round(numerator / denominator, 4) if denominator else None
+
+
+def hit_rate(hits: int, misses: int) -> float | None:
+    """Fraction of lookups that were hits.
+
+    Args:
+        hits: number of hits
+        misses: number of misses
+
+    Returns:
+        hit rate, or None if there were no lookups
+    """
+    return ratio(hits, hits + misses)
@@ -0,0 +1,413 @@
+"""OpenAI client.
+
+This module holds the clients all OpenAI requests are sent with: one sync and one async
+client per process, each with a pooled HTTP client. Requests are sent through
+openai_request or aopenai_request, which
+
+- wait until the request and token buckets shared by all workers in redis allow the
+  request,
+- send at most OPENAI_MAX_CONCURRENCY requests at once from each process, sync and
+  async requests alike, counting streams until they are closed, and
+- retry rate limited requests, connection errors and server errors with exponential
+  backoff and full jitter, waiting at least as long as the Retry-After header asks.
+
+The retries of the OpenAI library itself are disabled, so they can't multiply ours.
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, TypeVar, cast
+
+import httpx
+import openai
+from redis.exceptions import RedisError
+
+from server import redis_client
+from server.config import (
+    OPENAI_API_KEY,
+    OPENAI_BASE_URL,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_MAX_RETRIES,
+    OPENAI_REQUESTS_PER_MINUTE,
+    OPENAI_RETRY_BASE_SECONDS,
+    OPENAI_RETRY_MAX_SECONDS,
+    OPENAI_TIMEOUT_SECONDS,
+    OPENAI_TOKENS_PER_MINUTE,
+)
+from server.nlp.async_clients import async_redis_client
+from server.nlp.metrics import aincrement, increment
+from server.utils import custom_log
+
+assert redis_client is not None
+
+openai.api_key = OPENAI_API_KEY
+
+T = TypeVar("T")
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+bucket_keys = ["openai:rate_limit:requests", "openai:rate_limit:tokens"]
+
+# takes a (capacity per minute, amount) pair of arguments for each bucket key. refills
+# the buckets for the time since they were last used, and takes the amounts out of all
+# of them if they all hold enough. returns how many seconds to wait otherwise. amounts
+# larger than a whole bucket only wait for the bucket to be full
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local wait = 0
+local levels = {}
+local amounts = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local amount = math.min(tonumber(ARGV[2 * i]), capacity)
+    local bucket = redis.call("HMGET", key, "level", "time")
+    local level = tonumber(bucket[1]) or capacity
+    local last = tonumber(bucket[2]) or now
+    levels[i] = math.min(capacity, level + math.max(now - last, 0) * capacity / 60)
+    amounts[i] = amount
+    wait = math.max(wait, (amount - levels[i]) * 60 / capacity)
+end
+for i, key in ipairs(KEYS) do
+    if wait <= 0 then
+        levels[i] = levels[i] - amounts[i]
+    end
+    redis.call("HSET", key, "level", tostring(levels[i]), "time", tostring(now))
+    redis.call("EXPIRE", key, 120)
+end
+return tostring(wait)
+"""
+
+_bucket_script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+_async_bucket_script = None
+
+_client_lock = threading.Lock()
+_client: openai.OpenAI | None = None
+_async_client: openai.AsyncOpenAI | None = None
+# shared by the sync and async clients, so they don't get a limit each
+_semaphore = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+# seconds between attempts of coroutines to take a slot, at most
+SLOT_POLL_MAX_SECONDS = 0.05
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=OPENAI_MAX_CONCURRENCY,
+        max_keepalive_connections=OPENAI_MAX_CONCURRENCY,
+    )
+
+
+def create_openai_client(base_url: str | None = OPENAI_BASE_URL) -> openai.OpenAI:
+    """Create a sync OpenAI client with a pooled HTTP client.
+
+    Args:
+        base_url: URL of the OpenAI API, or None for the default
+
+    Returns:
+        OpenAI client, without retries of its own
+    """
+    return openai.OpenAI(
+        api_key=openai.api_key,
+        base_url=base_url,
+        max_retries=0,
+        http_client=httpx.Client(limits=_limits(), timeout=OPENAI_TIMEOUT_SECONDS),
+    )
+
+
+def create_async_openai_client(
+    base_url: str | None = OPENAI_BASE_URL,
+) -> openai.AsyncOpenAI:
+    """Create an async OpenAI client with a pooled HTTP client.
+
+    Args:
+        base_url: URL of the OpenAI API, or None for the default
+
+    Returns:
+        async OpenAI client, without retries of its own
+    """
+    return openai.AsyncOpenAI(
+        api_key=openai.api_key,
+        base_url=base_url,
+        max_retries=0,
+        http_client=httpx.AsyncClient(limits=_limits(), timeout=OPENAI_TIMEOUT_SECONDS),
+    )
+
+
+def openai_client() -> openai.OpenAI:
+    """Get the sync OpenAI client of this process.
+
+    Returns:
+        OpenAI client
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = create_openai_client()
+    return _client
+
+
+def async_openai_client() -> openai.AsyncOpenAI:
+    """Get the async OpenAI client of the background event loop.
+
+    Only call this from coroutines running on the background event loop.
+
+    Returns:
+        async OpenAI client
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = create_async_openai_client()
+    return _async_client
+
+
+def _bucket_args(tokens: int) -> list[int]:
+    return [OPENAI_REQUESTS_PER_MINUTE, 1, OPENAI_TOKENS_PER_MINUTE, tokens]
+
+
+def reserve(tokens: int) -> float:
+    """Take a request and tokens out of the rate limit buckets, if they allow it.
+
+    Args:
+        tokens: estimated number of tokens of the request
+
+    Returns:
+        0 if the request can be sent, otherwise seconds to wait before trying again
+    """
+    wait = cast(str, _bucket_script(keys=bucket_keys, args=_bucket_args(tokens)))
+    return float(wait)
+
+
+async def areserve(tokens: int) -> float:
+    """Take a request and tokens out of the rate limit buckets, if they allow it.
+
+    Args:
+        tokens: estimated number of tokens of the request
+
+    Returns:
+        0 if the request can be sent, otherwise seconds to wait before trying again
+    """
+    global _async_bucket_script
+    if _async_bucket_script is None:
+        _async_bucket_script = async_redis_client().register_script(TOKEN_BUCKET_SCRIPT)
+    wait = await _async_bucket_script(keys=bucket_keys, args=_bucket_args(tokens))
+    return float(wait)
+
+
+def throttle(tokens: int):
+    """Wait until the rate limits allow a request.
+
+    Requests are let through if the rate limiter is unavailable.
+
+    Args:
+        tokens: estimated number of tokens of the request
+    """
+    while True:
+        try:
+            wait = reserve(tokens)
+        except RedisError as e:
+            custom_log("openai rate limiter unavailable:", e, level=logging.WARNING)
+            return
+        if wait <= 0:
+            return
+        increment("openai_throttled_ms", round(wait * 1000))
+        time.sleep(wait)
+
+
+async def athrottle(tokens: int):
+    """Wait until the rate limits allow a request.
+
+    Requests are let through if the rate limiter is unavailable.
+
+    Args:
+        tokens: estimated number of tokens of the request
+    """
+    while True:
+        try:
+            wait = await areserve(tokens)
+        except RedisError as e:
+            custom_log("openai rate limiter unavailable:", e, level=logging.WARNING)
+            return
+        if wait <= 0:
+            return
+        await aincrement("openai_throttled_ms", round(wait * 1000))
+        await asyncio.sleep(wait)
+
+
+async def aacquire_slot():
+    """Wait until a request can be sent without exceeding OPENAI_MAX_CONCURRENCY.
+
+    The semaphore is shared with threads, so it is polled instead of blocking the
+    event loop.
+    """
+    delay = 0.001
+    while not _semaphore.acquire(blocking=False):
+        await asyncio.sleep(delay)
+        delay = min(2 * delay, SLOT_POLL_MAX_SECONDS)
+
+
+class HeldStream:
+    """Stream of a streaming request, which holds its slot until it is closed.
+
+    The slot is released once the stream is consumed, fails, or is closed.
+    """
+
+    def __init__(self, stream: Any):
+        """Wrap a stream whose request holds a slot.
+
+        Args:
+            stream: stream returned by the async OpenAI client
+        """
+        self._stream = stream
+        self._released = False
+
+    def __aiter__(self) -> AsyncIterator[Any]:
+        """Iterate over the chunks of the stream, closing it at the end."""
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[Any]:
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Close the stream and release its slot."""
+        if self._released:
+            return
+        self._released = True
+        try:
+            # streams of the OpenAI client close their HTTP response
+            close = getattr(self._stream, "close", None)
+            if close is not None:
+                await close()
+        finally:
+            _semaphore.release()
+
+
+def backoff(attempt: int, error: Exception) -> float:
+    """Compute how long to wait before retrying a failed request.
+
+    Args:
+        attempt: number of the failed attempt, starting at 0
+        error: error the attempt failed with
+
+    Returns:
+        seconds to wait
+    """
+    cap = min(OPENAI_RETRY_MAX_SECONDS, OPENAI_RETRY_BASE_SECONDS * 2**attempt)
+    delay = random.uniform(0, cap)
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            retry_after = float(response.headers.get("retry-after", 0))
+        except ValueError:
+            retry_after = 0
+        delay = max(delay, min(retry_after, OPENAI_RETRY_MAX_SECONDS))
+    return delay
+
+
+def openai_request(
+    create: Callable[..., T],
+    *args: Any,
+    tokens: int = 1,
+    label: str | None = None,
+    **kwargs,
+) -> T:
+    """Send a request to OpenAI within the rate limits, retrying transient errors.
+
+    Args:
+        create: method of the OpenAI client that sends the request
+        *args: positional arguments of the method
+        tokens: estimated number of tokens of the request
+        label: kind of request, to count its retries separately as well
+        **kwargs: keyword arguments of the method
+
+    Returns:
+        response of the request. streams aren't held, so send streaming requests
+        with aopenai_request
+    """
+    attempt = 0
+    while True:
+        throttle(tokens)
+        with _semaphore:
+            try:
+                return create(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= OPENAI_MAX_RETRIES:
+                    raise
+                delay = backoff(attempt, e)
+                custom_log(
+                    "openai request failed:",
+                    e,
+                    "retrying in",
+                    delay,
+                    level=logging.WARNING,
+                )
+        attempt += 1
+        increment("openai_retries")
+        if label is not None:
+            increment(f"openai_retries_{label}")
+        time.sleep(delay)
+
+
+async def aopenai_request(
+    create: Callable[..., Awaitable[T]],
+    *args: Any,
+    tokens: int = 1,
+    label: str | None = None,
+    **kwargs,
+) -> T:
+    """Send a request to OpenAI within the rate limits, retrying transient errors.
+
+    Only call this from coroutines running on the background event loop.
+
+    Args:
+        create: method of the async OpenAI client that sends the request
+        *args: positional arguments of the method
+        tokens: estimated number of tokens of the request
+        label: kind of request, to count its retries separately as well
+        **kwargs: keyword arguments of the method
+
+    Returns:
+        response of the request. streams of streaming requests are wrapped in a
+        HeldStream, and have to be consumed or closed to free their slot
+    """
+    attempt = 0
+    while True:
+        await athrottle(tokens)
+        await aacquire_slot()
+        try:
+            response = await create(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            _semaphore.release()
+            if attempt >= OPENAI_MAX_RETRIES:
+                raise
+            delay = backoff(attempt, e)
+            custom_log(
+                "openai request failed:",
+                e,
+                "retrying in",
+                delay,
+                level=logging.WARNING,
+            )
+        except BaseException:
+            _semaphore.release()
+            raise
+        else:
+            if kwargs.get("stream"):
+                return HeldStream(response)  # type: ignore
+            _semaphore.release()
+            return response
+        attempt += 1
+        await aincrement("openai_retries")
+        if label is not None:
+            await aincrement(f"openai_retries_{label}")
+        await asyncio.sleep(delay)
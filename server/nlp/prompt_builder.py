@@ -0,0 +1,190 @@
+"""Prompt builder.
+
+This module assembles the messages that ask OpenAI for a response within a token
+budget. Context documents retrieved for several questions are only included once, and
+the highest-scoring documents and the newest messages of the thread are kept first.
+
+Tokens are counted with tiktoken. When its encoding can't be loaded, e.g. without
+network access to download it, tokens are estimated from the text length instead.
+"""
+
+import logging
+from functools import cache
+
+from server.config import (
+    PROMPT_CONTEXT_SHARE,
+    PROMPT_TOKEN_BUDGET,
+    OpenAIMessage,
+    RedisDocument,
+)
+from server.nlp.embeddings import estimate_tokens
+from server.utils import custom_log
+
+ENCODING_MODEL = "gpt-4o"
+# tokens OpenAI adds around every message for its role and separators
+MESSAGE_OVERHEAD = 4
+
+CONTEXT_HEADER = "Here is some context to help you answer this email: \n"
+
+
+@cache
+def _encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.encoding_for_model(ENCODING_MODEL)
+    except Exception as e:
+        custom_log(
+            "tiktoken unavailable, estimating token counts instead:",
+            e,
+            level=logging.WARNING,
+        )
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Count the number of tokens in a text.
+
+    Args:
+        text: text to count
+
+    Returns:
+        number of tokens
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(message: OpenAIMessage) -> int:
+    """Count the number of tokens a message takes up in a prompt.
+
+    Args:
+        message: OpenAI message
+
+    Returns:
+        number of tokens
+    """
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+
+def email_message(email: str) -> OpenAIMessage:
+    """Build the message holding the newest email.
+
+    Args:
+        email: newest incoming hacker email
+
+    Returns:
+        OpenAI message
+    """
+    return {"role": "user", "content": "EMAIL FROM USER: \n\n" + email}
+
+
+def context_messages(documents: list[RedisDocument]) -> list[OpenAIMessage]:
+    """Build the messages holding the context documents.
+
+    Args:
+        documents: context documents
+
+    Returns:
+        list of OpenAI messages
+    """
+    message = CONTEXT_HEADER
+    for doc in documents:
+        message += doc["question"] + " " + doc["content"] + "\n"
+    return [
+        {"role": "user", "content": message},
+        {"role": "assistant", "content": "understood."},
+    ]
+
+
+def dedup_documents(docs: dict[str, list[RedisDocument]]) -> list[RedisDocument]:
+    """Merge the documents retrieved for all questions.
+
+    Args:
+        docs: dictionary mapping each question to its context documents
+
+    Returns:
+        documents retrieved for any question, once each with their highest score,
+        from highest to lowest score
+    """
+    unique: dict[str, RedisDocument] = {}
+    for documents in docs.values():
+        for doc in documents:
+            seen = unique.get(doc["sql_id"])
+            if seen is None or float(doc["score"]) > float(seen["score"]):
+                unique[doc["sql_id"]] = doc
+    return sorted(unique.values(), key=lambda doc: float(doc["score"]), reverse=True)
+
+
+def build_prompt(
+    thread: list[OpenAIMessage],
+    email: str,
+    docs: dict[str, list[RedisDocument]],
+    budget: int = PROMPT_TOKEN_BUDGET,
+) -> tuple[list[OpenAIMessage], int, int]:
+    """Build the thread of messages to answer an email with, within a token budget.
+
+    The newest email is always included. Context documents get up to
+    PROMPT_CONTEXT_SHARE of the remaining budget, and earlier messages of the thread
+    get whatever the documents leave over. Documents that don't fit are skipped in
+    favor of smaller ones with lower scores, while the thread is cut off at the
+    newest message that doesn't fit, so it stays contiguous.
+
+    Args:
+        thread: previous email thread
+        email: newest incoming hacker email
+        docs: dictionary mapping each question to its context documents
+        budget: maximum number of tokens for the thread, email and context
+
+    Returns:
+        (messages for the thread, email and context,
+        number of tokens without deduplication or trimming,
+        number of tokens in the returned messages)
+    """
+    newest = email_message(email)
+    remaining = budget - message_tokens(newest)
+
+    documents = dedup_documents(docs)
+    header_tokens = sum(message_tokens(m) for m in context_messages([]))
+    context_budget = int(remaining * PROMPT_CONTEXT_SHARE) - header_tokens
+    selected = []
+    for doc in documents:
+        tokens = count_tokens(doc["question"] + " " + doc["content"] + "\n")
+        if tokens <= context_budget:
+            selected.append(doc)
+            context_budget -= tokens
+    context = context_messages(selected)
+    remaining -= sum(message_tokens(message) for message in context)
+
+    history: list[OpenAIMessage] = []
+    for message in reversed(thread):
+        tokens = message_tokens(message)
+        if tokens > remaining:
+            break
+        history.insert(0, message)
+        remaining -= tokens
+
+    messages = history + [newest] + context
+    untrimmed = (
+        thread
+        + [newest]
+        + context_messages([doc for documents in docs.values() for doc in documents])
+    )
+    tokens_before = sum(message_tokens(message) for message in untrimmed)
+    tokens_after = sum(message_tokens(message) for message in messages)
+    if len(history) < len(thread) or len(selected) < len(documents):
+        custom_log(
+            "prompt trimmed to",
+            len(history),
+            "of",
+            len(thread),
+            "thread messages and",
+            len(selected),
+            "of",
+            len(documents),
+            "documents",
+            level=logging.DEBUG,
+        )
+    return messages, tokens_before, tokens_after
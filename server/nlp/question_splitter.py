@@ -0,0 +1,157 @@
+"""Question splitter.
+
+This module splits emails into questions locally, without calling OpenAI. It handles
+the common shapes of emails: a single question, numbered or bulleted lists of
+questions, and several sentences ending in question marks. Greetings and signatures
+are stripped first, but text after a sign-off that asks something is kept.
+
+Every split comes with a confidence. Emails the splitter is unsure about, e.g.
+requests or questions phrased without question marks, or follow-ups that depend on
+the rest of the email, get a low confidence, and should be parsed by OpenAI instead.
+"""
+
+import re
+
+GREETING = re.compile(
+    r"^\s*(hi|hello|hey|dear|greetings|good (morning|afternoon|evening))\b[^\n]{0,40}$",
+    re.IGNORECASE,
+)
+SIGN_OFF = re.compile(
+    r"^\s*(--\s*|(best|warm|kind)?\s*(regards|wishes)|best|thanks|thank you|"
+    r"thanks (so much|again|in advance)|many thanks|cheers|sincerely|"
+    r"sent from my \w+)[\s,.!]*$",
+    re.IGNORECASE,
+)
+LIST_ITEM = re.compile(r"^\s*(?:\d{1,2}[.)]|[-*•])\s+(\S.*)$")
+SENTENCE_END = re.compile(r"(?<=[.?!])\s+")
+# phrasings of questions that don't end in a question mark
+IMPLICIT_QUESTION = re.compile(
+    r"\b(wondering|wonder if|let me know|let us know|want to know|would like to know|"
+    r"need to know|can you|could you|would you|please (tell|confirm|advise|send|"
+    r"explain|clarify)|i need|is it possible)\b",
+    re.IGNORECASE,
+)
+INTERROGATIVE = re.compile(
+    r"^(who|what|when|where|why|how|which|is|are|am|was|were|do|does|did|can|could|"
+    r"will|would|should|shall|may|might|have|has)\b",
+    re.IGNORECASE,
+)
+# follow-ups like "what about it?" only make sense with the rest of the email
+FOLLOW_UP = re.compile(r"^(and|also|or|so|what about|how about)\b", re.IGNORECASE)
+PRONOUN = re.compile(r"\b(it|that|this|those|them|they)\b", re.IGNORECASE)
+
+# emails longer than this are left to OpenAI
+MAX_LOCAL_LENGTH = 1500
+# lines after a sign-off with more words than this aren't part of the signature
+SIGNATURE_MAX_WORDS = 6
+
+
+def _is_signature(lines: list[str]) -> bool:
+    """Whether the lines after a sign-off are only a signature."""
+    return not any(
+        "?" in line
+        or IMPLICIT_QUESTION.search(line)
+        or len(line.split()) > SIGNATURE_MAX_WORDS
+        for line in lines
+    )
+
+
+def strip_greeting_and_signature(email: str) -> str:
+    """Remove the greeting line and everything from the last sign-off on.
+
+    The sign-off is kept if anything substantive follows it, e.g. a question added
+    after "Thanks!".
+
+    Args:
+        email: email body
+
+    Returns:
+        email body without greeting and signature
+    """
+    lines = email.strip().splitlines()
+    if lines and GREETING.match(lines[0]):
+        lines = lines[1:]
+    for i in range(len(lines) - 1, -1, -1):
+        if SIGN_OFF.match(lines[i]):
+            if _is_signature(lines[i + 1 :]):
+                lines = lines[:i]
+            break
+    return "\n".join(lines).strip()
+
+
+def _is_question(text: str) -> bool:
+    return text.endswith("?") or bool(INTERROGATIVE.match(text))
+
+
+def _is_dependent(question: str) -> bool:
+    """Whether a question refers to something outside of it."""
+    if FOLLOW_UP.match(question):
+        return True
+    return len(question.split()) <= 4 and bool(PRONOUN.search(question))
+
+
+def _split_list(lines: list[str]) -> tuple[list[str], float] | None:
+    """Split an email that is a numbered or bulleted list."""
+    items = []
+    other = []
+    for line in lines:
+        match = LIST_ITEM.match(line)
+        if match:
+            items.append(match.group(1).strip())
+        elif line.strip():
+            other.append(line.strip())
+    if len(items) < 2:
+        return None
+
+    confidence = 0.9 if all(_is_question(item) for item in items) else 0.6
+    # questions outside the list would be lost
+    if any("?" in line or IMPLICIT_QUESTION.search(line) for line in other):
+        confidence = min(confidence, 0.4)
+    return items, confidence
+
+
+def _split_sentences(body: str) -> tuple[list[str], float]:
+    """Split an email into the sentences that end in question marks."""
+    sentences = [
+        sentence.strip()
+        for sentence in SENTENCE_END.split(" ".join(body.split()))
+        if sentence.strip()
+    ]
+    questions = [sentence for sentence in sentences if sentence.endswith("?")]
+    statements = [sentence for sentence in sentences if not sentence.endswith("?")]
+    # questions without a question mark, e.g. "What time is it.", would be lost
+    implicit = any(
+        IMPLICIT_QUESTION.search(sentence) or INTERROGATIVE.match(sentence)
+        for sentence in statements
+    )
+
+    if not questions:
+        # emails without questions are answered as a whole
+        return [body], 0.3 if implicit else 0.8
+    if implicit:
+        return questions, 0.4
+    if any(_is_dependent(question) for question in questions):
+        return questions, 0.5
+    return questions, 0.9 if len(questions) == 1 else 0.8
+
+
+def split_questions(email: str) -> tuple[list[str], float]:
+    """Split an email into questions.
+
+    Args:
+        email: email body
+
+    Returns:
+        (list of questions parsed from the email,
+        confidence between 0 and 1 that the split matches what OpenAI would return)
+    """
+    body = strip_greeting_and_signature(email)
+    if not body:
+        return [email], 0.0
+    if len(body) > MAX_LOCAL_LENGTH:
+        return [body], 0.0
+
+    split = _split_list(body.splitlines())
+    if split is not None:
+        return split
+    return _split_sentences(body)
@@ -0,0 +1,123 @@
+"""Quote stripper.
+
+This module strips the quoted replies and signatures that email clients add below the
+text of an email. Emails are stripped when they are stored, and the stripped copy is
+kept next to the body as received, so the quoted history isn't sent to OpenAI again
+with every later email of the thread, while organizers still see the whole email. It
+handles
+
+- reply headers of Gmail and Apple Mail ("On ... wrote:"), also in a few other
+  languages and wrapped over two lines,
+- Outlook separators, "From: ... Sent: ..." header blocks, and original and forwarded
+  message markers,
+- blocks of lines quoted with ">" at the end of an email, while quotes that are
+  answered inline are kept for context, and
+- short signatures below a "--" line, mobile footers like "Sent from my iPhone", and
+  short signature blocks below a sign-off, keeping the sign-off and the name under it.
+
+Everything from the first reply header or separator on is dropped. The patterns are
+combined into a single precompiled expression, so an email is only scanned once for
+them. Text that may have been written by the sender, like a P.S. or a question below
+a sign-off, is kept.
+"""
+
+import re
+
+from server.nlp.question_splitter import SIGN_OFF
+
+# first line of the quoted history or signature of an email
+CUT = re.compile(
+    "|".join(
+        [
+            # outlook separator
+            r"^_{10,}[ \t]*$",
+            r"^-{2,}[ \t]*(original|forwarded|reply) message[ \t]*-{2,}",
+            r"^begin forwarded message:",
+            # outlook header block
+            r"^\*?(from|von|de|da)\*?:[^\n]*\n\*?(sent|date|gesendet|envoyé|enviado|"
+            r"inviato|datum)\*?:",
+            # gmail and apple mail header, which gmail wraps if it is too long
+            r"^(on|le|am|el|il)\b[^\n]{0,200}(\n[^\n]{0,200})?\b(wrote|a écrit|"
+            r"schrieb|escribió|ha scritto)[ \t]*:[ \t]*$",
+            # mobile footers
+            r"^(sent from my|sent from (outlook|yahoo mail|mail) for|"
+            r"get outlook for)\b",
+        ]
+    ),
+    re.IGNORECASE | re.MULTILINE,
+)
+SIGNATURE_DELIMITER = re.compile(r"^--[ \t]*$")
+POSTSCRIPT = re.compile(r"^\s*p\.?(p\.?)?s\b", re.IGNORECASE)
+BLANK_LINES = re.compile(r"\n[ \t]*(?:\n[ \t]*)+\n")
+
+# blocks below a sign-off or "--" line are only dropped as signatures if they are at
+# most this many lines
+SIGNATURE_MAX_LINES = 6
+SIGNATURE_MAX_LINE_LENGTH = 80
+
+
+def is_signature(block: list[str]) -> bool:
+    """Check if a block of lines looks like a signature.
+
+    Args:
+        block: lines below a sign-off or "--" line
+
+    Returns:
+        whether the block is short, and doesn't ask anything or add a P.S.
+    """
+    block = [line for line in block if line.strip()]
+    return (
+        bool(block)
+        and len(block) <= SIGNATURE_MAX_LINES
+        and all(len(line) <= SIGNATURE_MAX_LINE_LENGTH for line in block)
+        and not any("?" in line or POSTSCRIPT.match(line) for line in block)
+    )
+
+
+def is_name(line: str) -> bool:
+    """Check if the line below a sign-off looks like the name of the sender."""
+    return bool(line.strip()) and len(line.split()) <= 4 and line[-1] not in ".!?:"
+
+
+def strip_signature(lines: list[str]) -> list[str]:
+    """Drop the signature block at the end of an email.
+
+    Blocks below the last "--" line are dropped. Blocks below the last sign-off are
+    dropped if a name follows the sign-off, and the sign-off and the name are kept.
+    Blocks that don't look like signatures are kept.
+
+    Args:
+        lines: lines of the email
+
+    Returns:
+        lines of the email, without the signature block
+    """
+    for i in range(len(lines) - 1, -1, -1):
+        if SIGNATURE_DELIMITER.match(lines[i]):
+            return lines[:i] if is_signature(lines[i + 1 :]) else lines
+        if SIGN_OFF.match(lines[i]):
+            name = lines[i + 1] if i + 1 < len(lines) else ""
+            if is_name(name) and is_signature(lines[i + 2 :]):
+                return lines[: i + 2]
+            return lines
+    return lines
+
+
+def strip_quotes(body: str) -> str:
+    """Strip the quoted replies and signature of an email.
+
+    Args:
+        body: body of the email
+
+    Returns:
+        text written by the sender, or the whole body if nothing else is left
+    """
+    match = CUT.search(body)
+    text = body[: match.start()] if match else body
+    lines = [line.rstrip() for line in text.strip().splitlines()]
+    # quotes followed by text of the sender are answers inline, and are kept
+    while lines and (not lines[-1].strip() or lines[-1].lstrip().startswith(">")):
+        lines.pop()
+    text = "\n".join(strip_signature(lines))
+    text = BLANK_LINES.sub("\n\n", text).strip()
+    return text or body.strip()
@@ -0,0 +1,232 @@
+"""Response cache.
+
+This module caches generated responses in redis, keyed by the embedding of the email
+they answer, so near-duplicate emails can reuse a response instead of generating a
+new one. Entries are searched with a RediSearch vector index, and only match emails
+that are at least RESPONSE_CACHE_MIN_SIMILARITY similar.
+
+Every entry records the corpus version it was generated against. The version is
+bumped whenever documents are added, changed or deleted by organizers, which
+invalidates all entries generated before. Documents made from the replies the team
+sends don't bump it, so the cache isn't emptied by every reply. Entries also expire
+after RESPONSE_CACHE_TTL.
+"""
+
+import json
+import logging
+import re
+import uuid
+from email.utils import parseaddr
+from typing import cast
+
+import numpy as np
+from redis.commands.search.field import NumericField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from redis.commands.search.result import Result
+from redis.exceptions import RedisError, ResponseError
+
+from server import redis_client
+from server.config import (
+    RESPONSE_CACHE_MIN_SIMILARITY,
+    RESPONSE_CACHE_TTL,
+    VECTOR_DIMENSION,
+    RedisDocument,
+)
+from server.nlp.async_clients import async_redis_client
+from server.nlp.metrics import aincrement
+from server.nlp.question_splitter import SIGN_OFF
+from server.utils import custom_log
+
+assert redis_client is not None
+
+index_name = "idx:response_cache"
+prefix = "response_cache:"
+corpus_version_key = "corpus_version"
+
+GREETING_LINE = re.compile(r"^\s*(dear|hi|hello|hey)\b[^\n,]*,", re.IGNORECASE)
+NAME = re.compile(r"^[A-Z][a-zA-Z'-]+$")
+
+CachedResponse = tuple[str, dict[str, list[RedisDocument]], float]
+
+_index_ready = False
+
+
+def bump_corpus_version():
+    """Invalidate cached responses, since the documents changed."""
+    redis_client.incr(corpus_version_key)
+
+
+async def _ensure_index():
+    """Create the response cache index if it doesn't exist yet."""
+    global _index_ready
+    if _index_ready:
+        return
+    client = async_redis_client()
+    try:
+        await client.ft(index_name).info()
+        _index_ready = True
+        return
+    except ResponseError:
+        pass
+    # the response, documents and confidence are returned but not indexed
+    schema = (
+        NumericField("corpus_version"),
+        VectorField(
+            "vector",
+            "FLAT",
+            {"TYPE": "FLOAT32", "DIM": VECTOR_DIMENSION, "DISTANCE_METRIC": "COSINE"},
+        ),
+    )
+    definition = IndexDefinition(prefix=[prefix], index_type=IndexType.HASH)
+    try:
+        await client.ft(index_name).create_index(fields=schema, definition=definition)
+    except ResponseError as e:
+        # another worker created the index in the meantime
+        if "already exists" not in str(e):
+            raise
+    _index_ready = True
+
+
+async def corpus_version() -> int:
+    """Get the current corpus version.
+
+    Returns:
+        corpus version
+    """
+    version = await async_redis_client().get(corpus_version_key)
+    return int(version) if version is not None else 0
+
+
+async def aget_cached_response(
+    embedding: list[float], version: int
+) -> CachedResponse | None:
+    """Find a cached response to a similar email.
+
+    Args:
+        embedding: embedding of the email
+        version: current corpus version
+
+    Returns:
+        (email response, documents, confidence) of the most similar cached email, or
+        None if no cached email is similar enough
+    """
+    await _ensure_index()
+    query = (
+        Query(
+            f"(@corpus_version:[{version} {version}])"
+            "=>[KNN 1 @vector $query_vector AS distance]"
+        )
+        .sort_by("distance")
+        .return_fields("distance", "response", "documents", "confidence")
+        .dialect(2)
+    )
+    # the stubs of search don't allow bytes values, which vectors are passed as
+    params: dict = {"query_vector": np.asarray(embedding, dtype=np.float32).tobytes()}
+    result = cast(
+        Result,
+        await async_redis_client().ft(index_name).search(query, params),
+    )
+
+    for doc in result.docs:
+        similarity = 1 - float(doc.distance)
+        if similarity >= RESPONSE_CACHE_MIN_SIMILARITY:
+            custom_log(
+                "response cache hit with similarity",
+                round(similarity, 4),
+                level=logging.DEBUG,
+            )
+            await aincrement("response_cache_hits")
+            return doc.response, json.loads(doc.documents), float(doc.confidence)
+    await aincrement("response_cache_misses")
+    return None
+
+
+async def acache_response(
+    embedding: list[float],
+    version: int,
+    response: str,
+    documents: dict[str, list[RedisDocument]],
+    confidence: float,
+):
+    """Cache a response to an email.
+
+    The response was already paid for, so failing to cache it is only logged.
+
+    Args:
+        embedding: embedding of the email
+        version: corpus version the response was generated against
+        response: email response
+        documents: dictionary mapping each question to its context documents
+        confidence: confidence of the response
+    """
+    key = f"{prefix}{uuid.uuid4().hex}"
+    pipeline = async_redis_client().pipeline(transaction=True)
+    pipeline.hset(
+        key,
+        mapping={
+            "corpus_version": version,
+            "response": response,
+            "documents": json.dumps(documents),
+            "confidence": float(confidence),
+            "vector": np.asarray(embedding, dtype=np.float32).tobytes(),
+        },
+    )
+    pipeline.expire(key, RESPONSE_CACHE_TTL)
+    try:
+        await pipeline.execute()
+    except RedisError as e:
+        custom_log("failed to cache response:", e, level=logging.WARNING)
+
+
+def sender_first_name(sender: str, email: str) -> str | None:
+    """Guess the first name of the sender of an email.
+
+    Uses the display name of the sender, or the name signed under the sign-off.
+
+    Args:
+        sender: sender of the email, e.g. "Alex Smith <alex@example.com>"
+        email: email body
+
+    Returns:
+        first name, or None if it can't be guessed
+    """
+    display_name, _ = parseaddr(sender)
+    if display_name.split():
+        return display_name.split()[0]
+
+    lines = [line.strip() for line in email.strip().splitlines()]
+    for i, line in enumerate(lines[:-1]):
+        if SIGN_OFF.match(line):
+            names = lines[i + 1].split()
+            if 0 < len(names) <= 3 and NAME.match(names[0]):
+                return names[0]
+    return None
+
+
+def greeting(sender: str, email: str) -> str:
+    """Greeting line of a response to an email.
+
+    Args:
+        sender: sender of the email
+        email: body of the email
+
+    Returns:
+        greeting line, addressing the sender by first name if it can be guessed
+    """
+    name = sender_first_name(sender, email)
+    return f"Dear {name}," if name else "Hi there,"
+
+
+def personalize_greeting(response: str, sender: str, email: str) -> str:
+    """Replace the greeting of a cached response with one for a new sender.
+
+    Args:
+        response: cached email response
+        sender: sender of the new email
+        email: body of the new email
+
+    Returns:
+        response greeting the new sender
+    """
+    return GREETING_LINE.sub(greeting(sender, email), response, count=1)
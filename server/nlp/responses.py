@@ -1,33 +1,102 @@
 """Responses.
 
 This module is used to generate responses to incoming emails using OpenAI.
+
+Responses are generated by an async pipeline on the async OpenAI and redis clients.
+The synchronous functions run it on the background event loop, for Flask routes.
 """
 
-import ast
-from typing import cast
+import asyncio
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Iterator, cast
 
 import numpy as np
-import openai
 from openai.types.chat import ChatCompletionMessageParam
-
-from server.config import OPENAI_API_KEY, OpenAIMessage, RedisDocument
-from server.nlp.embeddings import query_all
+from redis.exceptions import RedisError
+
+from server.config import (
+    FAST_PATH_ENABLED,
+    FAST_PATH_MIN_CONFIDENCE,
+    QUESTION_SPLITTER_MIN_CONFIDENCE,
+    RESPONSE_CACHE_ENABLED,
+    TEAM_REPLY_SOURCE,
+    OpenAIMessage,
+    RedisDocument,
+)
+from server.nlp.async_clients import iterate, run
+from server.nlp.embeddings import acompute_query_embeddings, aquery_all
+from server.nlp.metrics import aincrement
+from server.nlp.openai_client import aopenai_request, async_openai_client
+from server.nlp.prompt_builder import build_prompt, message_tokens
+from server.nlp.question_splitter import split_questions
+from server.nlp.response_cache import (
+    acache_response,
+    aget_cached_response,
+    corpus_version,
+    greeting,
+    personalize_greeting,
+)
 from server.utils import custom_log
 
-openai.api_key = OPENAI_API_KEY
-
 MODEL = "gpt-4o"
 
+FOOTER = "Best regards,\nThe HackMIT Team"
+
+# structured output format of parsed questions. the top level of a schema must be an
+# object, so the list is wrapped in one
+QUESTIONS_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "questions",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "questions": {"type": "array", "items": {"type": "string"}},
+            },
+            "required": ["questions"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+async def acreate_chat_completion(
+    messages: list[ChatCompletionMessageParam], **kwargs
+) -> Any:
+    """Send a chat completion request to OpenAI, within the rate limits.
+
+    Args:
+        messages: list of messages
+        **kwargs: other arguments of the request, e.g. stream, and of
+            aopenai_request, e.g. label
+
+    Returns:
+        chat completion, or a stream of chunks if streaming
+    """
+    tokens = sum(message_tokens(cast(OpenAIMessage, message)) for message in messages)
+    return await aopenai_request(
+        async_openai_client().chat.completions.create,
+        model=MODEL,
+        messages=messages,
+        tokens=tokens,
+        **kwargs,
+    )
 
-def openai_response(thread: list[OpenAIMessage], sender: str) -> str:
-    """Generate a response from OpenAI.
+
+def response_messages(
+    thread: list[OpenAIMessage], sender: str
+) -> list[ChatCompletionMessageParam]:
+    """Build the messages that ask OpenAI for a response.
 
     Args:
         thread: previous email thread
         sender: hacker email address
 
     Returns:
-        email response generated by
+        list of messages
     """
     messages = [
         {
@@ -61,9 +130,22 @@ def openai_response(thread: list[OpenAIMessage], sender: str) -> str:
         }
     ]
 
-    custom_log("query:", messages)
-    messages = cast(list[ChatCompletionMessageParam], messages)
-    response = openai.chat.completions.create(model=MODEL, messages=messages)
+    custom_log("query:", messages, level=logging.DEBUG)
+    return cast(list[ChatCompletionMessageParam], messages)
+
+
+async def aopenai_response(thread: list[OpenAIMessage], sender: str) -> str:
+    """Generate a response from OpenAI.
+
+    Args:
+        thread: previous email thread
+        sender: hacker email address
+
+    Returns:
+        email response generated by
+    """
+    messages = response_messages(thread, sender)
+    response = await acreate_chat_completion(messages)
 
     if response.choices[0].message.content is None:
         return "openai unknown error"
@@ -71,9 +153,72 @@ def openai_response(thread: list[OpenAIMessage], sender: str) -> str:
     return response.choices[0].message.content
 
 
-def openai_parse(email: str) -> list[str]:
+async def astream_openai_response(
+    thread: list[OpenAIMessage], sender: str
+) -> AsyncIterator[str]:
+    """Generate a response from OpenAI, streaming it as it is generated.
+
+    Args:
+        thread: previous email thread
+        sender: hacker email address
+
+    Yields:
+        pieces of the email response, in order
+    """
+    stream = await acreate_chat_completion(
+        response_messages(thread, sender), stream=True
+    )
+    try:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        # the stream holds a concurrency slot until it is closed, even if the
+        # response is abandoned halfway
+        await stream.close()
+
+
+def openai_response(thread: list[OpenAIMessage], sender: str) -> str:
+    """Generate a response from OpenAI.
+
+    Args:
+        thread: previous email thread
+        sender: hacker email address
+
+    Returns:
+        email response generated by
+    """
+    return run(aopenai_response(thread, sender))
+
+
+def parse_questions(content: str | None) -> list[str] | None:
+    """Validate the questions OpenAI parsed from an email.
+
+    Args:
+        content: content of the OpenAI response, a JSON object with a list of
+            questions
+
+    Returns:
+        list of questions, or None if the response has no questions
+    """
+    try:
+        data = json.loads(content or "")
+    except json.JSONDecodeError:
+        return None
+    questions = data.get("questions") if isinstance(data, dict) else None
+    if not isinstance(questions, list):
+        return None
+    questions = [q.strip() for q in questions if isinstance(q, str) and q.strip()]
+    return questions or None
+
+
+async def aopenai_parse(email: str) -> list[str]:
     """Parse an email into questions using OpenAI.
 
+    The response is constrained to a JSON schema, so it is always a list of strings.
+    Requests are only retried on API errors, and responses without questions fall
+    back to the whole email.
+
     Args:
         email: hacker email
 
@@ -84,70 +229,43 @@ def openai_parse(email: str) -> list[str]:
         {
             "role": "system",
             "content": "You are an organizer for HackMIT. Please parse incoming "
-            "emails from participants into a python list of separate questions. "
-            "Return a list of questions in the format of a python list. For "
+            "emails from participants into a list of separate questions. For "
             "example, given the following email: 'What is the best way to get "
             "started? What is HackMIT?', the list of questions would be ['What is "
-            "the best way to get started?', 'What is HackMIT?'], and you should then "
-            "format your response with only the python list: ['What is the best way "
-            "to get started?', 'What is HackMIT?']. If there are no questions in the "
-            "email, just return the whole email as a single element list. Do not "
-            "return an empty list. ",
+            "the best way to get started?', 'What is HackMIT?']. If there are no "
+            "questions in the email, just return the whole email as a single element "
+            "list. Do not return an empty list. ",
         },
         {"role": "user", "content": email},
     ]
-    response = openai.chat.completions.create(
-        model=MODEL,
-        messages=cast(list[ChatCompletionMessageParam], messages),
+    response = await acreate_chat_completion(
+        cast(list[ChatCompletionMessageParam], messages),
+        response_format=QUESTIONS_FORMAT,
+        label="parse",
     )
-    attempts = 0
-    while attempts < 3:
-        try:
-            questions = ast.literal_eval(cast(str, response.choices[0].message.content))
-            assert isinstance(questions, list)
-            assert len(questions) > 0
-            return questions
-        except Exception as e:
-            attempts += 1
-            custom_log(
-                "open ai failed to parse email after",
-                attempts,
-                "attempts. attempted response:",
-                response.choices[0].message.content,
-                "resulting in error:",
-                e,
-                "trying again...",
-            )
-            messages.append(
-                {
-                    "role": "assistant",
-                    "content": response.choices[0].message.content
-                    if response.choices[0].message.content is not None
-                    else "",
-                }
-            )
-            messages.append(
-                {
-                    "role": "user",
-                    "content": "your answer is not formatted as a python list, or "
-                    "is empty. please format your answer with only the python list. "
-                    "do not include any markdown formatting or any explanation. just "
-                    "a parseable python list that I can directly parse with the "
-                    "python ast library. for reference once more, here is the email: "
-                    f"{email}",
-                }
-            )
-            custom_log("query:", messages)
-            response = openai.chat.completions.create(
-                model=MODEL,
-                messages=cast(list[ChatCompletionMessageParam], messages),
-            )
-
-    custom_log(
-        "open ai failed to parse email after three attempts. "
-        "returning entire email as a single question instead.",
-    )
-    return [email]
+    questions = parse_questions(response.choices[0].message.content)
+    if questions is None:
+        custom_log(
+            "open ai returned no questions:",
+            response.choices[0].message.content,
+            "returning entire email as a single question instead.",
+            level=logging.WARNING,
+        )
+        await aincrement("parse_llm_invalid")
+        return [email]
+    return questions
+
+
+def openai_parse(email: str) -> list[str]:
+    """Parse an email into questions using OpenAI.
+
+    Args:
+        email: hacker email
+
+    Returns:
+        list of questions parsed from the email
+    """
+    return run(aopenai_parse(email))
 
 
 def confidence_metric(confidences: list[float]) -> float:
@@ -159,68 +277,258 @@ def confidence_metric(confidences: list[float]) -> float:
     Returns:
         confidence metric
     """
-    custom_log("confidences", confidences)
+    custom_log("confidences", confidences, level=logging.DEBUG)
     return np.min(np.array(confidences))
 
 
-def generate_context(
+async def agenerate_context(
     email: str,
-) -> tuple[list[OpenAIMessage], dict[str, list[RedisDocument]], float]:
+) -> tuple[dict[str, list[RedisDocument]], float]:
     """Generate email context.
 
+    The email is split into questions locally, and only parsed by OpenAI when the
+    local splitter isn't confident. In that case, the whole email is embedded while
+    it is being parsed. Emails without questions are parsed into the whole email, in
+    which case that embedding is used for the search right away.
+
     Args:
         email: hacker email
 
     Returns:
-        (list of contexts for all questions in email,
-        dictionary mapping each question to list of context documents used to
+        (dictionary mapping each question to list of context documents used to
         answer question,
         confidence metric for all documents)
     """
-    questions = openai_parse(email)
+    await aincrement("parse_requests")
+    questions, split_confidence = split_questions(email)
+    if split_confidence >= QUESTION_SPLITTER_MIN_CONFIDENCE:
+        results = await aquery_all(5, questions)
+    else:
+        custom_log(
+            "local split confidence",
+            split_confidence,
+            "parsing with openai",
+            level=logging.DEBUG,
+        )
+        email_embedding = asyncio.create_task(acompute_query_embeddings([email]))
+        start = time.perf_counter()
+        questions = await aopenai_parse(email)
+        await aincrement("parse_llm_calls")
+        await aincrement("parse_llm_ms", round((time.perf_counter() - start) * 1000))
+        if questions == [email]:
+            results = await aquery_all(5, questions, await email_embedding)
+        else:
+            email_embedding.cancel()
+            results = await aquery_all(5, questions)
+
     confidences = []
-    contexts = []
     docs = {}
 
-    results = query_all(5, questions)
-    message = "Here is some context to help you answer this email: \n"
     for result in results:
         confidence = 0
         docs[result["query"]] = []
         for doc in result["result"]:
             confidence = max(confidence, doc["score"])
-            message += doc["question"] + " " + doc["content"] + "\n"
             docs[result["query"]].append(doc)
         confidences.append(confidence)
 
-    contexts.append({"role": "user", "content": message})
-    contexts.append({"role": "assistant", "content": "understood."})
-    return contexts, docs, confidence_metric(confidences)
+    return docs, confidence_metric(confidences)
 
 
-def generate_response(
+def generate_context(
+    email: str,
+) -> tuple[dict[str, list[RedisDocument]], float]:
+    """Generate email context.
+
+    Args:
+        email: hacker email
+
+    Returns:
+        same as agenerate_context
+    """
+    return run(agenerate_context(email))
+
+
+async def abuild_prompt(
+    thread: list[OpenAIMessage], email: str, docs: dict[str, list[RedisDocument]]
+) -> list[OpenAIMessage]:
+    """Build the thread to answer an email with, and record its token counts.
+
+    Args:
+        thread: previous email thread
+        email: newest incoming hacker email
+        docs: dictionary mapping each question to list of context documents
+
+    Returns:
+        messages for the thread, email and context
+    """
+    messages, tokens_before, tokens_after = build_prompt(thread, email, docs)
+    await aincrement("prompts")
+    await aincrement("prompt_tokens_before", tokens_before)
+    await aincrement("prompt_tokens_after", tokens_after)
+    return messages
+
+
+def best_documents(docs: dict[str, list[RedisDocument]]) -> list[RedisDocument]:
+    """Best matching document of each question.
+
+    Args:
+        docs: dictionary mapping each question to list of context documents
+
+    Returns:
+        best matching document of each question that has context documents
+    """
+    return [
+        max(results, key=lambda doc: float(doc["score"]))
+        for results in docs.values()
+        if results
+    ]
+
+
+def use_fast_path(
+    thread: list[OpenAIMessage],
+    docs: dict[str, list[RedisDocument]],
+    confidence: float,
+) -> bool:
+    """Check if a response can be assembled from documents without OpenAI.
+
+    Args:
+        thread: previous email thread
+        docs: dictionary mapping each question to list of context documents
+        confidence: confidence of the context documents
+
+    Returns:
+        whether the fast path is enabled and the email starts a thread whose
+        questions all closely match a document that isn't a team reply
+    """
+    return (
+        FAST_PATH_ENABLED
+        and not thread
+        and confidence >= FAST_PATH_MIN_CONFIDENCE
+        and all(doc["source"] != TEAM_REPLY_SOURCE for doc in best_documents(docs))
+    )
+
+
+def fast_path_response(
+    sender: str, email: str, docs: dict[str, list[RedisDocument]]
+) -> str:
+    """Assemble a response from the best matching document of each question.
+
+    Args:
+        sender: hacker email address
+        email: newest incoming hacker email
+        docs: dictionary mapping each question to list of context documents
+
+    Returns:
+        email response, with the greeting and footer of generated responses
+    """
+    answers = [doc["content"].strip() for doc in best_documents(docs)]
+    body = "\n\n".join(dict.fromkeys(answer for answer in answers if answer))
+    return f"{greeting(sender, email)}\n\n{body}\n\n{FOOTER}"
+
+
+async def agenerate_response(
     sender: str, email: str, thread: list[OpenAIMessage] | None = None
-) -> tuple[str, dict[str, list[RedisDocument]], float]:
+) -> tuple[str, dict[str, list[RedisDocument]], float, bool]:
     """Generate response to email.
 
+    Responses to emails that start a thread are cached, and reused for similar
+    emails with the greeting personalized for the new sender. If the fast path is
+    enabled and every question closely matches a document, the response is
+    assembled from the documents instead of generated by OpenAI.
+
     Args:
         sender: hacker email address
-        email: newest incoming hacker email
-        thread : previous email thread
+        email: newest incoming hacker email, without its quoted history
+        thread : previous email thread, without the quoted history of its emails
 
     Returns:
         (email response,
         dictionary mapping each question to list of context documents used to
         answer question,
-        confidence of response)
+        confidence of response,
+        whether the response was assembled by the fast path)
     """
-    if thread is None:
-        thread = []
+    thread = thread or []
+
+    cache_key = None
+    if RESPONSE_CACHE_ENABLED and not thread:
+        try:
+            [email_embedding] = await acompute_query_embeddings([email])
+            version = await corpus_version()
+            cached = await aget_cached_response(email_embedding, version)
+            if cached is not None:
+                response, docs, confidence = cached
+                response = personalize_greeting(response, sender, email)
+                return response, docs, confidence, False
+            cache_key = (email_embedding, version)
+        except RedisError as e:
+            custom_log("response cache unavailable:", e, level=logging.WARNING)
 
     # generate new context
-    contexts, docs, confidence = generate_context(email)
+    docs, confidence = await agenerate_context(email)
+
+    if use_fast_path(thread, docs, confidence):
+        await aincrement("fast_path_responses")
+        return fast_path_response(sender, email, docs), docs, confidence, True
 
     # generate new response
-    thread.append({"role": "user", "content": "EMAIL FROM USER: \n\n" + email})
-    thread += contexts
-    return openai_response(thread, sender), docs, confidence
+    messages = await abuild_prompt(thread, email, docs)
+    response = await aopenai_response(messages, sender)
+
+    if cache_key is not None:
+        await acache_response(*cache_key, response, docs, confidence)
+    return response, docs, confidence, False
+
+
+def generate_response(
+    sender: str, email: str, thread: list[OpenAIMessage] | None = None
+) -> tuple[str, dict[str, list[RedisDocument]], float, bool]:
+    """Generate response to email.
+
+    Runs agenerate_response on the background event loop.
+
+    Args:
+        sender: hacker email address
+        email: newest incoming hacker email
+        thread : previous email thread
+
+    Returns:
+        same as agenerate_response
+    """
+    return run(agenerate_response(sender, email, thread))
+
+
+def stream_response(
+    sender: str, email: str, thread: list[OpenAIMessage] | None = None
+) -> tuple[Iterator[str], dict[str, list[RedisDocument]], float, bool]:
+    """Generate response to email, streaming the response as it is generated.
+
+    The context is generated up front, and the response is generated while the
+    returned iterator is consumed. Responses assembled by the fast path are
+    yielded whole.
+
+    Args:
+        sender: hacker email address
+        email: newest incoming hacker email, without its quoted history
+        thread : previous email thread, without the quoted history of its emails
+
+    Returns:
+        (iterator over pieces of the email response,
+        dictionary mapping each question to list of context documents used to
+        answer question,
+        confidence of response,
+        whether the response was assembled by the fast path)
+    """
+    thread = thread or []
+
+    docs, confidence = generate_context(email)
+
+    if use_fast_path(thread, docs, confidence):
+        run(aincrement("fast_path_responses"))
+        response = fast_path_response(sender, email, docs)
+        return iter([response]), docs, confidence, True
+
+    messages = run(abuild_prompt(thread, email, docs))
+    tokens = iterate(astream_openai_response(messages, sender))
+    return tokens, docs, confidence, False
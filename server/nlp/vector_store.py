@@ -0,0 +1,1228 @@
+"""Vector store.
+
+This module provides the vector stores that documents are searched in. Two backends
+are available:
+
+- RedisVectorStore keeps documents in a RediSearch index.
+- NumpyVectorStore keeps documents in a pre-normalized float32 matrix in memory, and
+  answers queries with a single matrix product. It doesn't need redis stack, and is
+  the faster option for small corpora.
+
+Both backends return search results in the same shape.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+from typing import Callable, cast
+
+import numpy as np
+from redis.commands.search.field import (
+    NumericField,
+    TextField,
+    VectorField,
+)
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+from redis.commands.search.result import Result
+from redis.exceptions import ResponseError
+
+from server import redis_binary_client, redis_client
+from server.config import (
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_RUNTIME,
+    HNSW_M,
+    HYBRID_CANDIDATES,
+    HYBRID_RRF_K,
+    HYBRID_TEXT_WEIGHT,
+    HYBRID_VECTOR_WEIGHT,
+    MMR_LAMBDA,
+    NUMPY_STORE_PRECISION,
+    NUMPY_STORE_REFRESH_SECONDS,
+    VECTOR_DIMENSION,
+    VECTOR_INDEX_ALGORITHM,
+    VECTOR_STORAGE,
+    RedisDocument,
+)
+from server.nlp.async_clients import async_redis_binary_client, async_redis_client
+from server.utils import custom_log
+
+assert redis_client is not None
+assert redis_binary_client is not None
+
+SearchResult = dict
+# search results of a query, with a matrix of their unit length vectors as rows
+Candidates = tuple[list[SearchResult], np.ndarray]
+# given the documents loaded by a sync by sql_id, returns the documents that changed
+# since the corpus was read, their embeddings, and the sql_ids of deleted documents
+Reconcile = Callable[
+    [dict[int, RedisDocument]],
+    tuple[list[RedisDocument], list[list[float]], list[int]],
+]
+
+# a rebuild reconciles at most this many times with documents changed while it ran
+RECONCILE_PASSES = 5
+
+WORD = re.compile(r"[^\W_]+")
+# default stopwords of RediSearch, which are not indexed
+STOPWORDS = frozenset(
+    "a is the an and are as at be but by for if in into it no not of on or such that "
+    "their then there these they this to was will with".split()
+)
+
+
+class VectorStore:
+    """Interface for vector store backends.
+
+    Embeddings are passed in as lists of floats, and don't need to be normalized.
+    """
+
+    def upsert(self, corpus: list[RedisDocument], embeddings: list[list[float]]):
+        """Add or replace documents.
+
+        Args:
+            corpus: list of documents, each represented by dictionary
+            embeddings: list of embeddings, one per document
+        """
+        raise NotImplementedError
+
+    def delete(self, sql_ids: list[int]):
+        """Remove documents.
+
+        Args:
+            sql_ids: ids of the documents in postgres
+        """
+        raise NotImplementedError
+
+    def sync(
+        self,
+        corpus: list[RedisDocument],
+        embeddings: list[list[float]],
+        reconcile: Reconcile | None = None,
+    ):
+        """Replace all documents with the given corpus.
+
+        Args:
+            corpus: list of documents, each represented by dictionary
+            embeddings: list of embeddings, one per document
+            reconcile: finds the documents changed since the corpus was read, which
+                are applied before the new documents go live
+        """
+        raise NotImplementedError
+
+    def search(self, vectors: list[list[float]], k: int) -> list[list[SearchResult]]:
+        """Find the k most similar documents for each query vector.
+
+        Args:
+            vectors: list of query embeddings
+            k: number of nearest neighbors to return
+
+        Returns:
+            list of results for each query vector, most similar first. each result is
+            a dictionary with the score (cosine similarity), source, question,
+            content and sql_id of the document.
+        """
+        raise NotImplementedError
+
+    async def asearch(
+        self, vectors: list[list[float]], k: int
+    ) -> list[list[SearchResult]]:
+        """Find the k most similar documents for each query vector, asynchronously.
+
+        Runs search in a worker thread, unless the backend has a native async search.
+
+        Args:
+            vectors: list of query embeddings
+            k: number of nearest neighbors to return
+
+        Returns:
+            same as search
+        """
+        return await asyncio.to_thread(self.search, vectors, k)
+
+    def search_with_vectors(
+        self, vectors: list[list[float]], k: int
+    ) -> list[Candidates]:
+        """Find the k most similar documents for each query vector, with their vectors.
+
+        Args:
+            vectors: list of query embeddings
+            k: number of nearest neighbors to return
+
+        Returns:
+            list of (results, as returned by search,
+            matrix of the unit length vectors of the results) for each query vector
+        """
+        raise NotImplementedError
+
+    async def asearch_with_vectors(
+        self, vectors: list[list[float]], k: int
+    ) -> list[Candidates]:
+        """Find the k most similar documents for each query vector, with their vectors.
+
+        Runs search_with_vectors in a worker thread, unless the backend has a native
+        async search.
+
+        Args:
+            vectors: list of query embeddings
+            k: number of nearest neighbors to return
+
+        Returns:
+            same as search_with_vectors
+        """
+        return await asyncio.to_thread(self.search_with_vectors, vectors, k)
+
+    def hybrid_search(
+        self, vectors: list[list[float]], texts: list[str], k: int
+    ) -> list[list[SearchResult]]:
+        """Find the k best documents for each query by vector and full-text search.
+
+        Backends without full-text search fall back to vector search.
+
+        Args:
+            vectors: list of query embeddings
+            texts: list of query texts, one per query embedding
+            k: number of documents to return
+
+        Returns:
+            same as search, ordered by fused rank
+        """
+        return self.search(vectors, k)
+
+    async def ahybrid_search(
+        self, vectors: list[list[float]], texts: list[str], k: int
+    ) -> list[list[SearchResult]]:
+        """Find the k best documents for each query by vector and full-text search.
+
+        Args:
+            vectors: list of query embeddings
+            texts: list of query texts, one per query embedding
+            k: number of documents to return
+
+        Returns:
+            same as hybrid_search
+        """
+        return await asyncio.to_thread(self.hybrid_search, vectors, texts, k)
+
+
+def document_key(sql_id: int | str, prefix: str = "documents:") -> str:
+    """Redis key of a document.
+
+    Args:
+        sql_id: id of the document in postgres
+        prefix: key prefix of the index the document belongs to
+
+    Returns:
+        redis key
+    """
+    return f"{prefix}{sql_id}"
+
+
+def wait_for_index(index_name: str, corpus_len: int, timeout: float = 60):
+    """Wait until an index has finished indexing its documents.
+
+    Polls FT.INFO with exponential backoff.
+
+    Args:
+        index_name: name of the index
+        corpus_len: number of documents the index should contain at least
+        timeout: seconds to wait before giving up
+
+    Raises:
+        exception: if the index isn't ready before the timeout
+    """
+    start = time.monotonic()
+    delay = 0.01
+    while 1:
+        info = redis_client.ft(index_name).info()
+        if int(info["indexing"]) == 0 and int(info["num_docs"]) >= corpus_len:
+            custom_log(
+                "num_docs",
+                info["num_docs"],
+                "indexing_failures",
+                info["hash_indexing_failures"],
+            )
+            return
+        if time.monotonic() - start >= timeout:
+            raise Exception("time out")
+        time.sleep(delay)
+        delay = min(delay * 2, 1)
+
+
+def vector_field_attributes(
+    algorithm: str = VECTOR_INDEX_ALGORITHM, dimension: int = VECTOR_DIMENSION
+) -> dict:
+    """Attributes of the vector field for the given index algorithm.
+
+    Args:
+        algorithm: "FLAT" or "HNSW"
+        dimension: dimension of the vectors
+
+    Returns:
+        vector field attributes
+
+    Raises:
+        exception: if the algorithm is not supported
+    """
+    attributes: dict = {
+        "TYPE": "FLOAT32",
+        "DIM": dimension,
+        "DISTANCE_METRIC": "COSINE",
+    }
+    if algorithm == "HNSW":
+        attributes.update(
+            {
+                "M": HNSW_M,
+                "EF_CONSTRUCTION": HNSW_EF_CONSTRUCTION,
+                "EF_RUNTIME": HNSW_EF_RUNTIME,
+            }
+        )
+    elif algorithm != "FLAT":
+        raise Exception(f"unsupported vector index algorithm {algorithm}")
+    return attributes
+
+
+def create_index(
+    corpus_len: int,
+    index_name: str = "idx:documents_vss",
+    prefix: str = "documents:",
+    algorithm: str = VECTOR_INDEX_ALGORITHM,
+    storage: str = "JSON",
+    dimension: int = VECTOR_DIMENSION,
+):
+    """Create search index in redis.
+
+    Documents that are already in redis are indexed in the background, so this waits
+    until all of them are indexed.
+
+    Args:
+        corpus_len:
+            number of documents already in redis
+        index_name:
+            name of the index
+        prefix:
+            key prefix of the documents to index
+        algorithm:
+            vector index algorithm, "FLAT" or "HNSW"
+        storage:
+            how the documents are stored, "JSON" or "HASH"
+        dimension:
+            dimension of the vectors
+
+    Raises:
+        exception: if failed to create index
+    """
+    custom_log("creating", algorithm, "index over", storage, "documents...")
+
+    vector_field = vector_field_attributes(algorithm, dimension)
+    if storage == "JSON":
+        schema = (
+            TextField("$.source", no_stem=True, as_name="source"),
+            TextField("$.question", no_stem=True, as_name="question"),
+            TextField("$.content", no_stem=True, as_name="content"),
+            NumericField("$.sql_id", as_name="sql_id"),
+            VectorField(
+                "$.question_and_content_embeddings",
+                algorithm,
+                vector_field,
+                as_name="vector",
+            ),
+        )
+        index_type = IndexType.JSON
+    elif storage == "HASH":
+        schema = (
+            TextField("source", no_stem=True),
+            TextField("question", no_stem=True),
+            TextField("content", no_stem=True),
+            NumericField("sql_id"),
+            VectorField("vector", algorithm, vector_field),
+        )
+        index_type = IndexType.HASH
+    else:
+        raise Exception(f"unsupported vector storage {storage}")
+
+    definition = IndexDefinition(prefix=[prefix], index_type=index_type)
+    res = redis_client.ft(index_name).create_index(fields=schema, definition=definition)
+
+    if res != "OK":
+        raise Exception("failed to create index")
+    wait_for_index(index_name, corpus_len)
+
+
+def write_document(
+    pipeline,
+    key: str,
+    doc: RedisDocument,
+    embedding: list[float],
+    storage: str = VECTOR_STORAGE,
+):
+    """Queue a write of a document and its embedding on a redis pipeline.
+
+    Args:
+        pipeline: redis pipeline
+        key: redis key of the document
+        doc: document represented by dictionary
+        embedding: embedding of the document
+        storage: how the document is stored, "JSON" or "HASH"
+    """
+    if storage == "HASH":
+        pipeline.hset(
+            key,
+            mapping={
+                **doc,
+                "vector": np.asarray(embedding, dtype=np.float32).tobytes(),
+            },
+        )
+    else:
+        pipeline.json().set(
+            key, "$", {**doc, "question_and_content_embeddings": embedding}
+        )
+
+
+def create_query(k: int, with_vectors: bool = False):
+    """Create k-NN redis query.
+
+    Args:
+        k: number of nearest neighbors to return
+        with_vectors: whether to return the vectors of the documents as well
+
+    Returns:
+        redis query object
+    """
+    fields = ["vector_score", "source", "question", "content", "sql_id"]
+    if with_vectors:
+        fields.append("vector")
+    return (
+        Query(f"(*)=>[KNN {k} @vector $query_vector AS vector_score]")
+        .sort_by("vector_score")
+        .return_fields(*fields)
+        .dialect(2)
+    )
+
+
+def decode_vector(value: bytes) -> np.ndarray:
+    """Decode a vector returned by a search, which is stored as JSON or HASH.
+
+    Args:
+        value: JSON array of floats, or packed float32 bytes
+
+    Returns:
+        float32 vector
+    """
+    if value[:1] == b"[":
+        try:
+            return np.array(json.loads(value), dtype=np.float32)
+        except ValueError:
+            # packed floats that happen to start with "["
+            pass
+    return np.frombuffer(value, dtype=np.float32)
+
+
+def create_text_query(text: str, k: int) -> Query | None:
+    """Create BM25 full-text redis query over the question and content of documents.
+
+    Documents matching any word of the text are ranked by BM25.
+
+    Args:
+        text: query text
+        k: number of documents to return
+
+    Returns:
+        redis query object, or None if the text has no searchable words
+    """
+    words = [
+        word
+        for word in dict.fromkeys(WORD.findall(text.lower()))
+        if len(word) > 1 and word not in STOPWORDS
+    ]
+    if not words:
+        return None
+    return (
+        Query(f"@question|content:({'|'.join(words)})")
+        .scorer("BM25")
+        .paging(0, k)
+        .return_fields("source", "question", "content", "sql_id")
+        .dialect(2)
+    )
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[SearchResult]],
+    weights: list[float],
+    k: int,
+    rrf_k: int = HYBRID_RRF_K,
+) -> list[SearchResult]:
+    """Merge rankings of documents with reciprocal rank fusion.
+
+    Every ranking contributes weight / (rrf_k + rank) to the fused score of each
+    document it contains, with ranks starting at 1.
+
+    Args:
+        rankings: lists of documents, best first
+        weights: weight of each ranking
+        k: number of documents to return
+        rrf_k: constant that dampens the advantage of the top ranks
+
+    Returns:
+        k documents with the highest fused scores, best first. documents in several
+        rankings are taken from the first of them
+    """
+    scores: dict[int, float] = {}
+    documents: dict[int, SearchResult] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc in enumerate(ranking, start=1):
+            sql_id = int(doc["sql_id"])
+            scores[sql_id] = scores.get(sql_id, 0) + weight / (rrf_k + rank)
+            documents.setdefault(sql_id, doc)
+    fused = sorted(scores, key=lambda sql_id: scores[sql_id], reverse=True)
+    return [documents[sql_id] for sql_id in fused[:k]]
+
+
+class RedisVectorStore(VectorStore):
+    """Vector store backed by a RediSearch index.
+
+    Every full rebuild loads the corpus into a new version, with its own key prefix
+    (documents_v{n}:) and index (idx:documents_vss:v{n}). Queries go through the
+    idx:documents_vss alias, which is swapped atomically to the new index once it is
+    fully indexed. Older versions are garbage collected afterwards.
+
+    A version keeps the storage it was built with, HASH documents with packed float32
+    vectors or JSON documents, so VECTOR_STORAGE only applies to new versions.
+    """
+
+    index_name = "idx:documents_vss"
+    live_version_key = "idx:documents_vss:live"
+    building_version_key = "idx:documents_vss:building"
+    version_counter_key = "idx:documents_vss:versions"
+    version_storage_key = "idx:documents_vss:storage"
+
+    @classmethod
+    def version_index(cls, version: int) -> str:
+        """Name of the index of a version."""
+        return f"{cls.index_name}:v{version}"
+
+    @staticmethod
+    def version_prefix(version: int | None) -> str:
+        """Key prefix of a version.
+
+        Documents loaded before versioning was introduced use the documents: prefix.
+        """
+        return "documents:" if version is None else f"documents_v{version}:"
+
+    def _version(self, key: str) -> int | None:
+        value = redis_client.get(key)
+        return None if value is None else int(value)  # type: ignore
+
+    def index_exists(self) -> bool:
+        """Check whether the search index exists."""
+        try:
+            redis_client.ft(self.index_name).info()
+        except ResponseError:
+            return False
+        return True
+
+    def ensure_index(self):
+        """Create an empty search index if it doesn't exist yet."""
+        if not self.index_exists():
+            self.sync([], [])
+
+    def _versions(self) -> list[int | None]:
+        """Versions that upserts and deletes apply to.
+
+        While a rebuild is running, changes are applied to both the live version and
+        the version being built, so they survive the swap.
+        """
+        versions = [self._version(self.live_version_key)]
+        building = self._version(self.building_version_key)
+        if building is not None:
+            versions.append(building)
+        return versions
+
+    def _storage(self, version: int | None) -> str:
+        """Storage of a version, which is fixed when the version is built.
+
+        Versions from before storage was configurable are stored as JSON.
+        """
+        if version is None:
+            return "JSON"
+        storage = redis_client.hget(self.version_storage_key, str(version))
+        return storage or "JSON"  # type: ignore
+
+    def _load(
+        self,
+        versions: list[int | None],
+        corpus: list[RedisDocument],
+        embeddings: list[list[float]],
+    ):
+        """Write documents into each of the given versions.
+
+        Raises:
+            exception: if failed to load documents into redis
+        """
+        custom_log("loading documents into redis...")
+
+        pipeline = redis_client.pipeline(transaction=False)
+        for version in versions:
+            prefix = self.version_prefix(version)
+            storage = self._storage(version)
+            for doc, embedding in zip(corpus, embeddings):
+                key = document_key(doc["sql_id"], prefix)
+                write_document(pipeline, key, doc, embedding, storage)
+        res = pipeline.execute()
+
+        # HSET replies with the number of new fields, which is 0 for replaced
+        # documents, so only JSON.SET replies are checked
+        if not all(r for r in res if not isinstance(r, int)):
+            raise Exception("failed to load some documents")
+        custom_log("successfully loaded", len(corpus), "documents")
+
+    def upsert(self, corpus: list[RedisDocument], embeddings: list[list[float]]):
+        """Add or replace documents.
+
+        Each document is stored under its sql_id, so loading a document that is
+        already in redis replaces it.
+        """
+        if not corpus:
+            return
+        self.ensure_index()
+        self._load(self._versions(), corpus, embeddings)
+
+    def delete(self, sql_ids: list[int]):
+        """Remove documents."""
+        if not sql_ids:
+            return
+        keys = [
+            document_key(sql_id, self.version_prefix(version))
+            for version in self._versions()
+            for sql_id in sql_ids
+        ]
+        res = redis_client.delete(*keys)
+        custom_log("deleted", res, "documents from redis")
+
+    def sync(
+        self,
+        corpus: list[RedisDocument],
+        embeddings: list[list[float]],
+        reconcile: Reconcile | None = None,
+    ):
+        """Replace all documents with the given corpus.
+
+        Builds a new version next to the live one and swaps the alias over once it
+        is ready, so the live index is never empty or partially loaded. Documents
+        changed before the version was marked as building only reached the live
+        version, so they are reconciled into the new one before the swap.
+        """
+        version = int(redis_client.incr(self.version_counter_key))  # type: ignore
+        index_name = self.version_index(version)
+        prefix = self.version_prefix(version)
+        custom_log("building index version", version, "...")
+
+        redis_client.hset(self.version_storage_key, str(version), VECTOR_STORAGE)
+        redis_client.set(self.building_version_key, version, ex=60 * 60)
+        try:
+            self._load([version], corpus, embeddings)
+            create_index(
+                len(corpus),
+                index_name,
+                prefix,
+                VECTOR_INDEX_ALGORITHM,
+                VECTOR_STORAGE,
+            )
+            if reconcile is not None:
+                self._reconcile(version, corpus, reconcile)
+
+            # indexes built before versioning are registered under the alias name,
+            # so they have to be dropped before the alias can take their place
+            if self.index_exists():
+                live_index = redis_client.ft(self.index_name).info()["index_name"]
+                if live_index == self.index_name:
+                    redis_client.ft(self.index_name).dropindex()
+
+            redis_client.ft(index_name).aliasupdate(self.index_name)
+            redis_client.set(self.live_version_key, version)
+        finally:
+            redis_client.delete(self.building_version_key)
+        custom_log("swapped to index version", version)
+
+        self.collect_garbage(version)
+
+    def _reconcile(
+        self, version: int, corpus: list[RedisDocument], reconcile: Reconcile
+    ):
+        """Apply documents changed while a version was built to it.
+
+        Changes are applied until there are none left, so a change that raced with
+        one pass is applied by the next.
+
+        Args:
+            version: version being built
+            corpus: documents loaded into the version
+            reconcile: finds the documents changed since the corpus was read
+        """
+        loaded = {int(doc["sql_id"]): doc for doc in corpus}
+        prefix = self.version_prefix(version)
+        for _ in range(RECONCILE_PASSES):
+            changed, embeddings, deleted = reconcile(loaded)
+            if not changed and not deleted:
+                return
+            custom_log(
+                "reconciling", len(changed), "changed and", len(deleted), "deleted docs"
+            )
+            if changed:
+                self._load([version], changed, embeddings)
+                loaded.update({int(doc["sql_id"]): doc for doc in changed})
+            if deleted:
+                redis_client.delete(
+                    *[document_key(sql_id, prefix) for sql_id in deleted]
+                )
+                for sql_id in deleted:
+                    loaded.pop(sql_id, None)
+        custom_log(
+            "documents still changing after",
+            RECONCILE_PASSES,
+            "passes",
+            level=logging.WARNING,
+        )
+
+    def collect_garbage(self, live_version: int):
+        """Drop indexes and documents of versions older than the live one.
+
+        Newer versions are left alone, since they may belong to a rebuild that is
+        still running.
+
+        Args:
+            live_version: version that is live
+        """
+        version_index = re.compile(rf"^{re.escape(self.index_name)}:v(\d+)$")
+        for index_name in redis_client.execute_command("FT._LIST"):
+            match = version_index.match(index_name)
+            if match and int(match.group(1)) < live_version:
+                redis_client.ft(index_name).dropindex()
+
+        stale_versions = [
+            version
+            # the stubs of hdel type its keys as lists, so the versions aren't typed
+            for version in cast(list, redis_client.hkeys(self.version_storage_key))
+            if int(version) < live_version
+        ]
+        if stale_versions:
+            redis_client.hdel(self.version_storage_key, *stale_versions)
+
+        version_key = re.compile(r"^documents_v(\d+):")
+        stale_keys = 0
+        for pattern in ("documents:*", "documents_v*:*"):
+            batch = []
+            for key in redis_client.scan_iter(match=pattern, count=1000):
+                match = version_key.match(key)
+                if match and int(match.group(1)) >= live_version:
+                    continue
+                batch.append(key)
+                if len(batch) == 1000:
+                    stale_keys += redis_client.unlink(*batch)  # type: ignore
+                    batch = []
+            if batch:
+                stale_keys += redis_client.unlink(*batch)  # type: ignore
+        custom_log("dropped old index versions and", stale_keys, "stale documents")
+
+    @staticmethod
+    def _search_params(vector: list[float]) -> dict:
+        return {"query_vector": np.array(vector, dtype=np.float32).tobytes()}
+
+    @staticmethod
+    def _parse_replies(replies: list) -> list[list[SearchResult]]:
+        """Parse raw FT.SEARCH replies, since search pipelines don't parse them."""
+        results = []
+        for reply in replies:
+            results.append(
+                [
+                    {
+                        "score": round(1 - float(doc.vector_score), 2),
+                        "source": doc.source,
+                        "question": doc.question,
+                        "content": doc.content,
+                        "sql_id": int(doc.sql_id),
+                    }
+                    for doc in Result(reply, True).docs
+                ]
+            )
+        return results
+
+    @staticmethod
+    def _parse_text_reply(reply) -> list[SearchResult]:
+        """Parse a raw FT.SEARCH reply of a full-text query.
+
+        Full-text queries don't compute similarities, so scores are left at 0.
+        """
+        return [
+            {
+                "score": 0.0,
+                "source": doc.source,
+                "question": doc.question,
+                "content": doc.content,
+                "sql_id": int(doc.sql_id),
+            }
+            for doc in Result(reply, True).docs
+        ]
+
+    def _fuse(
+        self, replies: list, text_queries: list[Query | None], k: int
+    ) -> list[list[SearchResult]]:
+        """Merge the k-NN and full-text replies of each query.
+
+        Documents only found by the full-text query weren't among the nearest
+        vector candidates, so they get the score of the least similar candidate.
+        """
+        replies_iter = iter(replies)
+        results = []
+        for text_query in text_queries:
+            [by_vector] = self._parse_replies([next(replies_iter)])
+            by_text = []
+            if text_query is not None:
+                floor = by_vector[-1]["score"] if by_vector else 0.0
+                by_text = [
+                    {**doc, "score": floor}
+                    for doc in self._parse_text_reply(next(replies_iter))
+                ]
+            results.append(
+                reciprocal_rank_fusion(
+                    [by_vector, by_text],
+                    [HYBRID_VECTOR_WEIGHT, HYBRID_TEXT_WEIGHT],
+                    k,
+                )
+            )
+        return results
+
+    @staticmethod
+    def _parse_candidate_replies(replies: list) -> list[Candidates]:
+        """Parse raw FT.SEARCH replies of the binary client, which include vectors."""
+        results = []
+        for reply in replies:
+            docs = []
+            rows = []
+            # replies are [total, key, fields, key, fields, ...]
+            for fields in reply[2::2]:
+                values = dict(zip(fields[::2], fields[1::2]))
+                rows.append(decode_vector(values[b"vector"]))
+                docs.append(
+                    {
+                        "score": round(1 - float(values[b"vector_score"]), 2),
+                        "source": values[b"source"].decode(),
+                        "question": values[b"question"].decode(),
+                        "content": values[b"content"].decode(),
+                        "sql_id": int(values[b"sql_id"]),
+                    }
+                )
+            matrix = normalize(np.array(rows)) if rows else np.empty((0, 0))
+            results.append((docs, matrix))
+        return results
+
+    def search(self, vectors: list[list[float]], k: int) -> list[list[SearchResult]]:
+        """Find the k most similar documents for each query vector.
+
+        All searches are sent in a single round trip.
+        """
+        query = create_query(k)
+        pipeline = redis_client.ft(self.index_name).pipeline(transaction=False)
+        for vector in vectors:
+            pipeline.search(query, self._search_params(vector))
+        return self._parse_replies(pipeline.execute())
+
+    async def asearch(
+        self, vectors: list[list[float]], k: int
+    ) -> list[list[SearchResult]]:
+        """Find the k most similar documents for each query vector, asynchronously.
+
+        All searches are sent in a single round trip on the async redis client.
+        """
+        query = create_query(k)
+        pipeline = async_redis_client().ft(self.index_name).pipeline(transaction=False)
+        for vector in vectors:
+            await pipeline.search(query, self._search_params(vector))
+        return self._parse_replies(await pipeline.execute())
+
+    def search_with_vectors(
+        self, vectors: list[list[float]], k: int
+    ) -> list[Candidates]:
+        """Find the k most similar documents for each query vector, with their vectors.
+
+        Vectors are returned as raw bytes, so searches go through the binary client.
+        All searches are sent in a single round trip.
+        """
+        query = create_query(k, with_vectors=True)
+        pipeline = redis_binary_client.ft(self.index_name).pipeline(transaction=False)
+        for vector in vectors:
+            pipeline.search(query, self._search_params(vector))
+        return self._parse_candidate_replies(pipeline.execute())
+
+    async def asearch_with_vectors(
+        self, vectors: list[list[float]], k: int
+    ) -> list[Candidates]:
+        """Find the k most similar documents for each query vector, with their vectors.
+
+        All searches are sent in a single round trip on the async binary client.
+        """
+        query = create_query(k, with_vectors=True)
+        client = async_redis_binary_client()
+        pipeline = client.ft(self.index_name).pipeline(transaction=False)
+        for vector in vectors:
+            await pipeline.search(query, self._search_params(vector))
+        return self._parse_candidate_replies(await pipeline.execute())
+
+    def hybrid_search(
+        self, vectors: list[list[float]], texts: list[str], k: int
+    ) -> list[list[SearchResult]]:
+        """Find the k best documents for each query by vector and full-text search.
+
+        The k-NN and BM25 queries of all queries are sent in a single round trip,
+        and merged with reciprocal rank fusion.
+        """
+        candidates = max(k, HYBRID_CANDIDATES)
+        vector_query = create_query(candidates)
+        text_queries = [create_text_query(text, candidates) for text in texts]
+        pipeline = redis_client.ft(self.index_name).pipeline(transaction=False)
+        for vector, text_query in zip(vectors, text_queries):
+            pipeline.search(vector_query, self._search_params(vector))
+            if text_query is not None:
+                pipeline.search(text_query)
+        return self._fuse(pipeline.execute(), text_queries, k)
+
+    async def ahybrid_search(
+        self, vectors: list[list[float]], texts: list[str], k: int
+    ) -> list[list[SearchResult]]:
+        """Find the k best documents for each query by vector and full-text search.
+
+        All queries are sent in a single round trip on the async redis client.
+        """
+        candidates = max(k, HYBRID_CANDIDATES)
+        vector_query = create_query(candidates)
+        text_queries = [create_text_query(text, candidates) for text in texts]
+        pipeline = async_redis_client().ft(self.index_name).pipeline(transaction=False)
+        for vector, text_query in zip(vectors, text_queries):
+            await pipeline.search(vector_query, self._search_params(vector))
+            if text_query is not None:
+                await pipeline.search(text_query)
+        return self._fuse(await pipeline.execute(), text_queries, k)
+
+
+def maximal_marginal_relevance(
+    query: np.ndarray, candidates: np.ndarray, k: int, lambda_mult: float
+) -> list[int]:
+    """Pick a diverse subset of candidates with maximal marginal relevance.
+
+    Candidates are picked one at a time. Each pick maximizes lambda_mult times its
+    similarity to the query, minus 1 - lambda_mult times its highest similarity to the
+    candidates picked before.
+
+    Args:
+        query: unit length query vector
+        candidates: matrix of unit length candidate vectors as rows
+        k: number of candidates to pick
+        lambda_mult: between 0 (only diversity) and 1 (only relevance)
+
+    Returns:
+        indices of the picked candidates, in the order they were picked
+    """
+    if len(candidates) == 0:
+        return []
+    relevance = candidates @ query
+    # (candidates x candidates) cosine similarities
+    similarity = candidates @ candidates.T
+    picked = [int(np.argmax(relevance))]
+    redundancy = similarity[picked[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[picked[0]] = False
+    while len(picked) < min(k, len(candidates)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return picked
+
+
+def rerank_mmr(
+    vectors: list[list[float]],
+    candidates: list[Candidates],
+    k: int,
+    lambda_mult: float = MMR_LAMBDA,
+) -> list[list[SearchResult]]:
+    """Pick a diverse top k out of the candidates of each query vector.
+
+    Args:
+        vectors: list of query embeddings
+        candidates: candidates of each query vector, from search_with_vectors
+        k: number of documents to return for each query vector
+        lambda_mult: between 0 (only diversity) and 1 (only relevance)
+
+    Returns:
+        same as search, in the order the documents were picked
+    """
+    queries = normalize(np.array(vectors, dtype=np.float32))
+    results = []
+    for query, (docs, matrix) in zip(queries, candidates):
+        picked = maximal_marginal_relevance(query, matrix, k, lambda_mult)
+        results.append([docs[i] for i in picked])
+    return results
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Normalize row vectors to unit length, as float32.
+
+    Args:
+        vectors: matrix of row vectors
+
+    Returns:
+        normalized matrix
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, highest first.
+
+    Args:
+        scores: 1-d array of scores
+        k: number of indices to return
+
+    Returns:
+        array of at most k indices
+    """
+    if k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def quantize(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Scalar-quantize row vectors to int8, with one scale per row.
+
+    Each row is scaled so its largest component maps to 127, so row i is approximately
+    quantized[i] * scales[i].
+
+    Args:
+        vectors: matrix of row vectors
+
+    Returns:
+        int8 matrix and float32 scales
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=-1, initial=0) / 127
+    scales = np.maximum(scales, np.finfo(np.float32).tiny)
+    quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+class NumpyVectorStore(VectorStore):
+    """Vector store backed by an in-memory float32 matrix.
+
+    Rows of the matrix are unit length, so cosine similarity against all documents is
+    a single matrix-vector product. The matrix grows by doubling, and deleted rows are
+    filled with the last row, so rows stay contiguous.
+
+    With int8 precision, rows are scalar-quantized, which takes a quarter of the
+    memory. Scores are then computed block by block in float32 and rescaled.
+
+    Every process keeps its own copy. Changes made in this process apply immediately,
+    and the store reloads from the loader when the loader's signature changes, checked
+    at most every NUMPY_STORE_REFRESH_SECONDS.
+    """
+
+    # rows dequantized at once when searching int8 matrices
+    block_rows = 4096
+
+    def __init__(
+        self,
+        loader: Callable[[], tuple[list[RedisDocument], list[list[float]]]],
+        signature: Callable[[], object],
+        refresh_seconds: float = NUMPY_STORE_REFRESH_SECONDS,
+        dimension: int = VECTOR_DIMENSION,
+        precision: str = NUMPY_STORE_PRECISION,
+    ):
+        """Create an empty store.
+
+        Args:
+            loader: returns the corpus and its embeddings to load
+            signature: returns a value that changes whenever the loader's corpus does
+            refresh_seconds: how often to check the signature
+            dimension: dimension of the vectors
+            precision: "float32" or "int8"
+
+        Raises:
+            exception: if the precision is not supported
+        """
+        if precision not in ("float32", "int8"):
+            raise Exception(f"unsupported numpy store precision {precision}")
+        self._loader = loader
+        self._signature = signature
+        self._refresh_seconds = refresh_seconds
+        self._dimension = dimension
+        self._dtype = np.int8 if precision == "int8" else np.float32
+        self._lock = threading.RLock()
+        self._matrix = np.empty((0, dimension), dtype=self._dtype)
+        self._scales = np.empty(0, dtype=np.float32)
+        self._documents: list[RedisDocument] = []
+        self._rows: dict[int, int] = {}
+        self._loaded_signature: object = None
+        self._checked_at: float | None = None
+
+    def __len__(self) -> int:
+        """Number of documents in the store."""
+        return len(self._documents)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes allocated for vectors."""
+        return self._matrix.nbytes + self._scales.nbytes
+
+    def _encode(self, embeddings) -> tuple[np.ndarray, np.ndarray]:
+        """Normalize embeddings, and quantize them if the precision is int8."""
+        vectors = normalize(np.array(embeddings, dtype=np.float32))
+        vectors = vectors.reshape(-1, self._dimension)
+        if self._dtype == np.int8:
+            return quantize(vectors)
+        return vectors, np.ones(len(vectors), dtype=np.float32)
+
+    def _scores(self, queries: np.ndarray, rows: int) -> np.ndarray:
+        """Cosine similarities of the first rows documents against queries."""
+        if self._dtype == np.float32:
+            return self._matrix[:rows] @ queries.T
+        scores = np.empty((rows, len(queries)), dtype=np.float32)
+        for start in range(0, rows, self.block_rows):
+            end = min(start + self.block_rows, rows)
+            block = self._matrix[start:end].astype(np.float32)
+            scores[start:end] = block @ queries.T
+        scores *= self._scales[:rows, None]
+        return scores
+
+    def _refresh(self):
+        """Reload the corpus if it changed in another process."""
+        now = time.monotonic()
+        if (
+            self._checked_at is not None
+            and now - self._checked_at < self._refresh_seconds
+        ):
+            return
+        with self._lock:
+            self._checked_at = now
+            signature = self._signature()
+            if signature == self._loaded_signature:
+                return
+            custom_log("reloading in-memory vector store...")
+            corpus, embeddings = self._loader()
+            self._replace(corpus, embeddings)
+            self._loaded_signature = signature
+
+    def _replace(self, corpus: list[RedisDocument], embeddings: list[list[float]]):
+        """Replace the contents of the store."""
+        self._matrix, self._scales = self._encode(embeddings)
+        self._documents = list(corpus)
+        self._rows = {int(doc["sql_id"]): i for i, doc in enumerate(corpus)}
+
+    def upsert(self, corpus: list[RedisDocument], embeddings: list[list[float]]):
+        """Add or replace documents."""
+        if not corpus:
+            return
+        vectors, scales = self._encode(embeddings)
+        with self._lock:
+            for doc, vector, scale in zip(corpus, vectors, scales):
+                sql_id = int(doc["sql_id"])
+                row = self._rows.get(sql_id)
+                if row is None:
+                    row = len(self._documents)
+                    if row == len(self._matrix):
+                        capacity = max(2 * row, 64)
+                        grown = np.empty((capacity, self._dimension), dtype=self._dtype)
+                        grown[:row] = self._matrix[:row]
+                        self._matrix = grown
+                        grown_scales = np.empty(capacity, dtype=np.float32)
+                        grown_scales[:row] = self._scales[:row]
+                        self._scales = grown_scales
+                    self._documents.append(doc)
+                    self._rows[sql_id] = row
+                else:
+                    self._documents[row] = doc
+                self._matrix[row] = vector
+                self._scales[row] = scale
+
+    def delete(self, sql_ids: list[int]):
+        """Remove documents."""
+        with self._lock:
+            for sql_id in sql_ids:
+                row = self._rows.pop(int(sql_id), None)
+                if row is None:
+                    continue
+                last = len(self._documents) - 1
+                if row != last:
+                    self._matrix[row] = self._matrix[last]
+                    self._scales[row] = self._scales[last]
+                    self._documents[row] = self._documents[last]
+                    self._rows[int(self._documents[row]["sql_id"])] = row
+                self._documents.pop()
+
+    def sync(
+        self,
+        corpus: list[RedisDocument],
+        embeddings: list[list[float]],
+        reconcile: Reconcile | None = None,
+    ):
+        """Replace all documents with the given corpus.
+
+        Documents changed while the corpus was embedded are picked up by the next
+        refresh from postgres, so reconcile isn't needed.
+        """
+        with self._lock:
+            self._replace(corpus, embeddings)
+
+    def _search(
+        self, vectors: list[list[float]], k: int, with_vectors: bool
+    ) -> list[Candidates]:
+        """Find the k most similar documents for each query vector.
+
+        Vectors of the results are only copied out of the matrix if with_vectors.
+        """
+        self._refresh()
+        queries = normalize(np.array(vectors, dtype=np.float32))
+        with self._lock:
+            documents = self._documents
+            # (documents x queries) cosine similarities
+            scores = self._scores(queries, len(documents))
+
+            results = []
+            for column in scores.T:
+                rows = top_k(column, k)
+                docs = [
+                    {
+                        "score": round(float(column[row]), 2),
+                        "source": documents[row]["source"],
+                        "question": documents[row]["question"],
+                        "content": documents[row]["content"],
+                        "sql_id": int(documents[row]["sql_id"]),
+                    }
+                    for row in rows
+                ]
+                matrix = np.empty((0, self._dimension), dtype=np.float32)
+                if with_vectors:
+                    matrix = self._matrix[rows].astype(np.float32)
+                    matrix *= self._scales[rows, None]
+                results.append((docs, matrix))
+        return results
+
+    def search(self, vectors: list[list[float]], k: int) -> list[list[SearchResult]]:
+        """Find the k most similar documents for each query vector."""
+        return [docs for docs, _ in self._search(vectors, k, with_vectors=False)]
+
+    def search_with_vectors(
+        self, vectors: list[list[float]], k: int
+    ) -> list[Candidates]:
+        """Find the k most similar documents for each query vector, with their vectors.
+
+        With int8 precision, the vectors are dequantized, so they are approximately
+        unit length.
+        """
+        return self._search(vectors, k, with_vectors=True)
@@ -1,15 +1,134 @@
 """Utils for server functions."""
 
-import inspect
+import json
+import logging
+import random
+import re
+import sys
+from datetime import datetime, timezone
 
 BLUE = "\033[34m"
 RESET = "\033[0m"
 
+# the logger of the Flask app has the same name, so the errors Flask logs are formatted
+# the same way
+logger = logging.getLogger("server")
 
-def custom_log(*args):
-    """Prints some calling information along with logging info."""
-    frame = inspect.currentframe()
-    caller_frame = inspect.getouterframes(frame)[1]
-    file_name = caller_frame.filename
-    function_name = caller_frame.function
-    print(f"{BLUE}{file_name}/{function_name}{RESET}", *args)
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as JSON lines for the log pipeline."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format a log record.
+
+        Args:
+            record: log record
+
+        Returns:
+            JSON object with the time, level, caller and message of the record
+        """
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "file": record.pathname,
+            "function": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formats log records as colored text for reading in a terminal."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format a log record.
+
+        Args:
+            record: log record
+
+        Returns:
+            caller of the record, followed by its message
+        """
+        caller = f"{BLUE}{record.pathname}/{record.funcName}{RESET}"
+        text = f"{caller} {record.getMessage()}"
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a random sample of the log records below WARNING."""
+
+    def __init__(self, rate: float):
+        """Create a filter.
+
+        Args:
+            rate: fraction of records below WARNING to keep
+        """
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Decide whether to keep a log record.
+
+        Args:
+            record: log record
+
+        Returns:
+            whether to keep the record
+        """
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def configure_logging(level: str, log_format: str, sample_rate: float):
+    """Set up the server logger.
+
+    Args:
+        level: name of the lowest level that is logged, e.g. "INFO"
+        log_format: "json" for JSON lines, or "text" for colored text
+        sample_rate: fraction of records below WARNING to keep
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+    logger.handlers = [handler]
+    logger.filters = [SamplingFilter(sample_rate)] if sample_rate < 1 else []
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def custom_log(*args, level: int = logging.INFO):
+    """Log the arguments, separated by spaces, along with the calling function.
+
+    The message is only formatted if the record is written, so logging below the
+    configured level costs little more than a level check.
+
+    Args:
+        *args: values to log
+        level: level of the record, e.g. logging.DEBUG
+    """
+    if not logger.isEnabledFor(level):
+        return
+    frame = sys._getframe(1)
+    code = frame.f_code
+    record = logger.makeRecord(
+        logger.name,
+        level,
+        code.co_filename,
+        frame.f_lineno,
+        " ".join(["%s"] * len(args)),
+        args,
+        None,
+        code.co_name,
+    )
+    logger.handle(record)
+
+
+def clean_up(text):
+    r"""Clean text by removing html tags and replacing <br /> with \n."""
+    breaked_line_text = text.replace("<br/>", "\n")
+    clean_regex = re.compile("<.*?>")
+    return re.sub(clean_regex, " ", breaked_line_text)
@@ -0,0 +1,89 @@
+"""Compare shortened and int8-quantized embeddings in the numpy vector store.
+
+Embeds the bundled corpora and their questions once at the native 1536 dimensions,
+then derives shortened embeddings by truncating and renormalizing, which is what the
+API does when asked for fewer dimensions. For each dimension and precision, reports
+the memory of the vectors, the KNN latency per question, and the agreement of the
+top-k results with the full-precision 1536 dimension results.
+
+The bundled corpora are small, so --replicas adds noisy copies of every document to
+simulate a larger corpus. Needs an OpenAI key.
+
+    python -m server_benchmarks.embedding_dimensions --dimensions 1536 512 256
+"""
+
+import argparse
+
+import numpy as np
+import openai
+
+from server_benchmarks.utils import load_corpus, timed, use_redis
+from server_benchmarks.vector_index import perturb
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dimensions", type=int, nargs="+", default=[1536, 1024, 512, 256]
+    )
+    parser.add_argument("--replicas", type=int, default=0)
+    parser.add_argument("--noise", type=float, default=0.3)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    use_redis()
+    from server.config import OPENAI_API_KEY
+    from server.nlp.embeddings import compute_openai_embeddings
+    from server.nlp.vector_store import NumpyVectorStore, normalize
+
+    openai.api_key = OPENAI_API_KEY
+    rng = np.random.default_rng(0)
+
+    documents = load_corpus("mit") + load_corpus("harvard")
+    texts = [doc["question"] + " " + doc["content"] for doc in documents]
+    questions = [doc["question"] for doc in documents]
+    full = normalize(np.array(compute_openai_embeddings(texts, 1536)))
+    full = np.concatenate(
+        [full] + [perturb(full, args.noise, rng) for _ in range(args.replicas)]
+    )
+    full_queries = normalize(np.array(compute_openai_embeddings(questions, 1536)))
+    corpus = [
+        {"question": "", "content": "", "source": "", "sql_id": i}
+        for i in range(len(full))
+    ]
+    print(f"documents: {len(full)}, queries: {len(full_queries)}, k: {args.k}")
+
+    baseline = None
+    for dimension in args.dimensions:
+        embeddings = normalize(full[:, :dimension])
+        queries = normalize(full_queries[:, :dimension]).tolist()
+        for precision in ("float32", "int8"):
+            store = NumpyVectorStore(
+                lambda: ([], []), lambda: None, dimension=dimension, precision=precision
+            )
+            store.search([queries[0]], args.k)  # initial load
+            store.sync(corpus, embeddings)  # type: ignore
+
+            def search_each(store=store, queries=queries):
+                return [store.search([query], args.k)[0] for query in queries]
+
+            latency, results = timed(search_each, repeat=args.repeat)
+            top = [[doc["sql_id"] for doc in result] for result in results]  # type: ignore
+            if baseline is None:
+                baseline = top
+            agreement = np.mean(
+                [len(set(a) & set(b)) / len(b) for a, b in zip(top, baseline)]
+            )
+            top_1 = np.mean([a[0] == b[0] for a, b in zip(top, baseline)])
+            print(
+                f"{dimension:5} {precision:7}  "
+                f"vectors {store.nbytes / 2**20:7.2f}MiB  "
+                f"knn {latency / len(queries) * 1e6:7.0f}us  "
+                f"agreement@{args.k} {agreement:.3f}  top-1 {top_1:.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Benchmark batched embedding requests against a mocked embeddings endpoint.
+
+The mock sleeps for a fixed per-request latency plus a small per-input cost, which is
+roughly how the real endpoint behaves. Compares the previous one-request-per-text
+behavior against compute_openai_embeddings.
+
+    python -m server_benchmarks.embeddings --texts 2000 --latency 150
+"""
+
+import argparse
+import time
+from unittest.mock import patch
+
+import openai
+from openai.types.create_embedding_response import CreateEmbeddingResponse, Usage
+from openai.types.embedding import Embedding
+
+from server_benchmarks.utils import load_corpus, timed, use_redis
+
+
+def mock_embeddings_endpoint(latency: float, per_input: float, dimension: int):
+    """Create a fake embeddings endpoint with the given latency profile."""
+
+    def create(input, model, **kwargs):
+        texts = [input] if isinstance(input, str) else input
+        time.sleep(latency + per_input * len(texts))
+        return CreateEmbeddingResponse(
+            model=model,
+            object="list",
+            data=[
+                Embedding(embedding=[0.0] * dimension, index=i, object="embedding")
+                for i in range(len(texts))
+            ],
+            usage=Usage(prompt_tokens=0, total_tokens=0),
+        )
+
+    return create
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--texts", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=150, help="ms per request")
+    parser.add_argument("--per-input", type=float, default=0.2, help="ms per input")
+    parser.add_argument("--dimension", type=int, default=16)
+    args = parser.parse_args()
+
+    # the mocked endpoint never checks the key, but the openai client requires one
+    openai.api_key = openai.api_key or "benchmark"
+    use_redis()
+    from server.nlp.embeddings import compute_openai_embeddings, embedding_model
+
+    corpus = load_corpus("mit") + load_corpus("harvard")
+    texts = [
+        f"{corpus[i % len(corpus)]['question']} {corpus[i % len(corpus)]['content']}"
+        for i in range(args.texts)
+    ]
+
+    endpoint = mock_embeddings_endpoint(
+        args.latency / 1000, args.per_input / 1000, args.dimension
+    )
+    with patch(
+        "openai.resources.embeddings.Embeddings.create", side_effect=endpoint
+    ) as mock:
+
+        def one_request_per_text():
+            return [
+                mock(input=text, model=embedding_model).data[0].embedding
+                for text in texts
+            ]
+
+        baseline, _ = timed(one_request_per_text)
+        baseline_requests = mock.call_count
+        mock.reset_mock()
+
+        batched, embeddings = timed(compute_openai_embeddings, texts)
+        batched_requests = mock.call_count
+
+    assert len(embeddings) == len(texts)  # type: ignore
+    print(f"texts: {len(texts)}, mocked latency: {args.latency:.0f}ms/request")
+    print(f"one request per text: {baseline:8.2f}s ({baseline_requests} requests)")
+    print(f"batched + concurrent: {batched:8.2f}s ({batched_requests} requests)")
+    print(f"speedup: {baseline / batched:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
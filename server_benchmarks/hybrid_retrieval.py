@@ -0,0 +1,147 @@
+"""Compare vector and hybrid retrieval on the bundled corpora.
+
+Loads the bundled corpora into a scratch key prefix in redis and builds an index over
+them. Every document's question is used as a query that should retrieve the document
+itself, both as written and as a keyword query of its two rarest words, e.g. "wifi
+password". Reports recall@k, mean reciprocal rank and query latency of vector search
+against hybrid search.
+
+Needs a redis stack server, and an OpenAI key unless --synthetic is passed, in which
+case queries are embedded as noisy copies of their documents, with more noise for
+keyword queries.
+
+    python -m server_benchmarks.hybrid_retrieval --k 5
+"""
+
+import argparse
+import contextlib
+import time
+from collections import Counter
+
+import numpy as np
+import openai
+
+from server_benchmarks.utils import CORPORA, load_corpus, use_redis
+
+PREFIX = "bench:hybrid:"
+INDEX = "idx:bench_hybrid"
+
+
+def keyword_query(question: str, document_frequency: Counter) -> str:
+    """Reduce a question to its two rarest words."""
+    from server.nlp.vector_store import STOPWORDS, WORD
+
+    words = [
+        word
+        for word in dict.fromkeys(WORD.findall(question.lower()))
+        if len(word) > 2 and word not in STOPWORDS
+    ]
+    words.sort(key=lambda word: document_frequency[word])
+    return " ".join(words[:2]) or question
+
+
+def embed(texts: list[str], args, base: np.ndarray | None, noise: float, seed: int):
+    """Embed texts with OpenAI, or as noisy copies of base if synthetic."""
+    if args.synthetic:
+        assert base is not None
+        rng = np.random.default_rng(seed)
+        vectors = base + rng.normal(0, noise / np.sqrt(base.shape[1]), base.shape)
+    else:
+        from server.nlp.embeddings import compute_openai_embeddings
+
+        vectors = np.array(compute_openai_embeddings(texts))
+    vectors = vectors.astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def evaluate(search, vectors: np.ndarray, texts: list[str], k: int):
+    """Run every query on its own, returning recall@k, MRR and latencies in ms."""
+    hits, reciprocal_ranks, latencies = [], [], []
+    for i, (vector, text) in enumerate(zip(vectors, texts)):
+        start = time.perf_counter()
+        [result] = search([vector.tolist()], [text], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids = [doc["sql_id"] for doc in result]
+        hits.append(i in ids)
+        reciprocal_ranks.append(1 / (ids.index(i) + 1) if i in ids else 0)
+    return np.mean(hits), np.mean(reciprocal_ranks), np.array(latencies)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpora", nargs="+", default=["mit", "harvard"])
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--noise", type=float, default=0.8)
+    parser.add_argument("--keyword-noise", type=float, default=1.2)
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--redis-host", default=None)
+    args = parser.parse_args()
+    assert all(name in CORPORA for name in args.corpora)
+
+    client = use_redis(args.redis_host)
+    from server.config import OPENAI_API_KEY, VECTOR_DIMENSION
+    from server.nlp.vector_store import (
+        WORD,
+        RedisVectorStore,
+        create_index,
+        write_document,
+    )
+
+    openai.api_key = OPENAI_API_KEY
+    corpus = [
+        {**doc, "sql_id": i}
+        for i, doc in enumerate(d for name in args.corpora for d in load_corpus(name))
+    ]
+    document_frequency = Counter(
+        word
+        for doc in corpus
+        for word in set(WORD.findall(f"{doc['question']} {doc['content']}".lower()))
+    )
+    questions = [doc["question"] for doc in corpus]
+    keywords = [keyword_query(question, document_frequency) for question in questions]
+
+    texts = [doc["question"] + " " + doc["content"] for doc in corpus]
+    base = np.random.default_rng(1).standard_normal((len(corpus), VECTOR_DIMENSION))
+    vectors = embed(texts, args, base, 0, seed=1)
+    queries = {
+        "question": (questions, embed(questions, args, vectors, args.noise, seed=2)),
+        "keywords": (
+            keywords,
+            embed(keywords, args, vectors, args.keyword_noise, seed=3),
+        ),
+    }
+    print(f"documents: {len(corpus)}, k: {args.k}")
+
+    store = RedisVectorStore()
+    store.index_name = INDEX
+    try:
+        pipeline = client.pipeline(transaction=False)
+        for doc, vector in zip(corpus, vectors):
+            doc = {key: doc[key] for key in ("source", "question", "content", "sql_id")}
+            write_document(pipeline, f"{PREFIX}{doc['sql_id']}", doc, vector, "HASH")
+        pipeline.execute()
+        create_index(len(corpus), INDEX, PREFIX, storage="HASH")
+
+        modes = {
+            "vector": lambda vectors, texts, k: store.search(vectors, k),
+            "hybrid": store.hybrid_search,
+        }
+        for kind, (texts, query_vectors) in queries.items():
+            for mode, search in modes.items():
+                recall, mrr, ms = evaluate(search, query_vectors, texts, args.k)
+                p50, p95 = np.percentile(ms, [50, 95])
+                print(
+                    f"{kind:8} {mode:6}  recall@{args.k} {recall:.3f}  MRR {mrr:.3f}  "
+                    f"p50 {p50:6.2f}ms  p95 {p95:6.2f}ms"
+                )
+    finally:
+        with contextlib.suppress(Exception):
+            client.ft(INDEX).dropindex()
+        keys = list(client.scan_iter(match=f"{PREFIX}*", count=1000))
+        for i in range(0, len(keys), 1000):
+            client.delete(*keys[i : i + 1000])
+
+
+if __name__ == "__main__":
+    main()
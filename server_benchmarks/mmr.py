@@ -0,0 +1,96 @@
+"""Benchmark maximal marginal relevance re-ranking on near-duplicate documents.
+
+Fills a NumpyVectorStore with random base documents on a shared topic, each with a
+few paraphrases (noisy copies), like FAQ entries that are worded several ways. Queries
+are noisy copies of base documents. For each lambda, reports how many distinct entries
+the top k covers, the mean similarity of the top k to the query, and the per-query
+latency of the re-ranking stage alone and of the whole search.
+
+    python -m server_benchmarks.mmr --documents 500 --paraphrases 3 --k 5
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from server_benchmarks.utils import timed, use_redis
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=500)
+    parser.add_argument("--paraphrases", type=int, default=3)
+    parser.add_argument("--entry-similarity", type=float, default=0.4)
+    parser.add_argument("--paraphrase-noise", type=float, default=0.5)
+    parser.add_argument("--query-noise", type=float, default=0.6)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--fetch-factor", type=int, default=4)
+    parser.add_argument("--lambdas", type=float, nargs="+", default=[1.0, 0.7, 0.5])
+    args = parser.parse_args()
+
+    use_redis()
+    from server.config import VECTOR_DIMENSION
+    from server.nlp.vector_store import NumpyVectorStore, normalize, rerank_mmr
+
+    rng = np.random.default_rng(0)
+
+    def noisy(vectors: np.ndarray, noise: float) -> np.ndarray:
+        scale = noise / np.sqrt(VECTOR_DIMENSION)
+        return normalize(vectors + rng.normal(0, scale, vectors.shape))
+
+    # entries share a topic vector, so they are about entry_similarity similar
+    topic = normalize(rng.standard_normal((1, VECTOR_DIMENSION)))
+    unique = normalize(rng.standard_normal((args.documents, VECTOR_DIMENSION)))
+    shared = np.sqrt(args.entry_similarity)
+    base = normalize(shared * topic + np.sqrt(1 - args.entry_similarity) * unique)
+    copies = 1 + args.paraphrases
+    embeddings = np.concatenate(
+        [base] + [noisy(base, args.paraphrase_noise) for _ in range(args.paraphrases)]
+    )
+    # document i is a wording of base document i % documents
+    corpus = [
+        {"question": f"q{i}", "content": "", "source": "", "sql_id": i}
+        for i in range(len(embeddings))
+    ]
+    store = NumpyVectorStore(lambda: ([], []), lambda: None)
+    store.search([base[0].tolist()], args.k)  # initial load
+    store.sync(corpus, embeddings)  # type: ignore
+
+    targets = rng.integers(0, args.documents, args.queries)
+    queries = noisy(base[targets], args.query_noise)
+    vectors = [[query.tolist()] for query in queries]
+    print(
+        f"documents: {len(corpus)} ({args.documents} entries x {copies} wordings), "
+        f"k: {args.k}, candidates: {args.k * args.fetch_factor}"
+    )
+
+    plain, _ = timed(
+        lambda: [store.search(vector, args.k) for vector in vectors], repeat=3
+    )
+    print(f"no re-ranking   search {plain / args.queries * 1e6:7.0f}us/query")
+
+    for lambda_mult in args.lambdas:
+        entries, relevance, stage = [], [], 0.0
+        start = time.perf_counter()
+        for vector, query in zip(vectors, queries):
+            candidates = store.search_with_vectors(vector, args.k * args.fetch_factor)
+            stage_start = time.perf_counter()
+            [result] = rerank_mmr(vector, candidates, args.k, lambda_mult)
+            stage += time.perf_counter() - stage_start
+            ids = [doc["sql_id"] for doc in result]
+            entries.append(len({sql_id % args.documents for sql_id in ids}))
+            relevance.append(np.mean(embeddings[ids] @ query))
+        total = time.perf_counter() - start
+        print(
+            f"lambda {lambda_mult:4.2f}     search {total / args.queries * 1e6:7.0f}us"
+            f"/query  stage {stage / args.queries * 1e6:6.0f}us/query  "
+            f"distinct entries {np.mean(entries):4.2f}/{args.k}  "
+            f"mean similarity {np.mean(relevance):.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Measure how much stripping quoted replies and signatures shrinks threads.
+
+Builds threads in which a hacker and the team take turns, and every email of the
+hacker quotes the whole conversation so far, the way Gmail, Outlook and Apple Mail
+quote it, with a signature on some of them. The texts come from the quote stripper
+test corpus. For each thread length, reports the tokens of the thread as sent to
+OpenAI with the newest email, with and without stripping the emails of the hacker,
+and how long stripping takes per email.
+
+    python -m server_benchmarks.quote_stripping --max-length 8
+"""
+
+import argparse
+import json
+import time
+
+from server_benchmarks.utils import use_redis
+
+CORPUS = "server_tests/quote_corpus.json"
+TEAM = "HackMIT Team <hackmit@my.hackmit.org>"
+SIGNATURE = "\n\n-- \nAlyssa P. Hacker\nMIT '26 | Course 6-3\nhttps://alyssa.dev\n"
+
+
+def quote(text: str) -> str:
+    """Quote every line of text with ">"."""
+    return "\n".join(f"> {line}" if line else ">" for line in text.splitlines())
+
+
+def reply(text: str, history: str, client: str) -> str:
+    """Write a reply with text above history, quoted the way a client quotes it."""
+    if client == "gmail":
+        header = f"On Mon, Jan 1, 2024 at 10:00 AM {TEAM} wrote:"
+        return f"{text}\n\n{header}\n\n{quote(history)}\n"
+    if client == "outlook":
+        header = (
+            f"________________________________\nFrom: {TEAM}\n"
+            "Sent: Monday, January 1, 2024 10:00 AM\nSubject: Re: HackMIT"
+        )
+        return f"{text}\n\n{header}\n\n{history}\n"
+    header = f"On Jan 1, 2024, at 10:00 AM, {TEAM} wrote:"
+    return f"{text}\n\nSent from my iPhone\n\n{quote(header)}\n>\n{quote(history)}\n"
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--max-length", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    use_redis()
+    from server.nlp.prompt_builder import count_tokens
+    from server.nlp.quote_stripper import strip_quotes
+
+    with open(CORPUS) as f:
+        texts = [
+            case["expected"] for case in json.load(f) if case["client"] != "only quote"
+        ]
+    clients = ["gmail", "outlook", "apple"]
+    answer = "Dear Alyssa,\n\n{}\n\nBest regards,\nThe HackMIT Team"
+
+    # emails of the thread, as received and as stored after stripping
+    received, stripped, history = [], [], ""
+    latencies = []
+    print("emails  tokens raw  tokens stripped  reduction")
+    for i in range(args.max_length):
+        if i % 2:
+            # the team's replies are stored as written
+            email = answer.format(f"Thanks for asking! This is answer {i // 2 + 1}.")
+            received.append(email)
+            stripped.append(email)
+            history = f"{email}\n\n{history}".strip()
+        else:
+            text = texts[(i // 2) % len(texts)]
+            if i % 4 == 0:
+                text += SIGNATURE
+            client = clients[(i // 2) % len(clients)]
+            email = reply(text, history, client) if history else text
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                strip_quotes(email)
+            latencies.append((time.perf_counter() - start) / args.repeat)
+            received.append(email)
+            stripped.append(strip_quotes(email))
+            history = email
+        raw = sum(count_tokens(email) for email in received)
+        after = sum(count_tokens(email) for email in stripped)
+        print(f"{i + 1:6}  {raw:10}  {after:15}  {1 - after / raw:9.0%}")
+
+    print(f"strip latency {sum(latencies) / len(latencies) * 1e6:.0f}us/email")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Benchmark end-to-end response generation against mocked OpenAI endpoints.
+
+The mocked chat and embeddings endpoints sleep for fixed latencies. The parse mock
+either splits the email into questions or returns the whole email, as it does for
+emails without questions. Compares the stages run one after another, always parsing
+with OpenAI, against generate_response, which splits emails locally when it can and
+otherwise embeds the email while it is being parsed. Documents are searched in a
+numpy vector store. The query embedding cache, the response cache and metrics are
+bypassed.
+
+    python -m server_benchmarks.responses --parse-latency 800 --embed-latency 150
+"""
+
+import argparse
+import asyncio
+import json
+from unittest.mock import AsyncMock, patch
+
+import numpy as np
+import openai
+from openai.types.chat import ChatCompletionMessage
+from openai.types.chat.chat_completion import ChatCompletion, Choice
+from openai.types.create_embedding_response import CreateEmbeddingResponse, Usage
+from openai.types.embedding import Embedding
+
+from server_benchmarks.utils import load_corpus, timed, use_redis
+
+EMAILS = {
+    "questions": "When is the deadline? Is there travel reimbursement?",
+    "no questions": "Thanks so much for organizing, see you at the event!",
+    "implicit": "I was wondering whether there is parking near the venue.",
+}
+
+
+def completion(content: str) -> ChatCompletion:
+    """Build a chat completion response with the given content."""
+    return ChatCompletion(
+        id="benchmark",
+        model="gpt-4o",
+        object="chat.completion",
+        choices=[
+            Choice(
+                finish_reason="stop",
+                index=0,
+                message=ChatCompletionMessage(content=content, role="assistant"),
+            )
+        ],
+        created=0,
+    )
+
+
+def mock_endpoints(args, dimension: int, split: bool):
+    """Create fake async chat and embeddings endpoints with the given latencies."""
+
+    async def chat(model, messages, **kwargs):
+        email = messages[-1]["content"]
+        if "parse incoming emails" in messages[0]["content"]:
+            await asyncio.sleep(args.parse_latency / 1000)
+            questions = email.replace("?", "?|").split("|")[:-1] if split else [email]
+            return completion(json.dumps({"questions": [q.strip() for q in questions]}))
+        await asyncio.sleep(args.response_latency / 1000)
+        return completion("Dear Hacker, ...")
+
+    rng = np.random.default_rng(0)
+
+    async def embeddings(input, model, **kwargs):
+        await asyncio.sleep(args.embed_latency / 1000)
+        return CreateEmbeddingResponse(
+            model=model,
+            object="list",
+            data=[
+                Embedding(
+                    embedding=rng.standard_normal(dimension).tolist(),
+                    index=i,
+                    object="embedding",
+                )
+                for i in range(len(input))
+            ],
+            usage=Usage(prompt_tokens=0, total_tokens=0),
+        )
+
+    return chat, embeddings
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--parse-latency", type=float, default=800, help="ms")
+    parser.add_argument("--response-latency", type=float, default=1500, help="ms")
+    parser.add_argument("--embed-latency", type=float, default=150, help="ms")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # the mocked endpoints never check the key, but the openai client requires one
+    openai.api_key = openai.api_key or "benchmark"
+    use_redis()
+    from server.config import VECTOR_DIMENSION
+    from server.nlp import embeddings, responses
+    from server.nlp.async_clients import run
+    from server.nlp.vector_store import NumpyVectorStore
+
+    corpus = load_corpus("mit") + load_corpus("harvard")
+    corpus = [{**doc, "sql_id": i} for i, doc in enumerate(corpus)]
+    rng = np.random.default_rng(1)
+    store = NumpyVectorStore(
+        lambda: (corpus, rng.standard_normal((len(corpus), VECTOR_DIMENSION)).tolist()),
+        lambda: len(corpus),
+    )
+    store.search([[1.0] * VECTOR_DIMENSION], 1)  # initial load
+
+    def lookup(questions):
+        texts = [embeddings.normalize_question(question) for question in questions]
+        return texts, {}, list(dict.fromkeys(texts))
+
+    async def sequential(email: str):
+        questions = await responses.aopenai_parse(email)
+        await embeddings.aquery_all(5, questions)
+        await responses.aopenai_response([], "hacker@example.com")
+
+    for kind, email in EMAILS.items():
+        chat, embed = mock_endpoints(args, VECTOR_DIMENSION, kind == "questions")
+        with patch.object(embeddings, "vector_store", store), patch.object(
+            embeddings, "_lookup_query_embeddings", lookup
+        ), patch.object(embeddings, "cache_query_embeddings"), patch.object(
+            responses, "aincrement", AsyncMock()
+        ), patch.object(responses, "RESPONSE_CACHE_ENABLED", False), patch(
+            "openai.resources.chat.completions.AsyncCompletions.create",
+            new=AsyncMock(side_effect=chat),
+        ), patch(
+            "openai.resources.embeddings.AsyncEmbeddings.create",
+            new=AsyncMock(side_effect=embed),
+        ):
+            before, _ = timed(
+                lambda email=email: run(sequential(email)), repeat=args.repeat
+            )
+            after, _ = timed(
+                responses.generate_response,
+                "hacker@example.com",
+                email,
+                repeat=args.repeat,
+            )
+        print(
+            f"{kind:12}  sequential {before * 1000:7.0f}ms  "
+            f"pipelined {after * 1000:7.0f}ms  saved {(before - after) * 1000:5.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Utils for benchmarks."""
+
+import json
+import os
+import time
+
+import redis
+
+import server
+
+CORPORA = {
+    "mit": "server/nlp/corpus_mit.json",
+    "harvard": "server/nlp/corpus_harvard.json",
+    "flask_seed": "server/nlp/corpus_flask_seed.json",
+}
+
+
+def load_corpus(name: str) -> list[dict]:
+    """Load one of the bundled corpora by name."""
+    with open(CORPORA[name]) as f:
+        return json.load(f)
+
+
+def use_redis(host: str | None = None) -> redis.Redis:
+    """Point the server's redis client at the given host.
+
+    server.nlp modules expect create_app to have set up the redis client. Benchmarks
+    don't need the rest of the app, so they only set up the client. The client does
+    not connect until it is first used.
+    """
+    host = host or os.environ.get("REDIS_HOST", "localhost")
+    server.redis_client = redis.Redis(host=host, port=6379, decode_responses=True)
+    server.redis_binary_client = redis.Redis(host=host, port=6379)
+    return server.redis_client
+
+
+def timed(func, *args, repeat: int = 1, **kwargs) -> tuple[float, object]:
+    """Run func repeat times, returning the mean wall time in seconds and result."""
+    result = None
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args, **kwargs)
+    return (time.perf_counter() - start) / repeat, result
@@ -0,0 +1,140 @@
+"""Compare HNSW and FLAT vector indexes on the bundled corpora.
+
+Loads the bundled corpora into a scratch key prefix in redis, builds a FLAT and an
+HNSW index over the same documents, and reports query latency and the recall@k of
+HNSW against the exact FLAT results. The bundled corpora are small, so --replicas adds
+noisy copies of every document to simulate a larger corpus.
+
+Needs a redis stack server, and an OpenAI key unless --synthetic is passed.
+
+    python -m server_benchmarks.vector_index --replicas 50 --k 5
+"""
+
+import argparse
+import contextlib
+import time
+
+import numpy as np
+import openai
+
+from server_benchmarks.utils import CORPORA, load_corpus, use_redis
+
+PREFIX = "bench:documents:"
+INDEXES = {"FLAT": "idx:bench_flat", "HNSW": "idx:bench_hnsw"}
+
+
+def embed(texts: list[str], synthetic: bool, dimension: int, seed: int) -> np.ndarray:
+    """Embed texts with OpenAI, or with random vectors if synthetic."""
+    if synthetic:
+        rng = np.random.default_rng(seed)
+        vectors = rng.standard_normal((len(texts), dimension))
+    else:
+        from server.nlp.embeddings import compute_openai_embeddings
+
+        vectors = np.array(compute_openai_embeddings(texts))
+    vectors = vectors.astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def perturb(vectors: np.ndarray, noise: float, rng) -> np.ndarray:
+    """Add gaussian noise to normalized vectors and renormalize."""
+    noisy = vectors + rng.normal(0, noise / np.sqrt(vectors.shape[1]), vectors.shape)
+    noisy = noisy.astype(np.float32)
+    return noisy / np.linalg.norm(noisy, axis=1, keepdims=True)
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpora", nargs="+", default=["mit", "harvard"])
+    parser.add_argument("--replicas", type=int, default=50)
+    parser.add_argument("--noise", type=float, default=0.3)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--redis-host", default=None)
+    args = parser.parse_args()
+    assert all(name in CORPORA for name in args.corpora)
+
+    client = use_redis(args.redis_host)
+    from server.config import OPENAI_API_KEY, VECTOR_DIMENSION
+    from server.nlp.vector_store import create_index, create_query
+
+    openai.api_key = OPENAI_API_KEY
+    rng = np.random.default_rng(0)
+
+    corpus = [doc for name in args.corpora for doc in load_corpus(name)]
+    texts = [doc["question"] + " " + doc["content"] for doc in corpus]
+    questions = [doc["question"] for doc in corpus]
+    base = embed(texts, args.synthetic, VECTOR_DIMENSION, seed=1)
+    if args.synthetic:
+        query_vectors = perturb(base, args.noise, rng)
+    else:
+        query_vectors = embed(questions, False, VECTOR_DIMENSION, seed=2)
+
+    vectors = np.concatenate(
+        [base] + [perturb(base, args.noise, rng) for _ in range(args.replicas)]
+    )
+    print(f"documents: {len(vectors)}, queries: {len(query_vectors)}, k: {args.k}")
+
+    try:
+        pipeline = client.pipeline(transaction=False)
+        for i, vector in enumerate(vectors):
+            doc = corpus[i % len(corpus)]
+            pipeline.json().set(
+                f"{PREFIX}{i}",
+                "$",
+                {
+                    "source": doc["source"],
+                    "question": doc["question"],
+                    "content": doc["content"],
+                    "sql_id": i,
+                    "question_and_content_embeddings": vector.tolist(),
+                },
+            )
+            if i % 500 == 0:
+                pipeline.execute()
+        pipeline.execute()
+
+        for algorithm, index_name in INDEXES.items():
+            start = time.perf_counter()
+            create_index(len(vectors), index_name, PREFIX, algorithm)
+            print(f"{algorithm} build: {time.perf_counter() - start:.2f}s")
+
+        query = create_query(args.k)
+        results: dict[str, list[set[str]]] = {}
+        latencies: dict[str, list[float]] = {}
+        for algorithm, index_name in INDEXES.items():
+            results[algorithm] = []
+            latencies[algorithm] = []
+            for vector in query_vectors:
+                params = {"query_vector": vector.tobytes()}
+                start = time.perf_counter()
+                docs = client.ft(index_name).search(query, params).docs  # type: ignore
+                latencies[algorithm].append(time.perf_counter() - start)
+                results[algorithm].append({doc.id for doc in docs})
+
+        recall = np.mean(
+            [
+                len(hnsw & flat) / max(len(flat), 1)
+                for hnsw, flat in zip(results["HNSW"], results["FLAT"])
+            ]
+        )
+        for algorithm, times in latencies.items():
+            ms = np.array(times) * 1000
+            p50, p95 = np.percentile(ms, [50, 95])
+            print(
+                f"{algorithm:5} mean {ms.mean():6.2f}ms  p50 {p50:6.2f}ms  "
+                f"p95 {p95:6.2f}ms"
+            )
+        print(f"HNSW recall@{args.k} vs FLAT: {recall:.3f}")
+    finally:
+        for index_name in INDEXES.values():
+            with contextlib.suppress(Exception):
+                client.ft(index_name).dropindex()
+        keys = list(client.scan_iter(match=f"{PREFIX}*", count=1000))
+        for i in range(0, len(keys), 1000):
+            client.delete(*keys[i : i + 1000])
+
+
+if __name__ == "__main__":
+    main()
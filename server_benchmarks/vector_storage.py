@@ -0,0 +1,87 @@
+"""Compare the redis memory footprint of JSON and HASH document storage.
+
+Loads the bundled corpora into scratch key prefixes in redis, once as JSON documents
+with embeddings as float arrays and once as HASH documents with packed float32
+embeddings, indexes both, and reports the memory used by the documents and the
+index build time. --replicas repeats the corpora to size larger instances.
+
+Needs a redis stack server. Embeddings are random unit vectors of the configured
+dimension, which take as much space as real ones.
+
+    python -m server_benchmarks.vector_storage --replicas 10
+"""
+
+import argparse
+import contextlib
+import time
+
+import numpy as np
+
+from server_benchmarks.utils import CORPORA, load_corpus, use_redis
+
+PREFIXES = {"JSON": "bench_json:documents:", "HASH": "bench_hash:documents:"}
+INDEXES = {"JSON": "idx:bench_json", "HASH": "idx:bench_hash"}
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpora", nargs="+", default=list(CORPORA))
+    parser.add_argument("--replicas", type=int, default=1)
+    parser.add_argument("--redis-host", default=None)
+    args = parser.parse_args()
+    assert all(name in CORPORA for name in args.corpora)
+
+    client = use_redis(args.redis_host)
+    from server.config import VECTOR_DIMENSION
+    from server.nlp.vector_store import create_index, normalize, write_document
+
+    corpus = [doc for name in args.corpora for doc in load_corpus(name)]
+    rng = np.random.default_rng(0)
+    size = len(corpus) * args.replicas
+    # openai returns python floats, so the JSON documents store float64 reprs
+    embeddings = normalize(rng.standard_normal((size, VECTOR_DIMENSION)))
+    embeddings = embeddings.astype(np.float64).tolist()
+    print(f"documents: {size}, dimension: {VECTOR_DIMENSION}")
+
+    try:
+        for storage, prefix in PREFIXES.items():
+            pipeline = client.pipeline(transaction=False)
+            for i, embedding in enumerate(embeddings):
+                doc = corpus[i % len(corpus)]
+                doc = {
+                    "source": doc["source"],
+                    "question": doc["question"],
+                    "content": doc["content"],
+                    "sql_id": i,
+                }
+                write_document(pipeline, f"{prefix}{i}", doc, embedding, storage)
+                if i % 500 == 0:
+                    pipeline.execute()
+            pipeline.execute()
+
+            start = time.perf_counter()
+            create_index(size, INDEXES[storage], prefix, "FLAT", storage)
+            build = time.perf_counter() - start
+
+            pipeline = client.pipeline(transaction=False)
+            for i in range(size):
+                pipeline.memory_usage(f"{prefix}{i}", samples=0)
+            total = sum(pipeline.execute())
+            print(
+                f"{storage:4}  documents {total / 2**20:8.2f}MiB  "
+                f"per document {total / size / 1024:6.2f}KiB  "
+                f"index build {build:6.2f}s"
+            )
+    finally:
+        for index_name in INDEXES.values():
+            with contextlib.suppress(Exception):
+                client.ft(index_name).dropindex()
+        for prefix in PREFIXES.values():
+            keys = list(client.scan_iter(match=f"{prefix}*", count=1000))
+            for i in range(0, len(keys), 1000):
+                client.delete(*keys[i : i + 1000])
+
+
+if __name__ == "__main__":
+    main()
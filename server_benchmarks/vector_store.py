@@ -0,0 +1,55 @@
+"""Benchmark KNN latency of the in-memory numpy vector store.
+
+Fills a NumpyVectorStore with random documents of the configured dimension and times
+single-question and multi-question searches. For RediSearch latency on the same
+corpora, see server_benchmarks.vector_index.
+
+    python -m server_benchmarks.vector_store --sizes 1000 5000 20000 --precision int8
+"""
+
+import argparse
+
+import numpy as np
+
+from server_benchmarks.utils import timed, use_redis
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--precision", choices=["float32", "int8"], default="float32")
+    args = parser.parse_args()
+
+    use_redis()
+    from server.config import VECTOR_DIMENSION
+    from server.nlp.vector_store import NumpyVectorStore
+
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        corpus = [
+            {"question": f"q{i}", "content": "", "source": "", "sql_id": i}
+            for i in range(size)
+        ]
+        embeddings = rng.standard_normal((size, VECTOR_DIMENSION)).astype(np.float32)
+        store = NumpyVectorStore(
+            lambda: ([], []), lambda: None, precision=args.precision
+        )
+        store.search([embeddings[0].tolist()], args.k)  # initial load
+        store.sync(corpus, embeddings)  # type: ignore
+
+        one = [embeddings[1].tolist()]
+        six = embeddings[:6].tolist()
+        single, _ = timed(store.search, one, args.k, repeat=args.repeat)
+        multi, _ = timed(store.search, six, args.k, repeat=args.repeat)
+        print(
+            f"{size:6} docs  1 question {single * 1e6:8.0f}us  "
+            f"6 questions {multi * 1e6:8.0f}us  "
+            f"matrix {store.nbytes / 2**20:6.1f}MiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
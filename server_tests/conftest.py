@@ -1,7 +1,7 @@
 import datetime
 import os
 from typing import cast
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 
 import openai
 import psycopg2
@@ -75,8 +75,12 @@ def mock_openai_chat_completion():
     # be able to access the mocks when seeding the database with test data.
     openai.api_key = "dummy_key"
 
-    with patch("openai.chat.completions.create") as mock:
-        mock.return_value = ChatCompletion(
+    # patch the methods of both client classes, so every client instance is mocked
+    with patch("openai.resources.chat.completions.Completions.create") as mock, patch(
+        "openai.resources.chat.completions.AsyncCompletions.create",
+        new_callable=AsyncMock,
+    ) as async_mock:
+        mock.return_value = async_mock.return_value = ChatCompletion(
             id="foo",
             model="gpt-3.5-turbo",
             object="chat.completion",
@@ -98,22 +102,31 @@ def mock_openai_chat_completion():
 @pytest.fixture(scope="session")
 def mock_openai_embeddings():
     """Mock the OpenAI embeddings API."""
-    with patch("openai.embeddings.create") as mock:
-        mock.return_value = CreateEmbeddingResponse(
+
+    def create_embeddings(input, **kwargs):
+        # embeddings are requested in batches, so return one embedding per input
+        texts = [input] if isinstance(input, str) else input
+        return CreateEmbeddingResponse(
             model="gpt-3.5-turbo",
             object="list",
             data=[
                 Embedding(
                     embedding=[0.1 for _ in range(VECTOR_DIMENSION)],
-                    index=0,
+                    index=i,
                     object="embedding",
                 )
+                for i in range(len(texts))
             ],
             usage=Usage(
                 prompt_tokens=10,
                 total_tokens=10,
             ),
         )
+
+    with patch("openai.resources.embeddings.Embeddings.create") as mock, patch(
+        "openai.resources.embeddings.AsyncEmbeddings.create", new_callable=AsyncMock
+    ) as async_mock:
+        mock.side_effect = async_mock.side_effect = create_embeddings
         yield mock
 
 
@@ -123,6 +136,9 @@ def app(
 ):
     os.environ["DATABASE_URL"] = db_url
     os.environ["REDIS_HOST"] = redis_host
+    # response jobs are run by the tests themselves, in the test transaction
+    os.environ["JOB_QUEUE"] = "memory"
+    os.environ["JOB_WORKERS"] = "0"
 
     app = create_app()
     app.config.update(
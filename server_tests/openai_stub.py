@@ -0,0 +1,88 @@
+"""Local stub of the OpenAI chat completions API for testing."""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMPLETION = {
+    "id": "stub",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4o",
+    "choices": [
+        {
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": "stubbed openai message!"},
+        }
+    ],
+}
+
+
+class OpenAIStub:
+    """Serves chat completions on a local port, failing the first requests.
+
+    Use as a context manager, and point an OpenAI client at url.
+    """
+
+    def __init__(
+        self,
+        failures: list[int] | None = None,
+        retry_after: str | None = None,
+        latency: float = 0,
+    ):
+        """Create the stub.
+
+        Args:
+            failures: status codes to respond to the first requests with, in order
+            retry_after: Retry-After header to send with failures
+            latency: seconds to wait before responding
+        """
+        self.failures = list(failures or [])
+        self.retry_after = retry_after
+        self.latency = latency
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):  # noqa: N802
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with stub._lock:
+                    stub.requests += 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                    status = stub.failures.pop(0) if stub.failures else 200
+                time.sleep(stub.latency)
+                with stub._lock:
+                    stub.in_flight -= 1
+
+                body = COMPLETION if status == 200 else {"error": {"message": "stub"}}
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if status != 200 and stub.retry_after is not None:
+                    self.send_header("Retry-After", stub.retry_after)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -1,8 +1,16 @@
+import json
+from unittest.mock import AsyncMock, Mock, patch
+
+import pytest
 from apiflask import APIFlask
 from flask.testing import FlaskClient
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice, ChoiceDelta
+from redis.exceptions import RedisError
 from sqlalchemy import select
 
 from server import db
+from server.models.email import Email
 from server.models.thread import Thread
 from server_tests.utils import assert_status
 
@@ -65,3 +73,173 @@ def test_get_response(app: APIFlask, client: FlaskClient):
             assert doc["confidence"] is not None
             assert doc["content"] is not None
             assert doc["source"] is not None
+
+
+def test_regen_response_stream(
+    app: APIFlask, client: FlaskClient, mock_openai_chat_completion
+):
+    """Test streaming a regenerated response."""
+    pieces = ["Dear Andrew,", "\n\nHackMIT is ", "a hackathon."]
+
+    async def chunks():
+        for piece in pieces:
+            yield ChatCompletionChunk(
+                id="foo",
+                model="gpt-4o",
+                object="chat.completion.chunk",
+                created=0,
+                choices=[Choice(index=0, delta=ChoiceDelta(content=piece))],
+            )
+
+    def create(**kwargs):
+        if kwargs.get("stream"):
+            return chunks()
+        return mock_openai_chat_completion.return_value
+
+    with patch(
+        "openai.resources.chat.completions.AsyncCompletions.create",
+        new_callable=AsyncMock,
+        side_effect=create,
+    ):
+        response = client.post("/api/emails/regen_response_stream", data={"id": 1})
+        assert_status(response, 200)
+        body = response.get_data(as_text=True)
+
+    events = [
+        (lines[0].removeprefix("event: "), json.loads(lines[1].removeprefix("data: ")))
+        for lines in (event.split("\n") for event in body.strip().split("\n\n"))
+    ]
+    assert [data["content"] for name, data in events if name == "token"] == pieces
+    name, data = events[-1]
+    assert name == "done"
+    assert data["content"] == "".join(pieces)
+
+    response = client.post("/api/emails/get_response", data={"id": 5})
+    assert_status(response, 200)
+    assert response.json is not None
+    assert response.json["content"] == "".join(pieces)
+
+
+def test_receive_email(app: APIFlask, client: FlaskClient):
+    """Test that received emails are answered by a background job."""
+    from server import job_queue
+    from server.controllers.emails import respond_to_email
+    from server.jobs import run_job
+
+    assert job_queue is not None
+    response = client.post(
+        "/api/emails/receive_email",
+        data={
+            "From": "Ben Bitdiddle <ben@mit.edu>",
+            "Subject": "Deadline",
+            "stripped-text": "When is the application deadline?",
+            "Message-Id": "<deadline@mit.edu>",
+        },
+    )
+    assert_status(response, 200)
+
+    with app.app_context():
+        email = db.session.execute(
+            select(Email).where(Email.message_id == "<deadline@mit.edu>")
+        ).scalar_one()
+        email_id, thread_id = email.id, email.thread_id
+
+    response = client.post("/api/emails/get_response", data={"id": email_id})
+    assert_status(response, 202)
+    assert response.json is not None
+    assert response.json["status"] == "queued"
+
+    # regenerating a response that is still queued doesn't enqueue it again
+    response = client.post("/api/emails/regen_response_stream", data={"id": thread_id})
+    assert_status(response, 202)
+    job = job_queue.pop(timeout=0)
+    assert job is not None
+    assert job_queue.pop(timeout=0) is None
+    with app.app_context():
+        run_job(job_queue, job, respond_to_email)
+    assert job_queue.status(email_id) == "done"
+
+    response = client.post("/api/emails/get_response", data={"id": email_id})
+    assert_status(response, 200)
+    assert response.json is not None
+    assert response.json["content"] == "mocked openai message!"
+
+
+def test_receive_email_strips_quotes(app: APIFlask, client: FlaskClient):
+    """Test that received emails are stored with a stripped copy of their body."""
+    body = (
+        "Can I bring a friend?\n\nOn Mon, Jan 1, 2024 at 10:00 AM HackMIT Team "
+        "<hackmit@my.hackmit.org> wrote:\n\n> Teams can have up to 4 people."
+        "\n________________________________\nOld Outlook thread"
+    )
+    response = client.post(
+        "/api/emails/receive_email",
+        data={
+            "From": "Ben Bitdiddle <ben@mit.edu>",
+            "Subject": "Teams",
+            "stripped-text": body,
+            "Message-Id": "<friend@mit.edu>",
+        },
+    )
+    assert_status(response, 200)
+
+    with app.app_context():
+        email = db.session.execute(
+            select(Email).where(Email.message_id == "<friend@mit.edu>")
+        ).scalar_one()
+        # organizers see the quoted history up to the outlook separator
+        assert email.body.startswith("Can I bring a friend?")
+        assert email.body.endswith("> Teams can have up to 4 people.\n")
+        assert email.prompt_body == "Can I bring a friend?"
+
+
+def test_receive_duplicate_email(app: APIFlask, client: FlaskClient):
+    """Test that duplicate deliveries of an email are only stored once."""
+    from server import redis_client
+
+    assert redis_client is not None
+    data = {
+        "From": "Alyssa Hacker <alyssa@mit.edu>",
+        "Subject": "Travel",
+        "stripped-text": "Do you reimburse travel?",
+        "Message-Id": "<travel@mit.edu>",
+    }
+    for _ in range(2):
+        assert_status(client.post("/api/emails/receive_email", data=data), 200)
+    # once redis forgets the email, the unique index still rejects it
+    redis_client.delete("emails:seen:<travel@mit.edu>")
+    assert_status(client.post("/api/emails/receive_email", data=data), 200)
+
+    with app.app_context():
+        emails = db.session.execute(
+            select(Email).where(Email.message_id == "<travel@mit.edu>")
+        ).scalars()
+        assert len(emails.all()) == 1
+        assert len(db.session.execute(select(Thread)).scalars().all()) == 2
+
+
+def test_receive_email_enqueue_failure(
+    app: APIFlask, client: FlaskClient, monkeypatch: pytest.MonkeyPatch
+):
+    """Test that a redelivery enqueues an email stored by a delivery that failed."""
+    from server import job_queue
+
+    assert job_queue is not None
+    data = {
+        "From": "Ben Bitdiddle <ben@mit.edu>",
+        "Subject": "Teams",
+        "stripped-text": "How big can teams be?",
+        "Message-Id": "<teams@mit.edu>",
+    }
+    enqueue = job_queue.enqueue
+    monkeypatch.setattr(job_queue, "enqueue", Mock(side_effect=RedisError("down")))
+    with pytest.raises(RedisError):
+        client.post("/api/emails/receive_email", data=data)
+
+    monkeypatch.setattr(job_queue, "enqueue", enqueue)
+    assert_status(client.post("/api/emails/receive_email", data=data), 200)
+    with app.app_context():
+        email = db.session.execute(
+            select(Email).where(Email.message_id == "<teams@mit.edu>")
+        ).scalar_one()
+        assert job_queue.status(email.id) == "queued"
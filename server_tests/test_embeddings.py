@@ -0,0 +1,93 @@
+from apiflask import APIFlask
+from flask.testing import FlaskClient
+
+from server_tests.utils import assert_status
+
+
+def test_batch_texts():
+    """Test that batches are capped by item count and estimated tokens."""
+    # server modules need the redis client, which is only set up with the app
+    from server.nlp.embeddings import batch_texts
+
+    assert batch_texts([]) == []
+    assert batch_texts(["a"] * 5, max_items=2) == [[0, 1], [2, 3], [4]]
+    # "a" * 39 is estimated at 10 tokens
+    texts = ["a" * 39] * 5
+    assert batch_texts(texts, max_tokens=25) == [[0, 1], [2, 3], [4]]
+    assert batch_texts(texts, max_tokens=30) == [[0, 1, 2], [3, 4]]
+
+
+def test_batch_texts_long_text():
+    """Test that a text over the token cap gets a batch of its own."""
+    from server.nlp.embeddings import batch_texts
+
+    texts = ["short", "a" * 1000, "short"]
+    assert batch_texts(texts, max_tokens=100) == [[0], [1], [2]]
+
+
+def test_compute_cached_embeddings(app: APIFlask):
+    """Test counting the embedding cache hits and misses of a call."""
+    with app.app_context():
+        from server.nlp.embeddings import compute_cached_embeddings
+
+        stats: dict[str, int] = {}
+        [miss] = compute_cached_embeddings(["Where is the venue? Stata"], stats)
+        assert stats == {"hits": 0, "misses": 1}
+
+        stats = {}
+        [hit] = compute_cached_embeddings(["Where is the venue? Stata"], stats)
+        assert stats == {"hits": 1, "misses": 0}
+        assert hit == miss
+
+
+def test_evict_unreferenced_embeddings(app: APIFlask):
+    """Test that cached embeddings no document references are evicted."""
+    with app.app_context():
+        from server.nlp.embedding_cache import (
+            embedding_key,
+            evict_unreferenced_embeddings,
+            get_cached_embeddings,
+        )
+        from server.nlp.embeddings import cache_model, compute_cached_embeddings
+
+        text = "Is there parking? No"
+        compute_cached_embeddings([text])
+        key = embedding_key(cache_model, text)
+        assert key in get_cached_embeddings([key])
+
+        assert evict_unreferenced_embeddings(cache_model) >= 1
+        assert get_cached_embeddings([key]) == {}
+
+
+def test_update_embeddings(client: FlaskClient):
+    """Test that updating embeddings reports the cache hits and misses of the call."""
+    response = client.get("/api/admin/update_embeddings")
+    assert_status(response, 200)
+    # the seeded documents are embedded already
+    assert response.json is not None
+    assert response.json["embedding_cache"]["misses"] == 0
+    assert response.json["embedding_cache"]["hits"] > 0
+
+
+def test_query_embedding_cache_hit_refreshes_ttl(app: APIFlask):
+    """Test that a query embedding cache hit refreshes the TTL of the entry."""
+    from typing import cast
+
+    with app.app_context():
+        from server import redis_client
+        from server.config import QUERY_EMBEDDING_CACHE_TTL
+        from server.nlp.embedding_cache import (
+            cache_query_embeddings,
+            embedding_key,
+            get_cached_query_embeddings,
+            query_cache_prefix,
+        )
+
+        assert redis_client is not None
+        text = "how big can teams be?"
+        key = query_cache_prefix + embedding_key("test-model", text)
+        cache_query_embeddings("test-model", [text], [[0.5, 0.5]])
+        redis_client.expire(key, 10)
+
+        assert get_cached_query_embeddings("test-model", [text]) == {text: [0.5, 0.5]}
+        assert cast(int, redis_client.ttl(key)) > QUERY_EMBEDDING_CACHE_TTL - 60
@@ -0,0 +1,61 @@
+import pytest
+from apiflask import APIFlask
+
+
+def test_enqueue_skips_pending_jobs():
+    """Test that emails whose job is queued or running aren't enqueued again."""
+    from server.jobs import DONE, QUEUED, RUNNING, InProcessJobQueue
+
+    job_queue = InProcessJobQueue()
+    assert job_queue.enqueue(1)
+    assert not job_queue.enqueue(1)
+    job_queue.set_status(1, RUNNING)
+    assert not job_queue.enqueue(1)
+    job_queue.set_status(1, DONE)
+    assert job_queue.enqueue(1)
+    assert job_queue.statuses([1, 2]) == [QUEUED, None]
+
+
+def test_requeue_stale_jobs(app: APIFlask, monkeypatch: pytest.MonkeyPatch):
+    """Test that jobs whose worker was lost are moved back to the queue."""
+    from server import redis_client
+    from server.jobs import QUEUED, RUNNING, RedisJobQueue
+
+    assert redis_client is not None
+    job_queue = RedisJobQueue()
+    redis_client.delete(job_queue.queue_key, job_queue.processing_key)
+    # jobs without a lease are requeued as soon as they are seen
+    monkeypatch.setattr("server.jobs.JOB_POLL_SECONDS", 0)
+
+    job_queue.enqueue(1)
+    job = job_queue.pop(timeout=1)
+    assert job is not None
+    job_queue.set_status(1, RUNNING)
+    assert job_queue.requeue_stale() == 0
+
+    # the worker died, and its lease expired
+    redis_client.delete(job_queue._lease_key(job))
+    assert job_queue.requeue_stale() == 1
+    assert job_queue.status(1) == QUEUED
+
+    assert job_queue.pop(timeout=1) == job
+    job_queue.ack(job)
+    assert redis_client.llen(job_queue.processing_key) == 0
+    assert job_queue.requeue_stale() == 0
+
+
+def test_enqueue_is_atomic(app: APIFlask):
+    """Test that concurrent enqueues of the same email push one job."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from server import redis_client
+    from server.jobs import RedisJobQueue
+
+    assert redis_client is not None
+    job_queue = RedisJobQueue()
+    redis_client.delete(job_queue.queue_key, f"{job_queue.status_prefix}2")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        enqueued = list(executor.map(lambda _: job_queue.enqueue(2), range(8)))
+    assert enqueued.count(True) == 1
+    assert redis_client.llen(job_queue.queue_key) == 1
+    redis_client.delete(job_queue.queue_key, f"{job_queue.status_prefix}2")
@@ -0,0 +1,93 @@
+import io
+
+from apiflask import APIFlask
+from sqlalchemy import select
+
+from server import db
+from server.models.email import Email
+from server.models.thread import Thread
+
+MBOX = b"""From alyssa@mit.edu Mon Jan  1 15:00:00 2024
+From: Alyssa Hacker <alyssa@mit.edu>
+Subject: Travel
+Message-Id: <travel@mit.edu>
+Date: Mon, 1 Jan 2024 10:00:00 -0500
+
+Do you reimburse travel?
+>From the bay area, that is.
+
+From hackmit@my.hackmit.org Mon Jan  1 16:00:00 2024
+From: "HackMIT Team" <hackmit@my.hackmit.org>
+Subject: Re: Travel
+Message-Id: <travel-reply@ses.com>
+In-Reply-To: <travel@mit.edu>
+References: <travel@mit.edu>
+Date: Mon, 1 Jan 2024 11:00:00 -0500
+Content-Type: text/html
+
+<p>Yes, we do!</p>
+________________________________
+Do you reimburse travel?
+
+From ben@mit.edu Tue Jan  2 15:00:00 2024
+From: Ben Bitdiddle <ben@mit.edu>
+Subject: Teams
+Message-Id: <teams@mit.edu>
+Date: Tue, 2 Jan 2024 10:00:00 -0500
+
+How big can teams be?
+"""
+
+
+def test_parse_mbox(app: APIFlask):
+    """Test reading the messages of an mbox file."""
+    with app.app_context():
+        from server.mail_import import iter_mbox, parse_message
+
+        emails = [parse_message(raw) for raw in iter_mbox(io.BytesIO(MBOX))]
+    assert [email["message_id"] for email in emails] == [
+        "<travel@mit.edu>",
+        "<travel-reply@ses.com>",
+        "<teams@mit.edu>",
+    ]
+    assert emails[0]["body"] == "Do you reimburse travel?\nFrom the bay area, that is."
+    # bodies are stored with their quoted history, next to a stripped copy for prompts
+    assert emails[1]["body"].startswith("Yes, we do!")
+    assert emails[1]["body"].endswith("Do you reimburse travel?")
+    assert emails[1]["stripped_body"] == "Yes, we do!"
+    assert emails[1]["parents"] == ["<travel@mit.edu>"]
+    assert [email["is_reply"] for email in emails] == [False, True, False]
+
+
+def test_import_mailbox(app: APIFlask):
+    """Test importing a mailbox into threads, and importing it again."""
+    with app.app_context():
+        from server.mail_import import enqueue_drafts, import_mailbox, iter_mbox
+
+        threads = len(db.session.execute(select(Thread)).scalars().all())
+        imported_threads: set[int] = set()
+        counts = import_mailbox(
+            iter_mbox(io.BytesIO(MBOX)), batch_size=2, imported_threads=imported_threads
+        )
+        assert counts["imported"] == 3
+        assert counts["threads"] == 2
+        assert len(imported_threads) == 2
+
+        reply = db.session.execute(
+            select(Email).where(Email.message_id == "<travel-reply@ses.com>")
+        ).scalar_one()
+        thread = db.session.execute(
+            select(Thread).where(Thread.id == reply.thread_id)
+        ).scalar_one()
+        assert len(thread.emails) == 2
+        assert thread.last_email == reply.id
+        assert thread.resolved
+
+        counts = import_mailbox(iter_mbox(io.BytesIO(MBOX)))
+        assert counts["imported"] == 0
+        assert counts["duplicates"] == 3
+        assert len(db.session.execute(select(Thread)).scalars().all()) == threads + 2
+
+        # only the unresolved thread gets a draft, and only once
+        assert enqueue_drafts(imported_threads) == 1
+        assert enqueue_drafts(imported_threads) == 0
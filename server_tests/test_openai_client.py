@@ -0,0 +1,153 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import pytest
+from openai.resources.chat.completions import AsyncCompletions, Completions
+
+from server_tests.openai_stub import OpenAIStub
+
+# the client methods are mocked once the app is set up, so keep the real one around to
+# send requests to the stub
+create_completion = Completions.create
+acreate_completion = AsyncCompletions.create
+
+MESSAGES = [{"role": "user", "content": "When is the deadline?"}]
+
+
+def send(client: openai.OpenAI):
+    from server.nlp.openai_client import openai_request
+
+    return openai_request(
+        create_completion, client.chat.completions, model="gpt-4o", messages=MESSAGES
+    )
+
+
+def test_retries(monkeypatch: pytest.MonkeyPatch):
+    """Test that rate limited requests and server errors are retried."""
+    from server.nlp import openai_client
+
+    monkeypatch.setattr(openai_client, "OPENAI_RETRY_BASE_SECONDS", 0.01)
+    with OpenAIStub(failures=[429, 500], retry_after="0") as stub:
+        response = send(openai_client.create_openai_client(stub.url))
+    assert response.choices[0].message.content == "stubbed openai message!"
+    assert stub.requests == 3
+
+
+def test_retry_after(monkeypatch: pytest.MonkeyPatch):
+    """Test that retries wait at least as long as the Retry-After header asks."""
+    from server.nlp import openai_client
+
+    monkeypatch.setattr(openai_client, "OPENAI_RETRY_BASE_SECONDS", 0.01)
+    with OpenAIStub(failures=[429], retry_after="0.5") as stub:
+        start = time.perf_counter()
+        send(openai_client.create_openai_client(stub.url))
+    assert time.perf_counter() - start >= 0.5
+    assert stub.requests == 2
+
+
+def test_gives_up(monkeypatch: pytest.MonkeyPatch):
+    """Test that requests fail once they run out of retries."""
+    from server.nlp import openai_client
+
+    monkeypatch.setattr(openai_client, "OPENAI_RETRY_BASE_SECONDS", 0.01)
+    monkeypatch.setattr(openai_client, "OPENAI_MAX_RETRIES", 2)
+    with OpenAIStub(failures=[503] * 5) as stub, pytest.raises(
+        openai.InternalServerError
+    ):
+        send(openai_client.create_openai_client(stub.url))
+    assert stub.requests == 3
+
+
+def test_concurrency_cap(monkeypatch: pytest.MonkeyPatch):
+    """Test that only a limited number of requests are sent at once."""
+    from server.nlp import openai_client
+
+    monkeypatch.setattr(openai_client, "_semaphore", threading.BoundedSemaphore(2))
+    with OpenAIStub(latency=0.05) as stub:
+        client = openai_client.create_openai_client(stub.url)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: send(client), range(8)))
+    assert stub.requests == 8
+    assert stub.max_in_flight == 2
+
+
+def test_concurrency_cap_shared(monkeypatch: pytest.MonkeyPatch):
+    """Test that sync and async requests share the concurrency limit."""
+    from server.nlp import openai_client
+    from server.nlp.async_clients import run
+
+    monkeypatch.setattr(openai_client, "_semaphore", threading.BoundedSemaphore(2))
+    with OpenAIStub(latency=0.05) as stub:
+        client = openai_client.create_openai_client(stub.url)
+        async_client = openai_client.create_async_openai_client(stub.url)
+
+        async def asend_all():
+            await asyncio.gather(
+                *(
+                    openai_client.aopenai_request(
+                        acreate_completion,
+                        async_client.chat.completions,
+                        model="gpt-4o",
+                        messages=MESSAGES,
+                    )
+                    for _ in range(4)
+                )
+            )
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(send, client) for _ in range(4)]
+            run(asend_all())
+            for future in futures:
+                future.result()
+    assert stub.requests == 8
+    assert stub.max_in_flight == 2
+
+
+def test_stream_holds_slot(monkeypatch: pytest.MonkeyPatch):
+    """Test that a streaming request holds its slot until the stream is consumed."""
+    from server.nlp import openai_client
+    from server.nlp.async_clients import run
+
+    semaphore = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(openai_client, "_semaphore", semaphore)
+
+    async def chunks():
+        yield "Dear"
+        yield " Alyssa"
+
+    async def create(**kwargs):
+        return chunks()
+
+    async def consume():
+        stream = await openai_client.aopenai_request(create, stream=True)
+        assert not semaphore.acquire(blocking=False)
+        assert [chunk async for chunk in stream] == ["Dear", " Alyssa"]
+        assert semaphore.acquire(blocking=False)
+
+    run(consume())
+
+
+def test_rate_limits(monkeypatch: pytest.MonkeyPatch):
+    """Test that the request and token buckets limit requests."""
+    from server import redis_client
+    from server.nlp import openai_client
+
+    assert redis_client is not None
+    monkeypatch.setattr(openai_client, "OPENAI_REQUESTS_PER_MINUTE", 2)
+    monkeypatch.setattr(openai_client, "OPENAI_TOKENS_PER_MINUTE", 100)
+    redis_client.delete(*openai_client.bucket_keys)
+    try:
+        assert openai_client.reserve(10) == 0
+        assert openai_client.reserve(10) == 0
+        # out of requests, a request refills in 30 seconds
+        assert 0 < openai_client.reserve(10) <= 30
+
+        redis_client.delete(*openai_client.bucket_keys)
+        assert openai_client.reserve(80) == 0
+        # out of tokens, the missing 60 tokens refill in 36 seconds
+        assert 0 < openai_client.reserve(80) <= 36
+    finally:
+        redis_client.delete(*openai_client.bucket_keys)
@@ -0,0 +1,52 @@
+def document(sql_id: int, score: float, content: str = "content") -> dict:
+    """Build a context document."""
+    return {
+        "sql_id": sql_id,
+        "score": score,
+        "question": f"question {sql_id}",
+        "content": content,
+        "source": "source",
+        "label": "label",
+    }
+
+
+def test_dedup_documents():
+    """Test that documents retrieved for several questions are only kept once."""
+    # server modules need the redis client, which is only set up with the app
+    from server.nlp.prompt_builder import dedup_documents
+
+    docs = {
+        "When is the deadline?": [document(1, 0.8), document(2, 0.7)],
+        "Is there travel reimbursement?": [document(3, 0.9), document(1, 0.85)],
+    }
+    documents = dedup_documents(docs)
+    assert [doc["sql_id"] for doc in documents] == [3, 1, 2]
+    assert documents[1]["score"] == 0.85
+
+
+def test_build_prompt_budget():
+    """Test that prompts keep the best documents and newest messages in budget."""
+    from server.nlp.prompt_builder import build_prompt
+
+    thread = [
+        {"role": "user", "content": "old email " * 200},
+        {"role": "assistant", "content": "old response " * 200},
+        {"role": "user", "content": "recent email"},
+        {"role": "assistant", "content": "recent response"},
+    ]
+    docs = {
+        "question": [
+            document(1, 0.9, "short"),
+            document(2, 0.8, "long " * 1000),
+            document(3, 0.7, "short"),
+        ]
+    }
+    messages, tokens_before, tokens_after = build_prompt(
+        thread, "new email", docs, budget=300
+    )
+    assert messages[:2] == thread[2:]
+    assert messages[2]["content"].endswith("new email")
+    assert "question 1" in messages[3]["content"]
+    assert "question 2" not in messages[3]["content"]
+    assert "question 3" in messages[3]["content"]
+    assert tokens_after <= 300 < tokens_before
@@ -0,0 +1,68 @@
+from server.config import QUESTION_SPLITTER_MIN_CONFIDENCE
+from server.nlp.question_splitter import split_questions
+
+
+def test_single_question():
+    """Test splitting an email with a single question."""
+    questions, confidence = split_questions(
+        "Hi team,\nWhen is the application deadline?\nBest,\nAlex"
+    )
+    assert questions == ["When is the application deadline?"]
+    assert confidence >= QUESTION_SPLITTER_MIN_CONFIDENCE
+
+
+def test_numbered_list():
+    """Test splitting an email with a numbered list of questions."""
+    questions, confidence = split_questions(
+        "Hello!\n"
+        "1. Is there travel reimbursement?\n"
+        "2) Can I bring a friend?\n"
+        "3. Where do we submit projects?\n"
+        "Thanks!\n"
+        "Sam"
+    )
+    assert questions == [
+        "Is there travel reimbursement?",
+        "Can I bring a friend?",
+        "Where do we submit projects?",
+    ]
+    assert confidence >= QUESTION_SPLITTER_MIN_CONFIDENCE
+
+
+def test_question_marks():
+    """Test splitting sentences ending in question marks."""
+    questions, confidence = split_questions(
+        "Dear HackMIT, I'm a first-year student. What is HackMIT? "
+        "What is the best way to get started?\n\n--\nJordan"
+    )
+    assert questions == ["What is HackMIT?", "What is the best way to get started?"]
+    assert confidence >= QUESTION_SPLITTER_MIN_CONFIDENCE
+
+
+def test_no_questions():
+    """Test that emails without questions are kept whole."""
+    questions, confidence = split_questions(
+        "Thanks so much for organizing, see you at the event!"
+    )
+    assert questions == ["Thanks so much for organizing, see you at the event!"]
+    assert confidence >= QUESTION_SPLITTER_MIN_CONFIDENCE
+
+
+def test_low_confidence():
+    """Test that ambiguous emails are left to OpenAI."""
+    for email in [
+        "Please let me know what the schedule is.",
+        "I registered late. Is that ok?",
+        "I was wondering about parking. Also, is food provided?",
+        "What time is it. Where is MIT?",
+    ]:
+        _, confidence = split_questions(email)
+        assert confidence < QUESTION_SPLITTER_MIN_CONFIDENCE
+
+
+def test_text_after_sign_off():
+    """Test that questions after a sign-off aren't stripped as the signature."""
+    questions, _ = split_questions(
+        "Hi team,\nWhen is the deadline?\nThanks!\nAlso, is there food?"
+    )
+    assert questions == ["When is the deadline?", "Also, is there food?"]
@@ -0,0 +1,15 @@
+import json
+from pathlib import Path
+
+import pytest
+
+# emails written with common email clients, and the text their senders wrote
+CORPUS = json.loads((Path(__file__).parent / "quote_corpus.json").read_text())
+
+
+@pytest.mark.parametrize("case", CORPUS, ids=[case["client"] for case in CORPUS])
+def test_strip_quotes(case: dict):
+    """Test stripping the quoted replies and signatures of emails."""
+    from server.nlp.quote_stripper import strip_quotes
+
+    assert strip_quotes(case["body"]) == case["expected"]
@@ -0,0 +1,60 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from apiflask import APIFlask
+from redis.exceptions import RedisError
+
+
+def test_sender_first_name():
+    """Test guessing the first name of a sender."""
+    from server.nlp.response_cache import sender_first_name
+
+    assert sender_first_name("Alyssa Hacker <alyssa@mit.edu>", "Hi") == "Alyssa"
+    email = "Hi,\nWhen is the deadline?\nThanks,\nBen Bitdiddle"
+    assert sender_first_name("ben@mit.edu", email) == "Ben"
+    assert sender_first_name("ben@mit.edu", "When is the deadline?") is None
+
+
+def test_personalize_greeting():
+    """Test greeting the sender of a new email in a cached response."""
+    from server.nlp.response_cache import personalize_greeting
+
+    response = "Dear Alyssa,\n\nThe deadline is May 1.\n\nBest regards,\nThe Team"
+    assert personalize_greeting(response, "Ben <ben@mit.edu>", "Hi") == (
+        "Dear Ben,\n\nThe deadline is May 1.\n\nBest regards,\nThe Team"
+    )
+    assert personalize_greeting(response, "ben@mit.edu", "Hi").startswith(
+        "Hi there,\n\n"
+    )
+
+
+def test_cache_response(app: APIFlask):
+    """Test that cached responses are found for the same corpus version only."""
+    from server.config import VECTOR_DIMENSION
+    from server.nlp.async_clients import run
+    from server.nlp.response_cache import (
+        acache_response,
+        aget_cached_response,
+        corpus_version,
+    )
+
+    embedding = [0.1] * VECTOR_DIMENSION
+    # a version no other test caches responses for
+    version = run(corpus_version()) + 1000
+    assert run(aget_cached_response(embedding, version)) is None
+
+    docs = {"When is the deadline?": [{"content": "May 1", "score": "0.9"}]}
+    run(acache_response(embedding, version, "Dear Alyssa,", docs, 0.9))
+    assert run(aget_cached_response(embedding, version)) == ("Dear Alyssa,", docs, 0.9)
+    assert run(aget_cached_response(embedding, version + 1)) is None
+
+
+def test_cache_response_redis_error():
+    """Test that failing to cache a response doesn't fail the response."""
+    from server.nlp.async_clients import run
+    from server.nlp.response_cache import acache_response
+
+    client = MagicMock()
+    client.pipeline.return_value.execute = AsyncMock(side_effect=RedisError("down"))
+    with patch("server.nlp.response_cache.async_redis_client", return_value=client):
+        run(acache_response([0.1], 0, "Dear Alyssa,", {}, 0.9))
+    client.pipeline.return_value.execute.assert_awaited_once()
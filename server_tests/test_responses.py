@@ -0,0 +1,75 @@
+def test_parse_questions():
+    """Test validating the questions OpenAI parsed from an email."""
+    # server modules need the redis client, which is only set up with the app
+    from server.nlp.responses import parse_questions
+
+    assert parse_questions('{"questions": ["When?", " Where? "]}') == [
+        "When?",
+        "Where?",
+    ]
+    assert parse_questions('{"questions": []}') is None
+    assert parse_questions('{"questions": [""]}') is None
+    assert parse_questions("mocked openai message!") is None
+    assert parse_questions(None) is None
+
+
+def test_fast_path_response():
+    """Test assembling a response from the best matching documents."""
+    from server.nlp.responses import fast_path_response
+
+    deadline = {"content": "The deadline is May 1.", "score": 0.95}
+    docs = {
+        "When is the deadline?": [{"content": "Apply online.", "score": 0.7}, deadline],
+        "When are applications due?": [deadline],
+    }
+    response = fast_path_response("ben@mit.edu", "Hi, when is the deadline?", docs)
+    assert response.count("The deadline is May 1.") == 1
+    assert "Apply online." not in response
+    assert response.endswith("Best regards,\nThe HackMIT Team")
+
+
+def test_use_fast_path(monkeypatch):
+    """Test that team replies are never reused verbatim by the fast path."""
+    from server.config import TEAM_REPLY_SOURCE
+    from server.nlp import responses
+
+    monkeypatch.setattr(responses, "FAST_PATH_ENABLED", True)
+    faq = {"content": "The deadline is May 1.", "source": "FAQ", "score": "0.95"}
+    reply = {"content": "Hi Alyssa, it's May 1!", "source": TEAM_REPLY_SOURCE}
+    docs = {"When is the deadline?": [faq]}
+    assert responses.use_fast_path([], docs, 0.95)
+    assert not responses.use_fast_path([], docs, 0.5)
+    docs["When are applications due?"] = [faq, {**reply, "score": "0.96"}]
+    assert not responses.use_fast_path([], docs, 0.95)
+    docs["When are applications due?"] = [faq, {**reply, "score": "0.9"}]
+    assert responses.use_fast_path([], docs, 0.95)
+
+
+def test_response_cache_unavailable(monkeypatch):
+    """Test that responses are generated when the response cache is unreachable."""
+    from unittest.mock import AsyncMock
+
+    from redis.exceptions import ConnectionError
+
+    from server.nlp import responses
+    from server.nlp.async_clients import run
+
+    monkeypatch.setattr(responses, "RESPONSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(
+        responses,
+        "acompute_query_embeddings",
+        AsyncMock(side_effect=ConnectionError("down")),
+    )
+    monkeypatch.setattr(
+        responses, "agenerate_context", AsyncMock(return_value=({}, 0.5))
+    )
+    monkeypatch.setattr(responses, "abuild_prompt", AsyncMock(return_value=[]))
+    monkeypatch.setattr(
+        responses, "aopenai_response", AsyncMock(return_value="Dear Ben,")
+    )
+    cache_response = AsyncMock()
+    monkeypatch.setattr(responses, "acache_response", cache_response)
+
+    response = run(responses.agenerate_response("ben@mit.edu", "When?"))
+    assert response == ("Dear Ben,", {}, 0.5, False)
+    cache_response.assert_not_awaited()
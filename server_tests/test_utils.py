@@ -0,0 +1,24 @@
+import io
+import json
+import logging
+
+
+def test_custom_log():
+    """Test that custom_log writes JSON with its caller, and skips lower levels."""
+    from server.utils import JsonFormatter, configure_logging, custom_log, logger
+
+    configure_logging("INFO", "json", 1)
+    stream = io.StringIO()
+    logger.handlers[0] = logging.StreamHandler(stream)
+    logger.handlers[0].setFormatter(JsonFormatter())
+
+    custom_log("imported", 3, "emails")
+    custom_log("query:", {"role": "user"}, level=logging.DEBUG)
+
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 1
+    entry = json.loads(lines[0])
+    assert entry["level"] == "INFO"
+    assert entry["function"] == "test_custom_log"
+    assert entry["file"] == __file__
+    assert entry["message"] == "imported 3 emails"
@@ -0,0 +1,113 @@
+def test_reciprocal_rank_fusion():
+    """Test merging vector and full-text rankings."""
+    # server modules need the redis client, which is only set up with the app
+    from server.nlp.vector_store import reciprocal_rank_fusion
+
+    by_vector = [{"sql_id": 1, "score": 0.9}, {"sql_id": 2, "score": 0.8}]
+    by_text = [{"sql_id": 3, "score": 0.8}, {"sql_id": 2, "score": 0.8}]
+    fused = reciprocal_rank_fusion([by_vector, by_text], [1.0, 1.0], k=2)
+    # found by both queries, so ranked first, with the score of the vector ranking
+    assert fused == [{"sql_id": 2, "score": 0.8}, {"sql_id": 1, "score": 0.9}]
+
+    fused = reciprocal_rank_fusion([by_vector, by_text], [1.0, 0.0], k=3)
+    assert [doc["sql_id"] for doc in fused] == [1, 2, 3]
+
+
+def test_create_text_query():
+    """Test building full-text queries from questions."""
+    from server.nlp.vector_store import create_text_query
+
+    query = create_text_query("What is the WiFi password?", 5)
+    assert query is not None
+    assert query.query_string() == "@question|content:(what|wifi|password)"
+    assert create_text_query("Is it?", 5) is None
+
+
+def test_maximal_marginal_relevance():
+    """Test that near-duplicates of picked candidates are passed over."""
+    import numpy as np
+
+    from server.nlp.vector_store import maximal_marginal_relevance, normalize
+
+    query = normalize(np.array([[1.0, 0.0, 0.0]]))[0]
+    candidates = normalize(
+        np.array([[1.0, 0.1, 0.0], [1.0, 0.12, 0.0], [0.7, 0.0, 0.7]])
+    )
+    assert maximal_marginal_relevance(query, candidates, 2, 1.0) == [0, 1]
+    assert maximal_marginal_relevance(query, candidates, 2, 0.5) == [0, 2]
+
+
+def numpy_store(precision: str = "float32"):
+    """Empty in-memory store of 3-dimensional vectors that never reloads."""
+    from server.nlp.vector_store import NumpyVectorStore
+
+    return NumpyVectorStore(lambda: ([], []), lambda: None, 60, 3, precision)
+
+
+def document(sql_id: int) -> dict:
+    """Document with the given sql_id."""
+    return {"question": f"Q{sql_id}", "source": "", "content": "", "sql_id": sql_id}
+
+
+def test_numpy_store_upsert():
+    """Test that the matrix grows as documents are added, and upserts replace."""
+    store = numpy_store()
+    vectors = [[1.0, float(i), 0.0] for i in range(100)]
+    store.upsert([document(i) for i in range(100)], vectors)
+    assert len(store) == 100
+    assert store._matrix.shape == (128, 3)
+
+    store.upsert([document(5)], [[0.0, 0.0, 1.0]])
+    assert len(store) == 100
+    [[best]] = store.search([[0.0, 0.0, 1.0]], 1)
+    assert best["sql_id"] == 5
+    assert best["score"] == 1.0
+
+
+def test_numpy_store_delete():
+    """Test that deleted rows are filled with the last row."""
+    store = numpy_store()
+    vectors = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+    store.upsert([document(i) for i in range(3)], vectors)
+    store.delete([0, 42])
+    assert len(store) == 2
+    assert store._rows == {2: 0, 1: 1}
+    assert [doc["sql_id"] for doc in store._documents] == [2, 1]
+    [[best]] = store.search([[0.0, 0.0, 1.0]], 1)
+    assert best["sql_id"] == 2
+    [[best]] = store.search([[1.0, 0.0, 0.0]], 1)
+    assert best["score"] == 0.0
+
+
+def test_numpy_store_search():
+    """Test that results are ordered by similarity, and capped at k."""
+    store = numpy_store()
+    vectors = [[1.0, 1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+    store.upsert([document(i) for i in range(4)], vectors)
+    [results] = store.search([[1.0, 0.2, 0.0]], 3)
+    assert [doc["sql_id"] for doc in results] == [1, 0, 2]
+    [results] = store.search([[1.0, 0.2, 0.0]], 10)
+    assert len(results) == 4
+
+
+def test_quantize():
+    """Test that int8 quantized vectors round-trip within a quantization step."""
+    import numpy as np
+
+    from server.nlp.vector_store import normalize, quantize
+
+    vectors = normalize(np.random.default_rng(0).normal(size=(10, 64)))
+    quantized, scales = quantize(vectors)
+    assert quantized.dtype == np.int8
+    assert np.abs(quantized).max() == 127
+    restored = quantized * scales[:, None]
+    assert np.all(np.abs(restored - vectors) <= scales[:, None] / 2 + 1e-6)
+
+    store = numpy_store("int8")
+    store.upsert(
+        [document(i) for i in range(3)],
+        [[1.0, 0.5, 0.0], [0.0, 1.0, 0.0], [0.2, 0.0, 1.0]],
+    )
+    [results] = store.search([[1.0, 0.5, 0.0]], 3)
+    assert [doc["sql_id"] for doc in results] == [0, 1, 2]
+    assert results[0]["score"] == 1.0
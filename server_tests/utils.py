@@ -16,12 +16,15 @@ def assert_status(response: TestResponse, status: int):
         )
         raise
 
+
 def seed_database():
     """Seeds the database with some fake data."""
 
+    from server import db
     from server.fake_data import generate_fake_thread, generate_test_documents
     from server.nlp.embeddings import embed_corpus
 
     test_documents = generate_test_documents()
     embed_corpus(test_documents)
+    db.session.commit()
     generate_fake_thread()
@@ -1,9 +1,15 @@
 """WSGI entrypoint."""
 
+import os
+
 from server import create_app
+from server.jobs import start_response_workers
 
 if __name__ == "__main__":
     app = create_app()
     port = app.config["FLASK_RUN_PORT"]
     debug = app.config["DEBUG"]
+    # the reloader serves the app from a child process, so only start workers there
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_response_workers(app, app.config["JOB_WORKERS"])
     app.run(host="0.0.0.0", port=port, debug=debug)